@@ -0,0 +1,359 @@
+"""
+A forwarding engine built on asyncio, as an alternative to portforward.
+
+This has the same add_mapping/del_mapping/get_mappings/quit interface as the
+portforward module, and (like portforward) runs its event loop on a thread of
+its own as soon as it is imported. The difference is that the loop is
+asyncio's, so connect timeouts are handled by the loop and flow control is
+done by pausing and resuming the transports. If uvloop is installed, then it
+is used in place of the default event loop.
+
+Only TCP -> TCP mappings are supported. The connect_timeout, backlog and
+balance options and the socket options have an effect, while the rest are
+accepted but ignored.
+"""
+
+import asyncio
+import errno
+import logging
+import os
+import socket
+import threading
+
+import balancer
+from mapping import (Protocol, Address, Relay, HIGH_WATERMARK, LOW_WATERMARK,
+                     parse_options, check_portspec, settle_batch, check_removals,
+                     format_address, tune_socket, tune_listener)
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+logger = logging.getLogger('[' + __name__ + ']')
+
+class ForwardProtocol(asyncio.Protocol):
+    """
+    One side of a forwarded connection, which writes everything it receives
+    to the transport of its peer. Nothing is read until the peer is known.
+    """
+    def __init__(self):
+        self.transport = None
+        self.peer = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.set_write_buffer_limits(high=HIGH_WATERMARK, low=LOW_WATERMARK)
+        connections.add(transport)
+        if self.peer is None:
+            transport.pause_reading()
+
+    def data_received(self, data):
+        self.peer.transport.write(data)
+
+    def eof_received(self):
+        # Closing the peer still lets it finish writing what it has buffered
+        self.peer.transport.close()
+        return False
+
+    def connection_lost(self, exc):
+        connections.discard(self.transport)
+        if self.peer is not None:
+            self.peer.transport.close()
+
+    def pause_writing(self):
+        self.peer.transport.pause_reading()
+
+    def resume_writing(self):
+        self.peer.transport.resume_reading()
+
+class InboundProtocol(ForwardProtocol):
+    "The accepted side of a forwarded connection, which connects the bridge"
+    def __init__(self, server):
+        super().__init__()
+        self._server = server
+        self._dest = None
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        self._server.connections.add(self)
+        tune_socket(transport.get_extra_info('socket'), self._server.options)
+        self._dest = self._server.balancer.pick(transport.get_extra_info('peername'))
+        loop.create_task(self._connect())
+
+    def connection_lost(self, exc):
+        super().connection_lost(exc)
+        self._server.connections.discard(self)
+        self._server.balancer.release(self._dest)
+
+    async def _connect(self):
+        dest_host, dest_port, _ = self._dest
+        sock = None
+        try:
+            # The socket is created here so that it can be tuned before it
+            # connects
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            tune_socket(sock, self._server.options)
+            await asyncio.wait_for(loop.sock_connect(sock, (dest_host, dest_port)),
+                                   self._server.options['connect_timeout'])
+            _, bridge = await loop.create_connection(ForwardProtocol, sock=sock)
+        except Exception as err:
+            # Not just OSErrors and timeouts - looking up a name with an
+            # overlong label raises a UnicodeError, and the inbound side still
+            # has to be closed
+            logger.error("TCP: Unable To Connect To %s Because '%s'",
+                         format_address(self._dest), str(err) or 'timed out')
+            if sock is not None:
+                sock.close()
+            self.transport.close()
+            return
+
+        if self.transport.is_closing():
+            bridge.transport.close()
+            return
+
+        self.peer = bridge
+        bridge.peer = self
+        self.transport.resume_reading()
+        bridge.transport.resume_reading()
+
+class Server:
+    "A mapping, and the asyncio server which listens for it"
+    def __init__(self, src, dest, options):
+        self.src = src
+        self.balancer = balancer.make_balancer(options['balance'], [dest])
+        self.options = options
+        self.server = None
+
+        # The inbound sides of the connections which were accepted by this
+        # server and are still open
+        self.connections = set()
+
+    def __str__(self):
+        return "{} -> {}".format(format_address(self.src),
+                                 ', '.join(map(format_address, self.balancer.backends)))
+
+    async def setup(self):
+        "Starts listening on the source address"
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            tune_listener(sock, self.options)
+            sock.bind(self.src[:Address.HOST_AND_PORT])
+        except OSError:
+            sock.close()
+            raise
+
+        self.server = await loop.create_server(
+            lambda: InboundProtocol(self), sock=sock, backlog=self.options['backlog'])
+        logger.debug("TCP: Created Server %s", self)
+
+    def destroy(self):
+        "Stops listening, while leaving existing connections alone"
+        logger.debug("TCP: Destroying %s", self)
+        self.server.close()
+
+    def drain(self):
+        """
+        Closes all of this server's connections once the data which they have
+        already read has been written.
+        """
+        logger.debug("TCP: Draining %i Connections Of %s", len(self.connections), self)
+        for inbound in list(self.connections):
+            # Closing a transport still lets it finish writing what it has
+            # buffered, and each side closes its peer once it is gone
+            inbound.transport.pause_reading()
+            inbound.transport.close()
+            if inbound.peer is not None:
+                inbound.peer.transport.pause_reading()
+                inbound.peer.transport.close()
+
+if uvloop is not None:
+    loop = uvloop.new_event_loop()
+else:
+    loop = asyncio.new_event_loop()
+
+# Map: src_portspec -> Server
+src_to_svr = {}
+
+# The transports of every open connection, so that they can be closed on exit
+connections = set()
+
+async def _add_mapping(src_portspec, dest_portspec, options):
+    if src_portspec in src_to_svr:
+        raise OSError(errno.EADDRINUSE, os.strerror(errno.EADDRINUSE))
+
+    server = Server(src_portspec, dest_portspec, options)
+    await server.setup()
+    src_to_svr[src_portspec] = server
+
+async def _del_mapping(src_portspec, drain):
+    server = src_to_svr.pop(src_portspec)
+    server.destroy()
+    if drain:
+        server.drain()
+
+async def _add_mappings(mappings, errors, atomic):
+    added = []
+    for index, (src_portspec, dest_portspec, options) in enumerate(mappings):
+        if errors[index] is not None:
+            continue
+
+        try:
+            await _add_mapping(src_portspec, dest_portspec, options)
+            added.append(index)
+        except Exception as err:
+            # Whatever goes wrong, the rest of the batch (and the rollback of
+            # an atomic one) has to go ahead
+            errors[index] = err
+
+    if atomic and any(errors):
+        for index in added:
+            await _del_mapping(mappings[index][0], False)
+    return settle_batch(errors, atomic)
+
+async def _del_mappings(src_portspecs, drain, atomic):
+    errors = check_removals(src_portspecs, src_to_svr, atomic)
+    for src_portspec, err in zip(src_portspecs, errors):
+        if err is None:
+            await _del_mapping(src_portspec, drain)
+    return errors
+
+async def _add_backend(src_portspec, dest_portspec):
+    src_to_svr[src_portspec].balancer.add(dest_portspec)
+
+async def _del_backend(src_portspec, dest_portspec):
+    src_to_svr[src_portspec].balancer.remove(dest_portspec)
+
+async def _get_mappings():
+    return [(svr.src, dest, dict(svr.options)) for svr in src_to_svr.values()
+            for dest in svr.balancer.backends]
+
+def check_mapping(src_portspec, dest_portspec, options):
+    "Parses the options of a mapping, and checks that this engine can forward it"
+    check_portspec(src_portspec)
+    check_portspec(dest_portspec)
+    options = parse_options(options)
+    if (src_portspec[Address.PROTOCOL] != Protocol.TCP or
+            dest_portspec[Address.PROTOCOL] != Protocol.TCP):
+        raise ValueError("The asyncio engine only supports TCP -> TCP mappings")
+    if options['relay'] == Relay.SPLICE:
+        logger.warning("The asyncio engine can't splice, so it will copy instead")
+    return options
+
+def add_mapping(src_portspec, dest_portspec, options=None):
+    """
+    Adds a mapping from a source host and port to a destination host
+    and port.
+    """
+    options = check_mapping(src_portspec, dest_portspec, options)
+    logger.debug("Added %s -> %s ...",
+                 format_address(src_portspec), format_address(dest_portspec))
+
+    asyncio.run_coroutine_threadsafe(
+        _add_mapping(src_portspec, dest_portspec, options), loop).result()
+
+def add_mappings(mappings, atomic=False):
+    """
+    Adds many mappings at once, from a list of (src_portspec, dest_portspec,
+    options) triples. Returns a list with None for each mapping which was
+    added, and the error for each which wasn't - if atomic is True, then
+    either every mapping is added or none of them are.
+    """
+    logger.debug("Adding %i Mappings ...", len(mappings))
+    checked = []
+    errors = []
+    for src_portspec, dest_portspec, options in mappings:
+        src_portspec, dest_portspec = tuple(src_portspec), tuple(dest_portspec)
+        try:
+            options = check_mapping(src_portspec, dest_portspec, options)
+            errors.append(None)
+        except ValueError as err:
+            errors.append(err)
+        checked.append((src_portspec, dest_portspec, options))
+
+    if atomic and any(errors):
+        return settle_batch(errors, atomic)
+    return asyncio.run_coroutine_threadsafe(
+        _add_mappings(checked, errors, atomic), loop).result()
+
+def del_mapping(src_portspec, drain=False):
+    """
+    Removes a mapping currently on a source host and port. Existing connections
+    are kept alive, unless drain is True, in which case they are closed once
+    the data which they have already read is written.
+    """
+    logger.debug("Removed %s ...", format_address(src_portspec))
+    asyncio.run_coroutine_threadsafe(_del_mapping(src_portspec, drain), loop).result()
+
+def del_mappings(src_portspecs, drain=False, atomic=False):
+    """
+    Removes many mappings at once. Returns a list with None for each mapping
+    which was removed, and the error for each which wasn't - if atomic is
+    True, then either every mapping is removed or none of them are.
+    """
+    logger.debug("Removing %i Mappings ...", len(src_portspecs))
+    return asyncio.run_coroutine_threadsafe(
+        _del_mappings([tuple(src) for src in src_portspecs], drain, atomic), loop).result()
+
+def add_backend(src_portspec, dest_portspec):
+    "Adds another destination to an existing mapping"
+    check_portspec(dest_portspec)
+    logger.debug("Added Backend %s To %s ...",
+                 format_address(dest_portspec), format_address(src_portspec))
+    if dest_portspec[Address.PROTOCOL] != Protocol.TCP:
+        raise ValueError("The asyncio engine only supports TCP -> TCP mappings")
+
+    asyncio.run_coroutine_threadsafe(
+        _add_backend(tuple(src_portspec), tuple(dest_portspec)), loop).result()
+
+def del_backend(src_portspec, dest_portspec):
+    """
+    Removes a destination from a mapping, while keeping the connections which
+    are already open to it alive.
+    """
+    logger.debug("Removed Backend %s From %s ...",
+                 format_address(dest_portspec), format_address(src_portspec))
+    asyncio.run_coroutine_threadsafe(
+        _del_backend(tuple(src_portspec), tuple(dest_portspec)), loop).result()
+
+def get_mappings():
+    """
+    Returns a list of (src_portspec, dest_portspec, options) for every mapping
+    - a mapping with several destinations appears once for each of them.
+    """
+    return asyncio.run_coroutine_threadsafe(_get_mappings(), loop).result()
+
+def set_profiling(enabled):
+    "Profiling is only supported by the portforward engine"
+    if enabled:
+        raise ValueError("The asyncio engine can't be profiled")
+
+def get_profile():
+    "Returns an empty profile, since this engine is never profiled"
+    return {}
+
+def start_metrics(port, host='127.0.0.1'):
+    "Metrics are only kept by the portforward engine"
+    raise ValueError("The asyncio engine doesn't export metrics")
+
+def quit():
+    loop.call_soon_threadsafe(loop.stop)
+
+def start():
+    "Runs the event loop until quit() is called, and then cleans up"
+    asyncio.set_event_loop(loop)
+    loop.run_forever()
+
+    for server in src_to_svr.values():
+        server.destroy()
+
+    for transport in list(connections):
+        transport.abort()
+
+    loop.run_until_complete(asyncio.sleep(0))
+    loop.close()
+
+thread = threading.Thread(target=start)
+thread.start()
@@ -0,0 +1,129 @@
+"""
+Ways of spreading a mapping's connections over several destinations.
+
+Each mapping has a balancer, which holds its destination portspecs (its
+backends) and picks one of them for each new connection. Balancers also keep
+count of how many connections each backend has, which the forwarder reports
+by calling release() once a connection is closed.
+"""
+
+import bisect
+import hashlib
+import itertools
+
+from mapping import Balance
+
+class Balancer:
+    "The parts that are common to every balancing strategy"
+    def __init__(self, backends):
+        self.backends = []
+        # Map: backend -> number of open connections
+        # Backends which have been removed stay here until their last
+        # connection is closed, so that their counts are still right if they
+        # are added back before then
+        self.active = {}
+        for backend in backends:
+            self.add(backend)
+
+    def add(self, backend):
+        "Adds a new backend, which new connections can be sent to right away"
+        if backend in self.backends:
+            raise ValueError("{} is already a backend".format(backend))
+
+        self.backends.append(backend)
+        self.active.setdefault(backend, 0)
+
+    def remove(self, backend):
+        """
+        Stops sending new connections to a backend. Connections which are
+        already open to it are left alone.
+        """
+        if backend not in self.backends:
+            raise KeyError(backend)
+        elif len(self.backends) == 1:
+            raise ValueError("Can't remove the last backend of a mapping")
+
+        self.backends.remove(backend)
+        if not self.active[backend]:
+            del self.active[backend]
+
+    def pick(self, client_addr):
+        "Picks the backend for a new connection from the given client address"
+        backend = self._choose(client_addr)
+        self.active[backend] += 1
+        return backend
+
+    def release(self, backend):
+        "Records that a connection to a backend has been closed"
+        if backend not in self.active:
+            return
+
+        self.active[backend] -= 1
+        if not self.active[backend] and backend not in self.backends:
+            del self.active[backend]
+
+    def _choose(self, client_addr):
+        raise NotImplementedError
+
+class RoundRobin(Balancer):
+    "Sends each connection to the next backend in turn"
+    def __init__(self, backends):
+        self._counter = itertools.count()
+        super().__init__(backends)
+
+    def _choose(self, client_addr):
+        return self.backends[next(self._counter) % len(self.backends)]
+
+class LeastConnections(Balancer):
+    "Sends each connection to the backend with the fewest open connections"
+    def _choose(self, client_addr):
+        return min(self.backends, key=self.active.__getitem__)
+
+class ConsistentHash(Balancer):
+    """
+    Sends all the connections from a client's host to the same backend, for as
+    long as that backend is around. Each backend gets several points on a hash
+    ring so that clients are spread evenly, and adding or removing a backend
+    only moves the clients whose points it takes over or gives up.
+    """
+    POINTS_PER_BACKEND = 64
+
+    def __init__(self, backends):
+        # The ring is kept as two sorted, parallel lists
+        self._hashes = []
+        self._owners = []
+        super().__init__(backends)
+
+    @staticmethod
+    def _hash(key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest()
+        return int.from_bytes(digest, 'big')
+
+    def add(self, backend):
+        super().add(backend)
+        for point in range(self.POINTS_PER_BACKEND):
+            point_hash = self._hash('{}:{}:{}#{}'.format(*backend, point))
+            index = bisect.bisect(self._hashes, point_hash)
+            self._hashes.insert(index, point_hash)
+            self._owners.insert(index, backend)
+
+    def remove(self, backend):
+        super().remove(backend)
+        kept = [(point_hash, owner) for point_hash, owner
+                in zip(self._hashes, self._owners) if owner != backend]
+        self._hashes = [point_hash for point_hash, _ in kept]
+        self._owners = [owner for _, owner in kept]
+
+    def _choose(self, client_addr):
+        index = bisect.bisect(self._hashes, self._hash(client_addr[0]))
+        return self._owners[index % len(self._owners)]
+
+STRATEGIES = {
+    Balance.ROUND_ROBIN: RoundRobin,
+    Balance.LEAST_CONN: LeastConnections,
+    Balance.HASH: ConsistentHash,
+}
+
+def make_balancer(strategy, backends):
+    "Creates a balancer using the named strategy"
+    return STRATEGIES[strategy](backends)
@@ -0,0 +1,608 @@
+"""
+Benchmarks the port forwarding service over loopback.
+
+This starts a copy of proxy-service-sockets (on a control socket of its own, so
+it can run alongside a real service), along with a process which runs a sink
+server and an echo server. Mappings onto those servers are added through the
+control socket - the same way that the tool adds them - and load is driven
+through the mappings from this process.
+
+The scenarios are:
+
+  throughput: Several connections each push a share of --bulk-bytes into the
+    sink at once, which replies once all of it has arrived. Reports MB/s, along with
+    how many seconds of CPU the service used per GB forwarded.
+  latency: Several connections each send --requests small messages to the
+    echo server, one at a time, timing how long each takes to come back.
+    Reports percentiles of the round trip time, in milliseconds.
+  connect: Several threads open connections to the echo server as fast as they
+    can for --duration seconds, sending one byte on each and waiting for it to
+    come back before closing. Reports connections per second.
+  hold: Several processes open --hold-connections connections to the echo
+    server between them, and hold them open. Reports how much memory the
+    service uses for each one, how much CPU it uses while they are idle, and
+    how the latency of a few active connections changes while they are held.
+    With --service-fd-limit, this also shows what the service does when it
+    runs out of file descriptors - it should turn the extra connections away
+    and carry on, which is checked once they are all closed again.
+
+Each scenario also reports how much CPU the service (along with any worker
+processes) used while it ran, which is read from /proc. The results are
+written out as JSON, so that runs with different engines or options can be
+compared.
+
+Example:
+    python3 bench-forward.py --engine portforward --option relay=splice \\
+        --output splice.json
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import selectors
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import socketproto
+
+parser = argparse.ArgumentParser(description='Benchmarks the port forwarding service over loopback')
+parser.add_argument('--engine', choices=('portforward', 'asyncio'), default='portforward',
+                    help='The event loop that the service forwards connections with')
+parser.add_argument('--workers', type=int, default=1,
+                    help='The number of processes that the service forwards connections with')
+parser.add_argument('--option', action='append', default=[], metavar='KEY=VALUE',
+                    help='An option for the benchmark mappings (can be given more than once)')
+parser.add_argument('--scenario', action='append',
+                    choices=('throughput', 'latency', 'connect', 'hold'),
+                    help='A scenario to run (can be given more than once - the default is all of them)')
+parser.add_argument('--bulk-bytes', type=int, default=1 << 30,
+                    help='How many bytes the throughput scenario sends altogether')
+parser.add_argument('--bulk-connections', type=int, default=4,
+                    help='How many connections the throughput scenario uses')
+parser.add_argument('--requests', type=int, default=5000,
+                    help='How many requests each latency connection makes')
+parser.add_argument('--request-size', type=int, default=64,
+                    help='How many bytes each latency request is')
+parser.add_argument('--latency-connections', type=int, default=4,
+                    help='How many connections the latency scenario uses')
+parser.add_argument('--duration', type=float, default=5.0,
+                    help='How many seconds the connect scenario runs for')
+parser.add_argument('--connect-threads', type=int, default=8,
+                    help='How many threads the connect scenario opens connections from')
+parser.add_argument('--hold-connections', type=int, default=10000,
+                    help='How many connections the hold scenario opens')
+parser.add_argument('--hold-processes', type=int, default=4,
+                    help='How many processes the hold scenario opens connections from')
+parser.add_argument('--service-fd-limit', type=int,
+                    help='The most file descriptors that the service can have open')
+parser.add_argument('--output', default='-',
+                    help='Where to write the JSON results (the default is stdout)')
+
+# How much the bulk senders write at once, and how much the sink reads at once
+CHUNK_SIZE = 256 * 1024
+
+# How long to wait for the service to start up, in seconds
+STARTUP_TIMEOUT = 10.0
+
+# How long a held connection has to answer before it is counted as refused
+HOLD_TIMEOUT = 5.0
+
+# How long to measure the service's CPU use for while connections are held
+IDLE_SAMPLE = 2.0
+
+# The header which tells the sink how many bytes are coming
+SIZE_FORMAT = '!Q'
+SIZE_LENGTH = struct.calcsize(SIZE_FORMAT)
+
+def free_port():
+    "Finds a TCP port on localhost which nothing is using (at the moment)"
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def raise_fd_limit(limit=None):
+    "Raises the limit on open file descriptors to the hard limit, or to limit"
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard if limit is None else limit, hard))
+
+def percentile(ordered, fraction):
+    "Gets a percentile out of a sorted list, using the nearest rank"
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))
+    return ordered[index]
+
+def run_backends(sink_port, echo_port, ready):
+    """
+    Runs the sink and echo servers on a single selector, until the process is
+    terminated. Each connection to the sink starts with the number of bytes
+    that are coming (as a SIZE_FORMAT), and once that many have arrived, the
+    sink replies with a single byte so that the sender knows. The forwarder
+    closes both sides of a connection once either side reaches EOF, so the
+    sender can't just shut down its side and wait for a reply.
+    """
+    selector = selectors.DefaultSelector()
+    buf = memoryview(bytearray(CHUNK_SIZE))
+
+    def listen(port, handler, make_state):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(('127.0.0.1', port))
+        server.listen(socket.SOMAXCONN)
+        server.setblocking(False)
+        selector.register(server, selectors.EVENT_READ, (accept, (handler, make_state)))
+
+    def accept(server, listener, events):
+        handler, make_state = listener
+        while True:
+            try:
+                conn, _ = server.accept()
+            except BlockingIOError:
+                return
+            conn.setblocking(False)
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            selector.register(conn, selectors.EVENT_READ, (handler, make_state()))
+
+    def close(conn):
+        selector.unregister(conn)
+        conn.close()
+
+    def sink(conn, state, events):
+        try:
+            size = conn.recv_into(buf)
+        except BlockingIOError:
+            return
+        except OSError:
+            size = 0
+
+        if not size:
+            close(conn)
+            return
+
+        # The state is [header, bytes still to come], where the count is None
+        # until all of the header has arrived
+        header, left = state
+        if left is None:
+            part = buf[:min(size, SIZE_LENGTH - len(header))]
+            header += part
+            size -= len(part)
+            if len(header) < SIZE_LENGTH:
+                return
+            left = struct.unpack(SIZE_FORMAT, header)[0]
+
+        left = state[1] = left - size
+        if not left:
+            try:
+                conn.send(b'k')
+            except OSError:
+                close(conn)
+
+    def echo(conn, outbuf, events):
+        if events & selectors.EVENT_READ:
+            try:
+                size = conn.recv_into(buf)
+            except BlockingIOError:
+                size = None
+            except OSError:
+                size = 0
+
+            if size == 0:
+                close(conn)
+                return
+            elif size:
+                outbuf += buf[:size]
+
+        if outbuf:
+            try:
+                sent = conn.send(outbuf)
+            except BlockingIOError:
+                sent = 0
+            except OSError:
+                close(conn)
+                return
+            del outbuf[:sent]
+
+        wanted = selectors.EVENT_READ | (selectors.EVENT_WRITE if outbuf else 0)
+        if selector.get_key(conn).events != wanted:
+            selector.modify(conn, wanted, (echo, outbuf))
+
+    listen(sink_port, sink, lambda: [bytearray(), None])
+    listen(echo_port, echo, bytearray)
+    ready.set()
+
+    while True:
+        for key, events in selector.select():
+            handler, state = key.data
+            handler(key.fileobj, state, events)
+
+class Service:
+    "A copy of proxy-service-sockets, which is run for the benchmark"
+    def __init__(self, engine, workers, fd_limit=None):
+        self._dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self._dir.name, 'control')
+        here = os.path.dirname(os.path.abspath(__file__))
+        self._process = subprocess.Popen(
+            [sys.executable, os.path.join(here, 'proxy-service-sockets.py'),
+             '--engine', engine, '--workers', str(workers),
+             '--control-socket', self.path, '--log-level', 'WARNING'],
+            cwd=here, preexec_fn=lambda: raise_fd_limit(fd_limit))
+
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while not os.path.exists(self.path):
+            if self._process.poll() is not None or time.monotonic() > deadline:
+                raise RuntimeError("The service didn't start")
+            time.sleep(0.05)
+
+    def request(self, msg):
+        "Sends a message to the service, returning its reply"
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            client.connect(self.path)
+            socketproto.write_message(client, msg)
+            if msg[0] != socketproto.Messages.Quit:
+                return socketproto.read_message(client)
+        finally:
+            client.close()
+
+    def add_mapping(self, src, dest, options):
+        if self.request((socketproto.Messages.AddProxy, (src, dest, options))) is not True:
+            raise RuntimeError("The service couldn't add a mapping onto {}:{}".format(*dest[:2]))
+
+    def del_mapping(self, src):
+        self.request((socketproto.Messages.DelProxy, src))
+
+    def alive(self):
+        return self._process.poll() is None
+
+    def _stats(self):
+        """
+        Yields the pid and the /proc/<pid>/stat fields (counting from the state)
+        of the service and each of its worker processes.
+        """
+        for pid in os.listdir('/proc'):
+            if not pid.isdigit():
+                continue
+
+            try:
+                with open('/proc/{}/stat'.format(pid)) as stat:
+                    # The command name is in parentheses, and can contain spaces
+                    fields = stat.read().rsplit(')', 1)[1].split()
+            except OSError:
+                continue
+
+            # The ppid is the second field
+            if int(pid) == self._process.pid or int(fields[1]) == self._process.pid:
+                yield pid, fields
+
+    def cpu_time(self):
+        """
+        Returns how many seconds of CPU the service and its worker processes
+        have used, between user and system time.
+        """
+        ticks = os.sysconf('SC_CLK_TCK')
+        # These are the utime and stime fields
+        return sum(int(fields[11]) + int(fields[12]) for _, fields in self._stats()) / ticks
+
+    def memory(self):
+        "Returns how many bytes of memory the service and its worker processes are using"
+        total = 0
+        for pid, _ in self._stats():
+            try:
+                with open('/proc/{}/statm'.format(pid)) as statm:
+                    total += int(statm.read().split()[1]) * resource.getpagesize()
+            except OSError:
+                pass
+        return total
+
+    def quit(self):
+        try:
+            self.request((socketproto.Messages.Quit, []))
+            self._process.wait(timeout=STARTUP_TIMEOUT)
+        except (OSError, subprocess.TimeoutExpired):
+            self._process.kill()
+            self._process.wait()
+        self._dir.cleanup()
+
+def run_threads(count, target):
+    """
+    Runs target(index) on count threads at once, and waits for them. If any of
+    them raised an exception, then the first one is raised again.
+    """
+    errors = []
+    def run(index):
+        try:
+            target(index)
+        except Exception as err:
+            errors.append(err)
+
+    threads = [threading.Thread(target=run, args=(index,), daemon=True)
+               for index in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+
+def bench_throughput(service, src, args):
+    share = args.bulk_bytes // args.bulk_connections
+    chunk = memoryview(bytes(CHUNK_SIZE))
+    conns = [socket.create_connection(src[:2]) for _ in range(args.bulk_connections)]
+
+    def send(index):
+        conn = conns[index]
+        conn.sendall(struct.pack(SIZE_FORMAT, share))
+        left = share
+        while left:
+            sent = conn.send(chunk[:min(left, CHUNK_SIZE)])
+            left -= sent
+        if conn.recv(1) != b'k':
+            raise RuntimeError("The sink didn't get everything")
+        conn.close()
+
+    cpu_before = service.cpu_time()
+    start = time.monotonic()
+    run_threads(len(conns), send)
+    elapsed = time.monotonic() - start
+    cpu = service.cpu_time() - cpu_before
+
+    total = share * len(conns)
+    return {
+        'bytes': total,
+        'connections': len(conns),
+        'seconds': round(elapsed, 3),
+        'mb_per_second': round(total / elapsed / 1e6, 1),
+        'cpu_seconds': round(cpu, 3),
+        'cpu_seconds_per_gb': round(cpu / (total / 1e9), 3),
+    }
+
+def ping(src, connections, requests, size):
+    """
+    Sends requests through several connections to the echo server at once,
+    one at a time on each. Returns the sorted round trip times, and how long
+    it took altogether.
+    """
+    message = b'x' * size
+    timings = [[] for _ in range(connections)]
+
+    def run(index):
+        conn = socket.create_connection(src[:2])
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        record = timings[index].append
+        for _ in range(requests):
+            start = time.perf_counter()
+            conn.sendall(message)
+            got = 0
+            while got < len(message):
+                data = conn.recv(len(message) - got)
+                if not data:
+                    raise RuntimeError("The echo server hung up")
+                got += len(data)
+            record(time.perf_counter() - start)
+        conn.close()
+
+    start = time.monotonic()
+    run_threads(connections, run)
+    elapsed = time.monotonic() - start
+    return sorted(timing for thread_timings in timings for timing in thread_timings), elapsed
+
+def to_ms(seconds):
+    return round(seconds * 1000, 3)
+
+def bench_latency(service, src, args):
+    cpu_before = service.cpu_time()
+    ordered, elapsed = ping(src, args.latency_connections, args.requests, args.request_size)
+    cpu = service.cpu_time() - cpu_before
+
+    return {
+        'requests': len(ordered),
+        'connections': args.latency_connections,
+        'request_size': args.request_size,
+        'requests_per_second': round(len(ordered) / elapsed, 1),
+        'p50_ms': to_ms(percentile(ordered, 0.50)),
+        'p90_ms': to_ms(percentile(ordered, 0.90)),
+        'p99_ms': to_ms(percentile(ordered, 0.99)),
+        'p999_ms': to_ms(percentile(ordered, 0.999)),
+        'max_ms': to_ms(ordered[-1]),
+        'cpu_seconds': round(cpu, 3),
+    }
+
+def bench_connect(service, src, args):
+    counts = [0] * args.connect_threads
+    failures = [0] * args.connect_threads
+    deadline = time.monotonic() + args.duration
+
+    def churn(index):
+        while time.monotonic() < deadline:
+            try:
+                conn = socket.create_connection(src[:2])
+                try:
+                    conn.sendall(b'c')
+                    if conn.recv(1) == b'c':
+                        counts[index] += 1
+                    else:
+                        failures[index] += 1
+                finally:
+                    conn.close()
+            except OSError:
+                failures[index] += 1
+
+    cpu_before = service.cpu_time()
+    start = time.monotonic()
+    run_threads(args.connect_threads, churn)
+    elapsed = time.monotonic() - start
+    cpu = service.cpu_time() - cpu_before
+
+    return {
+        'connections': sum(counts),
+        'failures': sum(failures),
+        'threads': args.connect_threads,
+        'seconds': round(elapsed, 3),
+        'connections_per_second': round(sum(counts) / elapsed, 1),
+        'cpu_seconds': round(cpu, 3),
+    }
+
+def hold_connections(src, count, control):
+    """
+    Opens count connections to the echo server and holds them open, in a
+    process of its own. Each one has to echo a byte back before it is counted
+    as being held. Once they are all open, (held, refused) is sent down the
+    control pipe, and they are closed again when anything is sent back.
+    """
+    held = []
+    refused = 0
+    for _ in range(count):
+        conn = None
+        try:
+            conn = socket.create_connection(src[:2], timeout=HOLD_TIMEOUT)
+            conn.sendall(b'h')
+            if conn.recv(1) != b'h':
+                raise ConnectionResetError
+            held.append(conn)
+        except OSError:
+            refused += 1
+            if conn is not None:
+                conn.close()
+
+    control.send((len(held), refused))
+    control.recv()
+    for conn in held:
+        conn.close()
+    control.send(None)
+
+def bench_hold(service, src, args):
+    probes = min(args.requests, 1000)
+    quiet, _ = ping(src, args.latency_connections, probes, args.request_size)
+    memory_before = service.memory()
+
+    context = multiprocessing.get_context('fork')
+    holders = []
+    start = time.monotonic()
+    for index in range(args.hold_processes):
+        count = args.hold_connections // args.hold_processes
+        if index < args.hold_connections % args.hold_processes:
+            count += 1
+        ours, theirs = context.Pipe()
+        process = context.Process(target=hold_connections, args=(src, count, theirs), daemon=True)
+        process.start()
+        holders.append((process, ours))
+
+    counts = [control.recv() for _, control in holders]
+    opening = time.monotonic() - start
+    held = sum(count for count, _ in counts)
+    refused = sum(count for _, count in counts)
+    memory_held = service.memory()
+
+    cpu_before = service.cpu_time()
+    time.sleep(IDLE_SAMPLE)
+    idle_cpu = service.cpu_time() - cpu_before
+
+    try:
+        busy, _ = ping(src, args.latency_connections, probes, args.request_size)
+    except (OSError, RuntimeError):
+        # Most likely the service is out of file descriptors
+        busy = None
+
+    for process, control in holders:
+        control.send(None)
+    for process, control in holders:
+        control.recv()
+        process.join()
+
+    # Whatever happened while the connections were held, the service should be
+    # able to carry on once they are gone
+    alive = service.alive()
+    try:
+        ping(src, 1, 1, args.request_size)
+        recovered = True
+    except (OSError, RuntimeError):
+        recovered = False
+
+    return {
+        'connections': args.hold_connections,
+        'held': held,
+        'refused': refused,
+        'processes': args.hold_processes,
+        'service_fd_limit': args.service_fd_limit,
+        'opened_per_second': round((held + refused) / opening, 1),
+        'memory_mb_before': round(memory_before / 1e6, 1),
+        'memory_mb_held': round(memory_held / 1e6, 1),
+        'memory_bytes_per_connection': round((memory_held - memory_before) / max(held, 1)),
+        'idle_cpu_percent': round(100 * idle_cpu / IDLE_SAMPLE, 1),
+        'p50_ms_quiet': to_ms(percentile(quiet, 0.50)),
+        'p99_ms_quiet': to_ms(percentile(quiet, 0.99)),
+        'p50_ms_held': to_ms(percentile(busy, 0.50)) if busy else None,
+        'p99_ms_held': to_ms(percentile(busy, 0.99)) if busy else None,
+        'service_alive': alive,
+        'recovered': recovered,
+    }
+
+SCENARIOS = {
+    'throughput': ('sink', bench_throughput),
+    'latency': ('echo', bench_latency),
+    'connect': ('echo', bench_connect),
+    'hold': ('echo', bench_hold),
+}
+
+def main():
+    args = parser.parse_args()
+    options = dict(option.split('=', 1) for option in args.option)
+    scenarios = args.scenario or ['throughput', 'latency', 'connect', 'hold']
+
+    # Every held connection takes a file descriptor in this process's
+    # children, and two (or more) in the service
+    raise_fd_limit()
+
+    backend_ports = {'sink': free_port(), 'echo': free_port()}
+    ready = multiprocessing.Event()
+    backends = multiprocessing.Process(
+        target=run_backends, args=(backend_ports['sink'], backend_ports['echo'], ready),
+        daemon=True)
+    backends.start()
+    ready.wait()
+
+    service = Service(args.engine, args.workers, args.service_fd_limit)
+    results = {}
+    try:
+        for name in scenarios:
+            backend, bench = SCENARIOS[name]
+            src = ('127.0.0.1', free_port(), socket.SOCK_STREAM)
+            dest = ('127.0.0.1', backend_ports[backend], socket.SOCK_STREAM)
+            service.add_mapping(src, dest, options)
+            try:
+                results[name] = bench(service, src, args)
+            finally:
+                service.del_mapping(src)
+            print('[{}] {}'.format(name, results[name]), file=sys.stderr)
+    finally:
+        service.quit()
+        backends.terminate()
+
+    report = {
+        'engine': args.engine,
+        'workers': args.workers,
+        'options': options,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'results': results,
+    }
+
+    if args.output == '-':
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+            output.write('\n')
+
+if __name__ == '__main__':
+    main()
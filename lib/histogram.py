@@ -0,0 +1,77 @@
+"""
+Histograms which are cheap enough to update on every pass of the event loop.
+
+Values are non-negative integers (microseconds, bytes, counts), and are
+counted in power-of-two buckets - bucket n holds the values whose bit length
+is n, so recording a value is a bit_length() and a list increment, and a
+histogram never takes up more than BUCKETS counters however much it sees.
+The price is that percentiles are only accurate to within a factor of two,
+which is plenty for seeing where the time goes.
+"""
+
+BUCKETS = 64
+
+def upper_bound(bucket):
+    "Returns the largest value which lands in a bucket"
+    return (1 << bucket) - 1
+
+class Histogram:
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value):
+        "Counts a single value"
+        self.counts[min(value.bit_length(), BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def snapshot(self):
+        """
+        Returns a copy of the histogram as a dictionary, with the count, sum
+        and max of its values, and an (upper_bound, count) pair for each bucket
+        which isn't empty.
+        """
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'max': self.max,
+            'buckets': [(upper_bound(bucket), count) for bucket, count in enumerate(self.counts)
+                        if count],
+        }
+
+def merge(snapshots):
+    "Combines several snapshots (say, one from each worker) into one"
+    buckets = {}
+    merged = {'count': 0, 'sum': 0, 'max': 0}
+    for snapshot in snapshots:
+        merged['count'] += snapshot['count']
+        merged['sum'] += snapshot['sum']
+        merged['max'] = max(merged['max'], snapshot['max'])
+        for bound, count in snapshot['buckets']:
+            buckets[bound] = buckets.get(bound, 0) + count
+
+    merged['buckets'] = sorted(buckets.items())
+    return merged
+
+def percentile(snapshot, fraction):
+    """
+    Returns the upper bound of the bucket which the given fraction (0 to 1) of
+    a snapshot's values fall at or below, or None if it is empty.
+    """
+    if not snapshot['count']:
+        return None
+
+    wanted = fraction * snapshot['count']
+    seen = 0
+    for bound, count in snapshot['buckets']:
+        seen += count
+        if seen >= wanted:
+            return min(bound, snapshot['max'])
+    return snapshot['max']
@@ -0,0 +1,142 @@
+"""
+Keeps the service's mappings on disk, so that they survive a restart.
+
+The journal is a file of JSON records, one per line, each of which is a change
+to the mappings - a mapping added or removed, or a destination added to or
+removed from one. Changes are only ever appended, so recording one costs a
+single write however many mappings there are. Replaying the journal gives the
+mappings it describes, which the service adds back in one batch when it
+starts.
+
+Since removals leave dead records behind, the journal is compacted now and
+then: it is rewritten as one record for each mapping (and each of its extra
+destinations), and swapped in for the old one with a rename so that a crash
+never leaves it half-written. A crash in the middle of an append can leave a
+partial last line, which is ignored when the journal is loaded.
+"""
+
+import json
+import logging
+import os
+
+logger = logging.getLogger('[' + __name__ + ']')
+
+# The journal is compacted once it has this many more records than the
+# mappings it describes need, and also more than COMPACT_RATIO times as many
+COMPACT_SLACK = 1024
+COMPACT_RATIO = 2
+
+class Journal:
+    def __init__(self, path):
+        self._path = path
+        self._file = None
+
+        # Each source portspec maps to [options, destinations], in the order in
+        # which they were added
+        self._mappings = {}
+        self._records = 0
+
+    def load(self):
+        """
+        Reads the journal (if there is one), and returns the mappings it
+        describes as a list of (src_portspec, dest_portspecs, options) - the
+        first of the destinations is the one which the mapping was added with.
+        """
+        self._mappings = {}
+        try:
+            with open(self._path, encoding='utf-8') as journal:
+                for line_num, line in enumerate(journal, 1):
+                    try:
+                        self._apply(json.loads(line))
+                    except (ValueError, KeyError, TypeError, IndexError):
+                        logger.warning("Ignoring Damaged Record On Line %i Of %s", line_num, self._path)
+        except FileNotFoundError:
+            pass
+
+        return [(src, list(dests), options) for src, (options, dests) in self._mappings.items()]
+
+    def _apply(self, record):
+        "Applies a single record to the mappings the journal describes"
+        op = record['op']
+        src = tuple(record['src'])
+        if op == 'add':
+            self._mappings[src] = [record['options'], [tuple(record['dest'])]]
+        elif op == 'del':
+            self._mappings.pop(src, None)
+        elif op == 'add-backend':
+            self._mappings[src][1].append(tuple(record['dest']))
+        elif op == 'del-backend':
+            self._mappings[src][1].remove(tuple(record['dest']))
+        else:
+            raise ValueError("Unknown journal record {}".format(op))
+
+    def _snapshot(self):
+        "Returns the records which describe the current mappings"
+        for src, (options, dests) in self._mappings.items():
+            yield {'op': 'add', 'src': src, 'dest': dests[0], 'options': options}
+            for dest in dests[1:]:
+                yield {'op': 'add-backend', 'src': src, 'dest': dest}
+
+    def compact(self):
+        """
+        Rewrites the journal with just enough records to describe the current
+        mappings, and opens it to have changes appended to it.
+        """
+        if self._file is not None:
+            self._file.close()
+
+        records = 0
+        temp_path = self._path + '.new'
+        with open(temp_path, 'w', encoding='utf-8') as journal:
+            for record in self._snapshot():
+                journal.write(json.dumps(record) + '\n')
+                records += 1
+            journal.flush()
+            os.fsync(journal.fileno())
+        os.replace(temp_path, self._path)
+
+        self._records = records
+        self._file = open(self._path, 'a', encoding='utf-8')
+
+    def reset(self, mappings):
+        """
+        Makes the journal describe exactly the given mappings, which are
+        (src_portspec, dest_portspecs, options) as load() returns them.
+        """
+        self._mappings = {tuple(src): [options, [tuple(dest) for dest in dests]]
+                          for src, dests, options in mappings}
+        self.compact()
+
+    def _write(self, records):
+        for record in records:
+            self._apply(record)
+            self._file.write(json.dumps(record) + '\n')
+            self._records += 1
+        self._file.flush()
+
+        needed = sum(len(dests) for _, dests in self._mappings.values())
+        if self._records > max(needed * COMPACT_RATIO, needed + COMPACT_SLACK):
+            logger.debug("Compacting %s ...", self._path)
+            self.compact()
+
+    def add(self, mappings):
+        "Records that (src_portspec, dest_portspec, options) mappings were added"
+        self._write({'op': 'add', 'src': src, 'dest': dest, 'options': options}
+                    for src, dest, options in mappings)
+
+    def remove(self, srcs):
+        "Records that the mappings on the given source portspecs were removed"
+        self._write({'op': 'del', 'src': src} for src in srcs)
+
+    def add_backend(self, src, dest):
+        "Records that a destination was added to a mapping"
+        self._write([{'op': 'add-backend', 'src': src, 'dest': dest}])
+
+    def del_backend(self, src, dest):
+        "Records that a destination was removed from a mapping"
+        self._write([{'op': 'del-backend', 'src': src, 'dest': dest}])
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
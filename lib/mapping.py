@@ -0,0 +1,301 @@
+"""
+Definitions shared by all of the forwarding engines - portspecs, the options
+which can be given to each mapping, and how those options are applied to the
+mapping's sockets.
+
+A portspec is a (host, port, protocol) tuple, where the protocol is one of the
+socket module's SOCK_STREAM or SOCK_DGRAM constants.
+"""
+
+import socket
+
+class Protocol:
+    "Various useful constants and maps related to TCP and UDP"
+    (TCP, UDP) = (socket.SOCK_STREAM, socket.SOCK_DGRAM)
+    ToString = {
+         socket.SOCK_STREAM: 'TCP',
+         socket.SOCK_DGRAM: 'UDP',
+    }
+    FromString = {
+        'TCP': socket.SOCK_STREAM,
+        'UDP': socket.SOCK_DGRAM
+    }
+
+class Address:
+    "Constants to address information in portspec tuples"
+    (HOST, PORT, PROTOCOL) = list(range(3))
+    HOST_AND_PORT = -1
+
+class Relay:
+    "The ways in which a TCP -> TCP mapping can move data between its sockets"
+    (COPY, SPLICE) = ('copy', 'splice')
+    ALL = (COPY, SPLICE)
+
+class Balance:
+    "The ways in which a mapping can pick which of its destinations to use"
+    (ROUND_ROBIN, LEAST_CONN, HASH) = ('roundrobin', 'leastconn', 'hash')
+    ALL = (ROUND_ROBIN, LEAST_CONN, HASH)
+
+# Once more than HIGH_WATERMARK bytes are waiting to be written to a socket,
+# its peer isn't read from until the backlog drops below LOW_WATERMARK. This
+# keeps a fast sender from filling up memory when the receiver is slow.
+HIGH_WATERMARK = 256 * 1024
+LOW_WATERMARK = 64 * 1024
+
+# Why a mapping in an atomic batch (see add_mappings) wasn't applied, when it
+# was fine but another mapping in the batch wasn't
+BATCH_ABORTED = "Not applied, since another mapping in the batch failed"
+
+def settle_batch(errors, atomic):
+    """
+    Takes the errors of a batch (None for each item which is fine), and
+    returns them as they should be reported - if the batch is atomic and
+    anything failed, then every item which was fine gets a BATCH_ABORTED
+    error instead.
+    """
+    if atomic and any(errors):
+        return [err or ValueError(BATCH_ABORTED) for err in errors]
+    return errors
+
+def check_removals(src_portspecs, mapped, atomic):
+    """
+    Checks a batch of mappings to remove against the source portspecs which
+    are mapped. Returns None for each mapping which should be removed, and a
+    KeyError for each which isn't mapped (or was already given earlier in the
+    batch), settled as settle_batch does.
+    """
+    errors = []
+    seen = set()
+    for src_portspec in src_portspecs:
+        if src_portspec in mapped and src_portspec not in seen:
+            errors.append(None)
+        else:
+            errors.append(KeyError(src_portspec))
+        seen.add(src_portspec)
+    return settle_batch(errors, atomic)
+
+# The options that every mapping starts out with, which add_mapping can
+# override on a per-mapping basis
+DEFAULT_OPTIONS = {
+    'relay': Relay.COPY,
+    # How new connections are spread over the destinations of a mapping, when
+    # it has more than one
+    'balance': Balance.ROUND_ROBIN,
+    # How many seconds an outbound connection can take before it is abandoned
+    'connect_timeout': 10.0,
+    # How many seconds a TCP connection can go without any data moving before
+    # it is closed, or 0 to keep idle connections open forever
+    'idle_timeout': 0.0,
+    # How many seconds a TCP connection can stay open, or 0 for no limit
+    'max_lifetime': 0.0,
+    # How many connections can wait to be accepted by a TCP mapping, which
+    # the kernel caps at net.core.somaxconn
+    'backlog': socket.SOMAXCONN,
+    # Whether to bind with SO_REUSEPORT, so that several processes can each
+    # have their own listener on the same port
+    'reuseport': False,
+    # How many connections to keep open to each destination ahead of time, so
+    # that new TCP connections don't have to wait for them to connect
+    'warm_pool': 0,
+    # How large of a buffer to read into, for connections which copy
+    'buffer_size': 65536,
+    # How many seconds a UDP client can be silent before its session is closed
+    'udp_idle_timeout': 60.0,
+    # How many UDP clients can have sessions at the same time
+    'udp_max_sessions': 1024,
+    # How many bytes per second all of a TCP mapping's connections can move
+    # between them, and how many each connection can move on its own, where 0
+    # means that there is no limit
+    'rate_limit': 0,
+    'conn_rate_limit': 0,
+    # How many bytes a connection can move at once after it has been quiet for
+    # a while, or 0 to use a tenth of a second's worth
+    'rate_burst': 0,
+
+    # The rest are socket options, which leave the kernel's defaults alone
+    # when they are 0 (or False). TCP_NODELAY turns off Nagle's algorithm, for
+    # connections which send lots of small messages that shouldn't wait.
+    'nodelay': False,
+    # SO_RCVBUF and SO_SNDBUF, in bytes
+    'rcvbuf': 0,
+    'sndbuf': 0,
+    # SO_KEEPALIVE, along with TCP_KEEPIDLE, TCP_KEEPINTVL (both in seconds)
+    # and TCP_KEEPCNT
+    'keepalive': False,
+    'keepidle': 0,
+    'keepintvl': 0,
+    'keepcnt': 0,
+    # TCP_QUICKACK, set when each connection is set up - the kernel can turn
+    # delayed ACKs back on later
+    'quickack': False,
+    # The length of the TCP_FASTOPEN queue on the listening socket
+    'fastopen': 0,
+    # The IP_TOS byte of outgoing packets (a DSCP value shifted left by 2)
+    'tos': 0,
+}
+
+# Map: option -> (level, name) of the socket options which a setting needs,
+# for checking that the platform has them
+SOCKET_OPTIONS = {
+    'reuseport': ('SOL_SOCKET', 'SO_REUSEPORT'),
+    'nodelay': ('IPPROTO_TCP', 'TCP_NODELAY'),
+    'keepidle': ('IPPROTO_TCP', 'TCP_KEEPIDLE'),
+    'keepintvl': ('IPPROTO_TCP', 'TCP_KEEPINTVL'),
+    'keepcnt': ('IPPROTO_TCP', 'TCP_KEEPCNT'),
+    'quickack': ('IPPROTO_TCP', 'TCP_QUICKACK'),
+    'fastopen': ('IPPROTO_TCP', 'TCP_FASTOPEN'),
+    'tos': ('IPPROTO_IP', 'IP_TOS'),
+}
+
+def parse_bool(value):
+    """
+    Converts an option into a boolean - strings (as they come from the control
+    tools) are read as words, since bool('false') is True.
+    """
+    if not isinstance(value, str):
+        return bool(value)
+    elif value.lower() in ('1', 'true', 'yes', 'on'):
+        return True
+    elif value.lower() in ('0', 'false', 'no', 'off'):
+        return False
+    else:
+        raise ValueError("{} is not a valid boolean".format(value))
+
+def parse_int(value):
+    "Converts an option into an integer, allowing strings like 0x10"
+    return int(value, 0) if isinstance(value, str) else int(value)
+
+def parse_options(options):
+    """
+    Merges a dictionary of per-mapping options with the defaults, raising a
+    ValueError if any of them are invalid.
+    """
+    merged = dict(DEFAULT_OPTIONS)
+    for key, value in (options or {}).items():
+        if key not in DEFAULT_OPTIONS:
+            raise ValueError("{} is not a valid mapping option".format(key))
+        merged[key] = value
+
+    if merged['relay'] not in Relay.ALL:
+        raise ValueError("{} is not a valid relay mode".format(merged['relay']))
+
+    if merged['balance'] not in Balance.ALL:
+        raise ValueError("{} is not a valid balancing strategy".format(merged['balance']))
+
+    merged['connect_timeout'] = float(merged['connect_timeout'])
+    if merged['connect_timeout'] <= 0:
+        raise ValueError("connect_timeout must be positive")
+
+    for key in ('idle_timeout', 'max_lifetime'):
+        merged[key] = float(merged[key])
+        if merged[key] < 0:
+            raise ValueError("{} can't be negative".format(key))
+
+    merged['backlog'] = int(merged['backlog'])
+    if merged['backlog'] <= 0:
+        raise ValueError("backlog must be positive")
+
+    merged['buffer_size'] = int(merged['buffer_size'])
+    if merged['buffer_size'] <= 0:
+        raise ValueError("buffer_size must be positive")
+
+    merged['warm_pool'] = int(merged['warm_pool'])
+    if merged['warm_pool'] < 0:
+        raise ValueError("warm_pool can't be negative")
+
+    merged['udp_idle_timeout'] = float(merged['udp_idle_timeout'])
+    if merged['udp_idle_timeout'] <= 0:
+        raise ValueError("udp_idle_timeout must be positive")
+
+    merged['udp_max_sessions'] = int(merged['udp_max_sessions'])
+    if merged['udp_max_sessions'] <= 0:
+        raise ValueError("udp_max_sessions must be positive")
+
+    for key in ('reuseport', 'nodelay', 'keepalive', 'quickack'):
+        merged[key] = parse_bool(merged[key])
+
+    for key in ('rate_limit', 'conn_rate_limit', 'rate_burst', 'rcvbuf', 'sndbuf',
+                'keepidle', 'keepintvl', 'keepcnt', 'fastopen'):
+        merged[key] = parse_int(merged[key])
+        if merged[key] < 0:
+            raise ValueError("{} can't be negative".format(key))
+
+    merged['tos'] = parse_int(merged['tos'])
+    if not 0 <= merged['tos'] <= 255:
+        raise ValueError("tos must be between 0 and 255")
+
+    for key, (_, name) in SOCKET_OPTIONS.items():
+        if merged[key] and not hasattr(socket, name):
+            raise ValueError("{} is not supported on this platform".format(name))
+    return merged
+
+def format_options(options):
+    """
+    Converts the options of a mapping which aren't the defaults into strings,
+    which is how they are shown to (and given by) the control tools.
+    """
+    formatted = {}
+    for key, value in options.items():
+        if value == DEFAULT_OPTIONS[key]:
+            continue
+        elif isinstance(value, bool):
+            formatted[key] = 'true' if value else 'false'
+        else:
+            formatted[key] = str(value)
+    return formatted
+
+def _setsockopt(sock, key, value):
+    level, name = SOCKET_OPTIONS[key]
+    sock.setsockopt(getattr(socket, level), getattr(socket, name), value)
+
+def tune_socket(sock, options):
+    """
+    Applies a mapping's socket options to one of its sockets. This has to be
+    done before the socket connects, since the buffer sizes decide what window
+    scaling is negotiated.
+    """
+    if options['rcvbuf']:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, options['rcvbuf'])
+    if options['sndbuf']:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, options['sndbuf'])
+    if options['tos']:
+        _setsockopt(sock, 'tos', options['tos'])
+
+    if sock.type != socket.SOCK_STREAM:
+        return
+
+    if options['nodelay']:
+        _setsockopt(sock, 'nodelay', 1)
+    if options['quickack']:
+        _setsockopt(sock, 'quickack', 1)
+    if options['keepalive']:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for key in ('keepidle', 'keepintvl', 'keepcnt'):
+            if options[key]:
+                _setsockopt(sock, key, options[key])
+
+def tune_listener(sock, options):
+    "Applies a mapping's socket options to its listening socket, before it binds"
+    if options['reuseport']:
+        _setsockopt(sock, 'reuseport', 1)
+    tune_socket(sock, options)
+    if options['fastopen'] and sock.type == socket.SOCK_STREAM:
+        _setsockopt(sock, 'fastopen', options['fastopen'])
+
+def check_portspec(portspec):
+    """
+    Raises a ValueError if a portspec (which may have come off the wire) can't
+    be bound or connected to.
+    """
+    (host, port, proto) = portspec
+    if not isinstance(host, str):
+        raise ValueError("{!r} is not a valid host".format(host))
+    if not isinstance(port, int) or not 0 <= port <= 65535:
+        raise ValueError("{!r} is not a valid port".format(port))
+    if proto not in Protocol.ToString:
+        raise ValueError("{!r} is not a valid protocol".format(proto))
+
+def format_address(portspec):
+    "Formats a portspec address into a string"
+    (host, port, proto) = portspec
+    return "{}:{} ({})".format(host, port, Protocol.ToString[proto])
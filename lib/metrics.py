@@ -0,0 +1,113 @@
+"""
+Writes metrics out in the Prometheus text exposition format.
+
+Metrics are grouped into families, each of which has a name, a type and some
+help text, and holds one sample for each set of labels (say, one for each
+mapping). An Exposition writes the families out one at a time, and its text is
+what a scraper gets back from the /metrics endpoint.
+
+Histograms are the ones kept by the histogram module, which count values in
+power-of-two buckets - these are written out as the cumulative buckets that
+Prometheus expects, with their bounds scaled into the family's unit.
+"""
+
+import os
+import resource
+import time
+
+import histogram
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# When this process started, as far as anything scraping it is concerned
+START_TIME = time.time()
+
+def escape(value):
+    "Escapes a label value"
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, escape(value))
+                          for key, value in sorted(labels.items())) + '}'
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+class Exposition:
+    def __init__(self):
+        self._lines = []
+
+    def _family(self, name, kind, help):
+        self._lines.append('# HELP {} {}'.format(name, help))
+        self._lines.append('# TYPE {} {}'.format(name, kind))
+
+    def _sample(self, name, labels, value):
+        self._lines.append('{}{} {}'.format(name, format_labels(labels), format_value(value)))
+
+    def counter(self, name, help, samples):
+        "Writes a family of counters, from (labels, value) pairs"
+        self._family(name, 'counter', help)
+        for labels, value in samples:
+            self._sample(name, labels, value)
+
+    def gauge(self, name, help, samples):
+        "Writes a family of gauges, from (labels, value) pairs"
+        self._family(name, 'gauge', help)
+        for labels, value in samples:
+            self._sample(name, labels, value)
+
+    def histogram(self, name, help, samples, scale=1, buckets=range(histogram.BUCKETS)):
+        """
+        Writes a family of histograms, from (labels, snapshot) pairs. Every
+        value is multiplied by scale, and the same buckets are written out for
+        every sample - Prometheus can only aggregate histograms whose buckets
+        line up.
+        """
+        self._family(name, 'histogram', help)
+        for labels, snapshot in samples:
+            counts = dict(snapshot['buckets'])
+            seen = sum(count for bound, count in snapshot['buckets']
+                       if bound < histogram.upper_bound(buckets[0]))
+            for bucket in buckets:
+                bound = histogram.upper_bound(bucket)
+                seen += counts.get(bound, 0)
+                self._sample(name + '_bucket', dict(labels, le=format_value(float(bound * scale))), seen)
+
+            self._sample(name + '_bucket', dict(labels, le='+Inf'), snapshot['count'])
+            self._sample(name + '_sum', labels, float(snapshot['sum'] * scale))
+            self._sample(name + '_count', labels, snapshot['count'])
+
+    def process(self):
+        "Writes the standard process_* metrics, about this process's resource usage"
+        times = os.times()
+        self.counter('process_cpu_seconds_total', 'Total user and system CPU time spent in seconds.',
+                     [({}, times.user + times.system)])
+
+        try:
+            with open('/proc/self/statm') as statm:
+                pages = [int(field) for field in statm.read().split()]
+            self.gauge('process_virtual_memory_bytes', 'Virtual memory size in bytes.',
+                       [({}, pages[0] * resource.getpagesize())])
+            self.gauge('process_resident_memory_bytes', 'Resident memory size in bytes.',
+                       [({}, pages[1] * resource.getpagesize())])
+        except OSError:
+            pass
+
+        try:
+            self.gauge('process_open_fds', 'Number of open file descriptors.',
+                       [({}, len(os.listdir('/proc/self/fd')))])
+        except OSError:
+            pass
+
+        self.gauge('process_max_fds', 'Maximum number of open file descriptors.',
+                   [({}, resource.getrlimit(resource.RLIMIT_NOFILE)[0])])
+        self.gauge('process_start_time_seconds', 'Start time of the process since unix epoch in seconds.',
+                   [({}, START_TIME)])
+
+    def getvalue(self):
+        "Returns everything written so far, encoded as a response body"
+        return ('\n'.join(self._lines) + '\n').encode('utf-8')
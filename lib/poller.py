@@ -3,35 +3,148 @@ A wrapper around both epoll and select.
 
 This allows for the superior performance of epoll without making this tool
 Linux specific
+
+Every registration carries a handler, which poll() hands back along with the
+events that happened - that way, the caller can dispatch straight to whatever
+owns the file descriptor rather than having to look it up.
 """
 
+import os
 import select
 import sys
 
+def _to_fd(fd):
+    "Accepts either a file descriptor or an object with a fileno() method"
+    return fd if isinstance(fd, int) else fd.fileno()
+
 if sys.platform == 'linux':
+    # The events that a file descriptor can be watched for. HANGUP and ERROR
+    # are always reported by epoll, whether or not they were asked for (except
+    # for the peer shutting down its write side, which needs EPOLLRDHUP), and
+    # EDGE makes the registration edge-triggered.
+    (READ, WRITE) = (select.EPOLLIN, select.EPOLLOUT)
+    HANGUP = select.EPOLLHUP | select.EPOLLRDHUP
+    ERROR = select.EPOLLERR
+    EDGE = select.EPOLLET
+
     class Poller:
         def __init__(self):
             self.poller = select.epoll()
+            self.handlers = {}
+
+        def register(self, fd, events=READ, handler=None):
+            """
+            Starts watching a file descriptor. The handler is what poll()
+            returns for it, which is the file descriptor itself if no handler
+            is given.
+            """
+            fd = _to_fd(fd)
+            self.poller.register(fd, events)
+            self.handlers[fd] = fd if handler is None else handler
+
+        def modify(self, fd, events, handler=None):
+            "Changes the events (and possibly the handler) of a file descriptor"
+            fd = _to_fd(fd)
+            self.poller.modify(fd, events)
+            if handler is not None:
+                self.handlers[fd] = handler
 
-        def register(self, fd):
-            self.poller.register(fd, select.EPOLLIN)
-        
         def unregister(self, fd):
+            fd = _to_fd(fd)
             self.poller.unregister(fd)
+            del self.handlers[fd]
 
         def poll(self, timeout):
-            return [ fd_event[0] for fd_event in self.poller.poll(timeout=timeout) ]
+            """
+            Returns a list of (handler, events) pairs, where events is a
+            bitmask of READ, WRITE, HANGUP and ERROR.
+            """
+            handlers = self.handlers
+            return [(handlers[fd], events)
+                    for fd, events in self.poller.poll(timeout=timeout)]
 else:
+    # select can't report hangups or errors on their own - they show up as
+    # the file descriptor being readable. It also can't do edge triggering,
+    # which is harmless, since callers using EDGE have to be able to cope
+    # with being told about the same event twice anyway.
+    (READ, WRITE, HANGUP, ERROR, EDGE) = (1, 4, 16, 8, 1 << 31)
+
     class Poller:
         def __init__(self):
-            self.watchers = []
+            self.watchers = {}
+
+        def register(self, fd, events=READ, handler=None):
+            fd = _to_fd(fd)
+            self.watchers[fd] = (events, fd if handler is None else handler)
 
-        def register(self, fd):
-            self.watchers.append(fd)
+        def modify(self, fd, events, handler=None):
+            fd = _to_fd(fd)
+            _, old_handler = self.watchers[fd]
+            self.watchers[fd] = (events, old_handler if handler is None else handler)
 
         def unregister(self, fd):
-            self.watchers.remove(fd)
+            del self.watchers[_to_fd(fd)]
 
         def poll(self, timeout):
-            (readers, _, _) = select.select(self.watchers, [], [], timeout)
-            return readers
+            readers = [fd for fd, (events, _) in self.watchers.items() if events & READ]
+            writers = [fd for fd, (events, _) in self.watchers.items() if events & WRITE]
+            (readable, writable, _) = select.select(readers, writers, [], timeout)
+
+            ready = {}
+            for fd in readable:
+                ready[fd] = READ
+            for fd in writable:
+                ready[fd] = ready.get(fd, 0) | WRITE
+            return [(self.watchers[fd][1], events) for fd, events in ready.items()]
+
+if hasattr(os, 'eventfd'):
+    class Waker:
+        """
+        Something which another thread can use to wake up a thread that is
+        blocked in poll() - register it for READ, and clear it when it fires.
+        """
+        def __init__(self):
+            self._fd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+
+        def fileno(self):
+            return self._fd
+
+        def wake(self):
+            os.eventfd_write(self._fd, 1)
+
+        def clear(self):
+            try:
+                os.eventfd_read(self._fd)
+            except BlockingIOError:
+                pass
+
+        def close(self):
+            os.close(self._fd)
+else:
+    class Waker:
+        "Like the eventfd version, but using a pipe where eventfd isn't available"
+        def __init__(self):
+            self._read_fd, self._write_fd = os.pipe()
+            os.set_blocking(self._read_fd, False)
+            os.set_blocking(self._write_fd, False)
+
+        def fileno(self):
+            return self._read_fd
+
+        def wake(self):
+            try:
+                os.write(self._write_fd, b'\0')
+            except BlockingIOError:
+                # The pipe is full, so the other side is going to wake up anyway
+                pass
+
+        def clear(self):
+            try:
+                while os.read(self._read_fd, 4096):
+                    pass
+            except BlockingIOError:
+                pass
+
+        def close(self):
+            os.close(self._read_fd)
+            os.close(self._write_fd)
@@ -1,275 +1,2067 @@
+import collections
+import concurrent.futures
+import errno
+import functools
 import logging
+import os
 import socket
+import struct
 import threading
+import time
 
+import balancer
+import histogram
+import metrics
 import poller
+import resolver
+import timerwheel
+import tokenbucket
+from mapping import (Protocol, Address, Relay, HIGH_WATERMARK, LOW_WATERMARK,
+                     parse_options, check_portspec, settle_batch, check_removals,
+                     format_address, tune_socket, tune_listener)
 
 logger = logging.getLogger('[' + __name__ + ']')
 
-class Protocol:
-    "Various useful constants and maps related to TCP and UDP"
-    (TCP, UDP) = (socket.SOCK_STREAM, socket.SOCK_DGRAM)
-    ToString = {
-         socket.SOCK_STREAM: 'TCP',
-         socket.SOCK_DGRAM: 'UDP',
-    }
-    FromString = {
-        'TCP': socket.SOCK_STREAM,
-        'UDP': socket.SOCK_DGRAM
-    }
+# os.splice only exists on Linux, and only from Python 3.10 onwards
+HAS_SPLICE = hasattr(os, 'splice')
+
+# How much data to move through a splice pipe at once - this is the default
+# capacity of a Linux pipe
+SPLICE_CHUNK = 65536
+
+# How many bytes a UDP socket can move each time it is readable, before giving
+# other sockets a turn
+EVENT_BUDGET = 256 * 1024
+
+# How many bytes the sockets which are ready can move between them in one pass
+# of the event loop. Each socket gets an equal share (its quantum), though never
+# less than FAIR_QUANTUM. Anything more is left in the socket, and since the
+# poller is level-triggered, it is reported again on the next pass - after
+# every other socket which was ready has had its turn. This keeps one bulk
+# transfer from holding up the small, latency-sensitive messages of other
+# connections, without slowing it down when it has the loop to itself.
+PASS_BUDGET = 1024 * 1024
+FAIR_QUANTUM = 64 * 1024
+
+# How many seconds of traffic a rate limit's bucket can save up, when the
+# mapping doesn't give a burst size of its own
+DEFAULT_BURST_TIME = 0.1
+
+# How many connections a TCP server accepts each time it is readable, before
+# giving other sockets a turn
+ACCEPT_BUDGET = 64
+
+# The largest datagram that a UDP socket can receive
+DATAGRAM_SIZE = 65536
+
+# How many datagrams a UDP session holds onto while its destination is being
+# looked up - any more than this are dropped
+UDP_LOOKUP_QUEUE = 16
+
+# Where the fields that accept_queue() needs are in a Linux struct tcp_info,
+# and how much of it to ask for
+TCP_INFO_UNACKED = 24
+TCP_INFO_SIZE = 32
+
+# How many seconds to wait before trying to fill a warm pool again, after one
+# of its connections failed or was closed by the destination
+WARM_RETRY_DELAY = 1.0
+
+# How many seconds a TCP server stops accepting for, when it has run out of
+# file descriptors and can't even shed connections (see shed_connection)
+ACCEPT_RETRY_DELAY = 1.0
+
+# The errors which mean that there aren't any file descriptors left, either in
+# this process or in the whole system
+OUT_OF_FDS = (errno.EMFILE, errno.ENFILE)
+
+# How long a client of the metrics endpoint gets to send its request and read
+# the response, in seconds, and how big its request can be
+METRICS_TIMEOUT = 5.0
+METRICS_REQUEST_SIZE = 8192
 
-class Address:
-    "Constants to address information in portspec tuples"
-    (HOST, PORT, PROTOCOL) = list(range(3))
-    HOST_AND_PORT = -1
+# Which of the histogram module's buckets connect latencies are exported with
+# - they're in microseconds, so this runs from 15us up to about 33s
+CONNECT_LATENCY_BUCKETS = range(4, 26)
 
-def format_address(portspec):
-    "Formats a portspec address into a string"
-    (host, port, proto) = portspec
-    return "{}:{} ({})".format(host, port, Protocol.ToString[proto])
+# How often, in seconds, a timer is scheduled to measure how late the event
+# loop runs things while it is being profiled (see set_profiling)
+LAG_PROBE_INTERVAL = 0.1
 
-def make_server(proto, src, dest):
+def make_server(proto, src, dest, options):
     if proto == Protocol.TCP:
-        return TCPServer(src, dest)
+        return TCPServer(src, dest, options)
+    elif dest[Address.PROTOCOL] == Protocol.UDP:
+        return UDPServer(src, dest, options)
     else:
-        logging.error("The UDP -> * implementation is really flaky right now. Best not to use it.")
-        raise NotImplementedError()
+        raise ValueError("UDP can only be forwarded onto UDP")
+
+class UDPSession:
+    """
+    The upstream half of a UDP 'connection' - each client gets its own socket
+    connected to one of the destinations, so that replies can be sent back to
+    the right client.
+
+    The socket can't be connected until the destination has been looked up, so
+    until then, the datagrams that the client sends are held onto.
+    """
+    def __init__(self, server, client_addr, dest):
+        self._server = server
+        self._client_addr = client_addr
+        self._dest = dest
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setblocking(0)
+        tune_socket(self._socket, server._options)
+        self._timer = None
+        self._waiting = []
+        self._closed = False
+        self.last_active = loop_time
+
+    def setup(self):
+        "Starts looking up the destination, which the socket is connected to"
+        self._timer = timers.schedule(
+            loop_time + self._server._options['udp_idle_timeout'], self.check_idle)
+        dns.resolve(self._dest[Address.HOST], self.connect)
+
+    def connect(self, address, error):
+        "Connects the upstream socket once the destination's address is known"
+        if self._closed:
+            return
+
+        if error is None:
+            try:
+                self._socket.connect((address, self._dest[Address.PORT]))
+            except socket.error as err:
+                error = err
+
+        if error is not None:
+            logger.error("UDP: Unable To Connect To %s Because '%s'",
+                         format_address(self._dest), error)
+            self._server.close_session(self._client_addr)
+            return
+
+        poll.register(self._socket, poller.READ, self.handle)
+        logger.debug("UDP: Opened Session %i For (%s, %i)",
+                     self._socket.fileno(), *self._client_addr)
+
+        waiting, self._waiting = self._waiting, None
+        for data in waiting:
+            self.send(data)
+
+    def close(self):
+        logger.debug("UDP: Closing Session %i For (%s, %i)",
+                     self._socket.fileno(), *self._client_addr)
+        self._closed = True
+        self._timer.cancel()
+        if self._waiting is None:
+            poll.unregister(self._socket)
+        self._socket.close()
+        self._server._balancer.release(self._dest)
+
+    def check_idle(self):
+        """
+        Closes the session if the client has been quiet for too long, or
+        checks again later if it hasn't.
+        """
+        deadline = self.last_active + self._server._options['udp_idle_timeout']
+        if deadline <= loop_time:
+            self._server.close_session(self._client_addr)
+        else:
+            self._timer = timers.schedule(deadline, self.check_idle)
+
+    def send(self, data):
+        "Sends a datagram from the client to the destination"
+        self.last_active = loop_time
+        if self._waiting is not None:
+            if len(self._waiting) < UDP_LOOKUP_QUEUE:
+                # The datagram is most likely in a shared receive buffer
+                self._waiting.append(bytes(data))
+            return
+
+        try:
+            self._socket.send(data)
+        except socket.error as err:
+            # Datagrams are allowed to be lost, so there's no reason to queue
+            # anything up
+            logger.debug("UDP: Dropped Datagram To %s Because '%s'",
+                         format_address(self._dest), err)
+
+    def handle(self, events):
+        "Relays all of the datagrams waiting from the destination to the client"
+        self.last_active = loop_time
+        server_socket = self._server._socket
+        buf = recv_buffer(DATAGRAM_SIZE)
+        budget = EVENT_BUDGET
+        try:
+            while budget > 0:
+                try:
+                    size = self._socket.recv_into(buf)
+                except BlockingIOError:
+                    return
+                except socket.error as err:
+                    # Most likely an ICMP error from an earlier datagram
+                    logger.debug("UDP: Session Encountered Error '%s'", err)
+                    return
+
+                budget -= size
+                try:
+                    server_socket.sendto(buf[:size], self._client_addr)
+                except socket.error as err:
+                    logger.debug("UDP: Dropped Datagram To (%s, %i) Because '%s'",
+                                 self._client_addr[0], self._client_addr[1], err)
+        finally:
+            self._server._received[BRIDGE] += EVENT_BUDGET - budget
 
 class UDPServer:
-    "A wrapper for the functions of the UDP server socket"
-    def __init__(self, src, dest):
+    """
+    A wrapper for the functions of the UDP server socket.
+
+    UDP makes this exercise a little strange, because UDP is connectionless,
+    and so there is nothing which says when a client is done. The server keeps
+    a table of sessions, one per client address, which are closed when they
+    have been idle for longer than the udp_idle_timeout option.
+    """
+    def __init__(self, src, dest, options):
         self._src = src
-        self._dest = dest
-        self._server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self._bridge = None
+        self._dest_proto = dest[Address.PROTOCOL]
+        self._balancer = balancer.make_balancer(options['balance'], [dest])
+        self._options = options
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+        # Map: client_address -> UDPSession
+        self._sessions = {}
+
+        # How many bytes have been received from clients and from destinations,
+        # indexed by INBOUND and BRIDGE
+        self._received = [0, 0]
 
     def __str__(self):
-        return "{} -> {}".format(format_address(self._src), format_address(self._dest))
+        return "{} -> {}".format(format_address(self._src),
+                                 ', '.join(map(format_address, self._balancer.backends)))
 
     def setup(self):
         "Binds the socket and registers it"
-        self._server.setblocking(0)
-        self._server.bind(self._src[:Address.HOST_AND_PORT])
-        poll.register(self._server)
+        self._socket.setblocking(0)
+        tune_listener(self._socket, self._options)
+        self._socket.bind(self._src[:Address.HOST_AND_PORT])
+        poll.register(self._socket, poller.READ, self.handle)
 
         src_to_svr[self._src] = self
-        fd_to_svr[self._server.fileno()] = self
 
         logger.debug("UDP: Created Server %s", self)
 
     def destroy(self):
-        "Stops listening on this server socket"
+        "Stops listening on this server socket, and closes all its sessions"
         logger.debug("UDP: Destroying %s", self)
         del src_to_svr[self._src]
-        del fd_to_svr[self._server.fileno()]
-        
-        if self._bridge:
-            self._bridge.close()
 
-        poll.unregister(self._server)
-        self._server.close()
+        for session in self._sessions.values():
+            session.close()
+        self._sessions.clear()
+
+        poll.unregister(self._socket)
+        self._socket.close()
+
+    def handle(self, events):
+        "Handles datagrams waiting on the server socket"
+        self.connect()
 
     def connect(self):
         """
-        UDP makes this exercise a little strange, because UDP is connectionless 
-        and the only 'connection' actually occurs when a packet is being sent to 
-        this socket.
-
-        So, the UDP server has to keep around a socket which will be open or 
-        closed depending upon whether or not it is needed. It is closed when 
-        the socket recieves a datagram of length 0; even though this is a 
-        valid datagram, it seems sensible enough to use  an empty packet as 
-        a terminating mark.
+        Relays all of the datagrams waiting on the server socket to the
+        sessions of the clients that sent them, opening new sessions as
+        necessary.
         """
-        if self._bridge is None or self._bridge not in fd_to_pair:
-            #
-            # Apparently the easiest way to do two-way UDP communication
-            # is to bind both sockets and connect them to each other.
-            #
-            logger.debug("UDP: Binding a bridge socket for %s", self)
-            self._bridge = socket.socket(socket.AF_INET, self._dest[Address.PROTOCOL])
-            self._bridge.bind(('', 0))
-            self._bridge.connect(self._dest[:Address.HOST_AND_PORT])
-            addr = self._bridge.getsockname()
-        
-            logger.debug("UDP: Bound a bridge socket on (%s, %i)", *addr)
-            self._server.connect(addr)
-    
-            logger.debug("UDP: Registering the bridge socket %i", self._bridge.fileno())
-            fd_to_pair[self._bridge.fileno()] = (self._bridge, self._server)
-            poll.register(self._bridge)
+        buf = recv_buffer(DATAGRAM_SIZE)
+        budget = EVENT_BUDGET
+        try:
+            while budget > 0:
+                try:
+                    size, client_addr = self._socket.recvfrom_into(buf)
+                except BlockingIOError:
+                    return
+                except socket.error as err:
+                    logger.debug("UDP: Server Encountered Error '%s'", err)
+                    return
+
+                budget -= size
+                session = self._sessions.get(client_addr)
+                if session is None:
+                    session = self._open_session(client_addr)
+                    if session is None:
+                        continue
+
+                session.send(buf[:size])
+        finally:
+            self._received[INBOUND] += EVENT_BUDGET - budget
+
+    def _open_session(self, client_addr):
+        "Creates a session for a new client, if there is room for one"
+        if len(self._sessions) >= self._options['udp_max_sessions']:
+            logger.debug("UDP: Dropped Datagram From (%s, %i), %s Has Too Many Sessions",
+                         client_addr[0], client_addr[1], self)
+            return None
+
+        dest = self._balancer.pick(client_addr)
+        try:
+            session = UDPSession(self, client_addr, dest)
+        except OSError as err:
+            logger.error("UDP: Unable To Open A Session For (%s, %i) Because '%s'",
+                         client_addr[0], client_addr[1], err)
+            self._balancer.release(dest)
+            return None
+
+        self._sessions[client_addr] = session
+        session.setup()
+
+        # If the destination is already known not to resolve, then the session
+        # has been closed again
+        return self._sessions.get(client_addr)
+
+    def close_session(self, client_addr):
+        "Closes the session of a client"
+        self._sessions.pop(client_addr).close()
 
-        do_send(self._bridge, self._server)
+    def received(self):
+        "Returns how many bytes have been received from clients and from destinations"
+        return list(self._received)
+
+    def add_backend(self, dest):
+        "Starts sending new clients to another destination"
+        self._balancer.add(dest)
+
+    def del_backend(self, dest):
+        "Stops sending new clients to a destination"
+        self._balancer.remove(dest)
 
 class TCPServer:
-    "A wrapper for the functions of the TCP server socket"
-    def __init__(self, src, dest):
+    """
+    A wrapper for the functions of the TCP server socket.
+
+    Each connection is forwarded to one of the mapping's destinations, which
+    its balancer picks when the connection is accepted.
+
+    When the warm_pool option is set, the server keeps that many connections
+    open to each destination ahead of time, so that an accepted connection can
+    be paired up right away instead of waiting on a handshake. A warm
+    connection which the destination closes is thrown away, but one which it
+    sends something on (like the banner of an SSH or SMTP server) is kept, and
+    whatever was sent is forwarded once the connection is used.
+    """
+    def __init__(self, src, dest, options):
         self._src = src
-        self._dest = dest
+        self._dest_proto = dest[Address.PROTOCOL]
+        self._balancer = balancer.make_balancer(options['balance'], [dest])
+        self._options = options
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
+        # Map: dest_portspec -> {bridge_fd: bridge_socket}
+        # The connected sockets in the warm pool of each destination
+        self._warm = {}
+
+        # Map: bridge_fd -> (bridge_socket, dest_portspec, timeout_timer)
+        # The sockets which are still connecting, before joining a warm pool
+        self._warming = {}
+        self._refill_timer = None
+
+        # The connections which were accepted by this server and are still open,
+        # including those whose bridges are still connecting
+        self._connections = set()
+
+        # How many connections have been accepted, how many times there were
+        # still connections waiting after accepting ACCEPT_BUDGET of them, how
+        # many times the accept queue was full when the server woke up, and the
+        # longest that the accept queue has been
+        self._accepted = 0
+        self._accept_bursts = 0
+        self._accept_queue_full = 0
+        self._accept_queue_peak = 0
+
+        # How many connections have been closed because the process ran out of
+        # file descriptors, and the timer which starts accepting again if the
+        # server had to stop (see shed_connection)
+        self._out_of_fds = 0
+        self._accept_timer = None
+
+        # Whether the server is known to be out of file descriptors, since it
+        # last managed to get one for a connection
+        self._short_of_fds = False
+
+        # How many bytes the connections which have been closed received from
+        # clients and from destinations (indexed by INBOUND and BRIDGE), how
+        # many connections never reached their destinations, and how long the
+        # ones which did took to get there after being accepted (in
+        # microseconds) - these are only updated once per connection, so that
+        # none of this costs anything while data is moving
+        self._received = [0, 0]
+        self._connect_failures = 0
+        self._connect_latency = histogram.Histogram()
+
+        # The limit on all of the mapping's connections put together
+        self._bucket = None
+        if options['rate_limit']:
+            self._bucket = make_bucket(options['rate_limit'], options['rate_burst'])
+
+        self._splice = False
+        if options['relay'] == Relay.SPLICE:
+            if not HAS_SPLICE:
+                logger.warning("TCP: splice() is unavailable, %s will copy data instead", self)
+            elif dest[Address.PROTOCOL] != Protocol.TCP:
+                logger.warning("TCP: splice() only works between TCP sockets, %s will copy data instead", self)
+            else:
+                self._splice = True
+
+        if options['warm_pool'] and dest[Address.PROTOCOL] != Protocol.TCP:
+            logger.warning("TCP: Warm pools only work with TCP destinations, %s won't have one", self)
+
     def __str__(self):
-        return "{} -> {}".format(format_address(self._src), format_address(self._dest))
+        return "{} -> {}".format(format_address(self._src),
+                                 ', '.join(map(format_address, self._balancer.backends)))
 
     def setup(self):
         "Bind the socket, start listening, and register the socket"
         self._socket.setblocking(0)
+        tune_listener(self._socket, self._options)
         self._socket.bind(self._src[:Address.HOST_AND_PORT])
-        self._socket.listen(5)
-        poll.register(self._socket)
+        self._socket.listen(self._options['backlog'])
+        poll.register(self._socket, poller.READ, self.handle)
 
         src_to_svr[self._src] = self
-        fd_to_svr[self._socket.fileno()] = self
 
         logger.debug("TCP: Created Server %s", self)
+        self.fill_pool()
 
     def destroy(self):
-        "Stops listening on this server socket"
+        "Stops listening on this server socket, and closes its warm pools"
         logger.debug("TCP: Destroying %s", self)
         del src_to_svr[self._src]
-        del fd_to_svr[self._socket.fileno()]
+
+        for dest in list(self._warm):
+            self.drop_pool(dest)
+        if self._refill_timer is not None:
+            self._refill_timer.cancel()
+        if self._accept_timer is not None:
+            self._accept_timer.cancel()
 
         poll.unregister(self._socket)
         self._socket.close()
 
-    def connect(self):
-        "Sets up a child socket"
+    def add_backend(self, dest):
+        "Starts sending new connections to another destination"
+        self._balancer.add(dest)
+        self.fill_pool()
+
+    def del_backend(self, dest):
+        "Stops sending new connections to a destination, and closes its warm pool"
+        self._balancer.remove(dest)
+        self.drop_pool(dest)
+
+    def fill_pool(self):
+        "Looks up every destination, so that their warm pools can be filled"
+        self._refill_timer = None
+        if not self._options['warm_pool'] or self._dest_proto != Protocol.TCP:
+            return
+
+        for dest in self._balancer.backends:
+            dns.resolve(dest[Address.HOST], functools.partial(self.warm_up, dest))
+
+    def warm_up(self, dest, address, error):
+        "Starts connecting enough sockets to fill up a destination's warm pool"
+        if src_to_svr.get(self._src) is not self or dest not in self._balancer.backends:
+            # The mapping or destination went away during the lookup
+            return
+        elif error is not None:
+            self.retry_fill()
+            return
+
+        pool = self._warm.setdefault(dest, {})
+        connecting = sum(1 for _, warming_dest, _ in self._warming.values()
+                         if warming_dest == dest)
+        for _ in range(self._options['warm_pool'] - len(pool) - connecting):
+            try:
+                bridge = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            except OSError as err:
+                logger.debug("TCP: Unable To Warm Up A Bridge To %s Because '%s'",
+                             format_address(dest), err)
+                self.retry_fill()
+                break
+
+            bridge.setblocking(0)
+            tune_socket(bridge, self._options)
+            err = bridge.connect_ex((address, dest[Address.PORT]))
+            if err not in (0, errno.EINPROGRESS):
+                logger.debug("TCP: Unable To Warm Up A Bridge To %s Because '%s'",
+                             format_address(dest), os.strerror(err))
+                bridge.close()
+                self.retry_fill()
+                break
+
+            timer = timers.schedule(loop_time + self._options['connect_timeout'],
+                                    self.warm_timed_out, bridge)
+            bridge_fd = bridge.fileno()
+            self._warming[bridge_fd] = (bridge, dest, timer)
+            poll.register(bridge_fd, poller.WRITE,
+                          functools.partial(self.warm_connected, bridge, bridge_fd))
+
+    def retry_fill(self):
+        "Fills the warm pools again after a while, if that isn't already coming up"
+        if self._refill_timer is None:
+            self._refill_timer = timers.schedule(loop_time + WARM_RETRY_DELAY, self.fill_pool)
+
+    def drop_pool(self, dest):
+        "Closes all of a destination's warm sockets, including those still connecting"
+        for bridge in self._warm.pop(dest, {}).values():
+            poll.unregister(bridge)
+            bridge.close()
+
+        for bridge_fd, (bridge, warming_dest, timer) in list(self._warming.items()):
+            if warming_dest == dest:
+                del self._warming[bridge_fd]
+                timer.cancel()
+                poll.unregister(bridge)
+                bridge.close()
+
+    def warm_connected(self, bridge, bridge_fd, events):
+        "Puts a warm socket into its destination's pool once it is connected"
+        warming = self._warming.get(bridge_fd)
+        if warming is None or warming[0] is not bridge:
+            # Dropped earlier in the same batch of events
+            return
+
+        _, dest, timer = self._warming.pop(bridge_fd)
+        timer.cancel()
+
+        err = bridge.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            logger.debug("TCP: Unable To Warm Up A Bridge To %s Because '%s'",
+                         format_address(dest), os.strerror(err))
+            poll.unregister(bridge_fd)
+            bridge.close()
+            self.retry_fill()
+            return
+
+        self._warm.setdefault(dest, {})[bridge_fd] = bridge
+        poll.modify(bridge_fd, poller.READ | poller.HANGUP,
+                    functools.partial(self.warm_closed, bridge, dest, bridge_fd))
+
+    def warm_closed(self, bridge, dest, bridge_fd, events):
+        """
+        Throws away a warm socket which the destination has closed. If the
+        destination has just sent something, the socket is only watched for
+        hangups from then on, since it would otherwise stay readable.
+        """
+        if self._warm.get(dest, {}).get(bridge_fd) is not bridge:
+            # Taken (or dropped) earlier in the same batch of events, so it
+            # may be paired up or closed by now
+            return
+
+        try:
+            waiting = bridge.recv(1, socket.MSG_PEEK)
+        except BlockingIOError:
+            return
+        except socket.error:
+            waiting = b''
+
+        if waiting and not events & poller.HANGUP:
+            poll.modify(bridge_fd, poller.HANGUP)
+            return
+
+        logger.debug("TCP: Discarding Warm Bridge %i To %s",
+                     bridge_fd, format_address(dest))
+        del self._warm[dest][bridge_fd]
+        poll.unregister(bridge_fd)
+        bridge.close()
+        self.retry_fill()
+
+    def warm_timed_out(self, bridge):
+        "Gives up on a warm socket which took too long to connect"
+        _, dest, _ = self._warming.pop(bridge.fileno())
+        logger.debug("TCP: Timed Out Warming Up A Bridge To %s", format_address(dest))
+        poll.unregister(bridge)
+        bridge.close()
+        self.retry_fill()
+
+    def take_warm(self, dest):
+        """
+        Takes a socket out of a destination's warm pool, or returns None if
+        the pool is empty.
+        """
+        pool = self._warm.get(dest)
+        while pool:
+            bridge_fd = next(iter(pool))
+            bridge = pool.pop(bridge_fd)
+            poll.unregister(bridge_fd)
+
+            # The destination may have closed it since the last poll - but if
+            # it has sent something, that is forwarded once the pair starts
+            try:
+                if bridge.recv(1, socket.MSG_PEEK):
+                    return bridge
+            except BlockingIOError:
+                return bridge
+            except socket.error:
+                pass
+
+            logger.debug("TCP: Discarding Warm Bridge %i To %s",
+                         bridge_fd, format_address(dest))
+            bridge.close()
+
+        return None
+
+    def handle(self, events):
+        "Accepts the connections waiting on the server socket"
+        queued, backlog = self.accept_queue()
+        if queued is not None:
+            self._accept_queue_peak = max(self._accept_queue_peak, queued)
+            if queued >= backlog:
+                # The kernel is probably dropping connections
+                self._accept_queue_full += 1
+                logger.debug("TCP: Accept Queue Of %s Is Full", self)
+
+        shed = 0
+        for _ in range(ACCEPT_BUDGET):
+            try:
+                inbound, client_addr = self._socket.accept()
+            except BlockingIOError:
+                return
+            except ConnectionAbortedError:
+                # The client gave up while it was waiting to be accepted
+                continue
+            except socket.error as err:
+                if err.errno not in OUT_OF_FDS:
+                    logger.error("TCP: Unable To Accept On %s Because '%s'", self, err)
+                    return
+
+                if not shed_connection(self._socket):
+                    if reserve_fd is None:
+                        self.pause_accepting()
+                    return
+
+                if not shed:
+                    logger.error("TCP: Out Of File Descriptors, Closing New Connections To %s", self)
+                shed += 1
+                self._out_of_fds += 1
+                continue
+
+            self._accepted += 1
+            self.connect(inbound, client_addr)
+
+        # The rest of the waiting connections are accepted the next time around
+        self._accept_bursts += 1
+
+    def pause_accepting(self):
+        """
+        Stops accepting for a while, for when connections can't even be shed -
+        otherwise the server would be readable on every pass of the event loop
+        without ever getting anywhere.
+        """
+        logger.error("TCP: Not Accepting On %s For %.1fs", self, ACCEPT_RETRY_DELAY)
+        poll.modify(self._socket, 0)
+        self._accept_timer = timers.schedule(loop_time + ACCEPT_RETRY_DELAY,
+                                             self.resume_accepting)
+
+    def resume_accepting(self):
+        "Starts accepting again after pause_accepting"
+        self._accept_timer = None
+        poll.modify(self._socket, poller.READ)
+
+    def accept_queue(self):
+        """
+        Returns how many connections are waiting to be accepted, and how many
+        can wait at most - or (None, None) where the kernel won't say.
+        """
+        if not hasattr(socket, 'TCP_INFO'):
+            return (None, None)
+
+        # For a listening socket, Linux reports the length of the accept queue
+        # in tcpi_unacked and the backlog in tcpi_sacked
+        info = self._socket.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, TCP_INFO_SIZE)
+        return struct.unpack_from('II', info, TCP_INFO_UNACKED)
+
+    def accept_stats(self):
+        "Returns a dictionary of counters describing how connections are being accepted"
+        queued, backlog = self.accept_queue()
+        return {
+            'accepted': self._accepted,
+            'accept_bursts': self._accept_bursts,
+            'accept_queue_full': self._accept_queue_full,
+            'accept_queue_peak': self._accept_queue_peak,
+            'accept_queue': queued,
+            'backlog': backlog,
+            'out_of_fds': self._out_of_fds,
+        }
+
+    def connect(self, inbound, client_addr):
+        """
+        Starts connecting the bridge of a newly accepted child socket to the
+        destination.
+
+        The destination is looked up and the bridge connects in the
+        background, so that a slow resolver or destination doesn't hold up any
+        other connections - the pair isn't complete until finish_connect is
+        called when the bridge becomes writable.
+        """
         logger.debug("TCP: Accepting Connection On %s", self)
+        tune_socket(inbound, self._options)
+        conn = Connection(self, inbound, self._balancer.pick(client_addr))
+        self._connections.add(conn)
+
+        bridge = self.take_warm(conn.dest)
+        if bridge is not None:
+            logger.debug("TCP: Using Warm Bridge %i To %s",
+                         bridge.fileno(), format_address(conn.dest))
+            self.pair(conn, bridge)
+            self.fill_pool()
+            return
+
+        # The timeout covers the lookup as well, so that a slow resolver can't
+        # hold on to the inbound socket forever
+        conn.timers['connect'] = timers.schedule(
+            loop_time + self._options['connect_timeout'], self.connect_timed_out, conn)
+        dns.resolve(conn.dest[Address.HOST],
+                    functools.partial(self.start_connect, conn))
+
+    def start_connect(self, conn, address, error):
+        "Starts connecting a child socket's bridge, once its address is known"
+        if conn.closed:
+            # The mapping was drained (or the forwarder quit, or the connect
+            # timed out) during the lookup
+            return
+        elif error is not None:
+            logger.error("TCP: Unable To Resolve %s Because '%s'",
+                         format_address(conn.dest), error)
+            self._connect_failures += 1
+            conn.close()
+            return
 
-        bridge = socket.socket(socket.AF_INET, self._dest[Address.PROTOCOL])
-        inbound, _ = self._socket.accept()
-        dest_host, dest_port, dest_proto = self._dest
-        
         try:
-            logger.debug("TCP: Connecting Bridge To %s",
-                         format_address(self._dest))
-            bridge.connect((dest_host, dest_port))
-        except socket.error as err:
+            bridge = socket.socket(socket.AF_INET, self._dest_proto)
+        except OSError as err:
+            if err.errno in OUT_OF_FDS:
+                self.out_of_fds("Connecting To", conn.dest)
+            else:
+                logger.error("TCP: Unable To Connect To %s Because '%s'",
+                             format_address(conn.dest), err)
+            self._connect_failures += 1
+            conn.close()
+            return
+
+        self._short_of_fds = False
+        bridge.setblocking(0)
+        tune_socket(bridge, self._options)
+
+        logger.debug("TCP: Connecting Bridge To %s",
+                     format_address(conn.dest))
+        err = bridge.connect_ex((address, conn.dest[Address.PORT]))
+        if err not in (0, errno.EINPROGRESS):
+            logger.error("TCP: Unable To Connect To %s Because '%s'",
+                         format_address(conn.dest),
+                         os.strerror(err))
+            bridge.close()
+            self._connect_failures += 1
+            conn.close()
+            return
+
+        conn.attach(bridge)
+        poll.register(bridge, poller.WRITE,
+                      functools.partial(self.finish_connect, conn))
+
+    def finish_connect(self, conn, events):
+        "Pairs up a child socket with its bridge once the bridge is connected"
+        if conn.closed:
+            # Drained earlier in the same batch of events
+            return
+
+        conn.timers.pop('connect').cancel()
+
+        bridge = conn.socks[BRIDGE]
+        err = bridge.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
             logger.error("TCP: Unable To Connect To %s Because '%s'",
-                         format_address(self._dest),
-                         err)
+                         format_address(conn.dest),
+                         os.strerror(err))
+            self._connect_failures += 1
+            conn.close()
             return
 
+        self.pair(conn, bridge)
+
+    def pair(self, conn, bridge):
+        "Starts forwarding between a child socket and its connected bridge"
+        inbound = conn.socks[INBOUND]
         logger.debug("TCP: Pairing Inbound %i and Bridge %i",
                      inbound.fileno(), bridge.fileno())
 
-        fd_to_pair[bridge.fileno()] = (bridge, inbound)
-        fd_to_pair[inbound.fileno()] = (inbound, bridge)
+        if self._splice:
+            try:
+                conn.pipes = make_pipes()
+            except OSError as err:
+                if err.errno in OUT_OF_FDS:
+                    self.out_of_fds("Creating Splice Pipes For", conn.dest)
+                else:
+                    logger.error("TCP: Unable To Create Splice Pipes For %s Because '%s'",
+                                 format_address(conn.dest), err)
+                if conn.socks[BRIDGE] is None:
+                    # A warm bridge, which the connection doesn't have yet
+                    bridge.close()
+                conn.close()
+                return
+            conn.piped = [0, 0]
+        else:
+            conn.buf = recv_buffer(self._options['buffer_size'])
+            conn.outbufs = (bytearray(), bytearray())
+
+        inbound.setblocking(0)
+        conn.connected = loop_time
+        self._connect_latency.record(int((loop_time - conn.accepted) * 1e6))
 
         logger.debug("TCP: Registering Inbound %i And Bridge %i With The Selector",
                      inbound.fileno(), bridge.fileno())
-        poll.register(bridge.fileno())
-        poll.register(inbound.fileno())
+        poll.register(inbound, poller.READ | poller.HANGUP,
+                      functools.partial(handle_pair, conn, INBOUND))
+        if conn.socks[BRIDGE] is None:
+            # A warm bridge, which was taken out of the poller along with its pool
+            conn.attach(bridge)
+            poll.register(bridge, poller.READ | poller.HANGUP,
+                          functools.partial(handle_pair, conn, BRIDGE))
+        else:
+            poll.modify(bridge, poller.READ | poller.HANGUP,
+                        functools.partial(handle_pair, conn, BRIDGE))
+
+        if self._options['idle_timeout']:
+            conn.timers['idle'] = timers.schedule(
+                loop_time + self._options['idle_timeout'], conn.check_idle)
+        if self._options['max_lifetime']:
+            conn.timers['lifetime'] = timers.schedule(
+                loop_time + self._options['max_lifetime'], conn.expire, 'Lived Too Long')
+
+        buckets = []
+        if self._bucket is not None:
+            buckets.append(self._bucket)
+        if self._options['conn_rate_limit']:
+            buckets.append(make_bucket(self._options['conn_rate_limit'],
+                                       self._options['rate_burst']))
+        if buckets:
+            conn.buckets = buckets
+
+    def out_of_fds(self, doing, dest):
+        """
+        Counts a connection which couldn't get a file descriptor. Once this
+        happens, it tends to happen to every connection until some are closed,
+        so it is only logged as an error the first time.
+        """
+        self._out_of_fds += 1
+        if self._short_of_fds:
+            logger.debug("TCP: Out Of File Descriptors %s %s", doing, format_address(dest))
+        else:
+            self._short_of_fds = True
+            logger.error("TCP: Out Of File Descriptors %s %s", doing, format_address(dest))
+
+    def connect_timed_out(self, conn):
+        "Gives up on a bridge which took too long to connect"
+        logger.error("TCP: Timed Out Connecting To %s",
+                     format_address(conn.dest))
+        self._connect_failures += 1
+        conn.close()
+
+    def forget(self, conn):
+        "Stops keeping track of a connection, once it has been closed"
+        self._connections.discard(conn)
+        self._balancer.release(conn.dest)
+        self._received[INBOUND] += conn.received[INBOUND]
+        self._received[BRIDGE] += conn.received[BRIDGE]
+
+    def received(self):
+        "Returns how many bytes have been received from clients and from destinations"
+        received = list(self._received)
+        for conn in self._connections:
+            received[INBOUND] += conn.received[INBOUND]
+            received[BRIDGE] += conn.received[BRIDGE]
+        return received
+
+    def drain(self):
+        """
+        Closes all of this server's connections once the data that they have
+        already read has been written, and closes its unpaired connections
+        straight away.
+        """
+        logger.debug("TCP: Draining %i Connections Of %s", len(self._connections), self)
+        for conn in list(self._connections):
+            conn.drain()
+
+# Which socket of a connection is which. Everything that a connection keeps for
+# each of its sockets is kept in pairs, indexed by these.
+(INBOUND, BRIDGE) = (0, 1)
+
+# Why a socket of a connection isn't being read from - it is PAUSED when its
+# peer has too much data waiting for it (or it has reached EOF), and THROTTLED
+# when it has used up its rate limit, until a timer lets it go again. A socket
+# is DRAINING when it should be closed, along with its peer, once all of the
+# data waiting for it has been written.
+(PAUSED, THROTTLED, DRAINING) = (1, 2, 4)
+
+class Connection:
+    """
+    A forwarded TCP connection, from when it is accepted until it is closed.
+
+    A connection holds both of its sockets (the inbound socket which was
+    accepted, and the bridge to its destination) along with everything needed
+    to move data between them. Whatever belongs to only one of the sockets is
+    kept in a pair, indexed by INBOUND or BRIDGE, so that both directions can
+    be handled by the same code:
+
+    - outbufs holds the data waiting to be written to each socket, for
+      connections which copy.
+    - pipes holds the pipe that the data read from each socket is spliced
+      through, and piped how many bytes are waiting in the peer's pipe to be
+      written to each socket, for connections which splice.
+    - flags holds the PAUSED, THROTTLED and DRAINING bits of each socket.
+    - received holds how many bytes have been read from each socket.
+
+    There are a lot of these, so they have __slots__ rather than a __dict__.
+    """
+    __slots__ = ('server', 'dest', 'socks', 'fds', 'buf', 'outbufs', 'pipes',
+                 'piped', 'flags', 'received', 'buckets', 'timers', 'accepted',
+                 'connected', 'last_active', 'closed')
+
+    def __init__(self, server, inbound, dest):
+        self.server = server
+        self.dest = dest
+        self.socks = [inbound, None]
+        self.fds = [inbound.fileno(), -1]
+        self.buf = None
+        self.outbufs = None
+        self.pipes = None
+        self.piped = None
+        self.flags = [0, 0]
+        self.received = [0, 0]
+
+        # The rate limits that the connection is under, or None if it isn't
+        # under any
+        self.buckets = None
+
+        # Map: name -> timer
+        # The timers which go along with the connection, which are cancelled
+        # when it is closed
+        self.timers = {}
+
+        # When the connection was accepted, when its bridge was connected (which
+        # is None until then), and when either socket was last readable or
+        # writable
+        self.accepted = loop_time
+        self.connected = None
+        self.last_active = loop_time
+        self.closed = False
+
+        track(self.fds[INBOUND], self)
 
-mapping_mod_lock = threading.Lock()
+    def attach(self, bridge):
+        "Gives the connection its bridge, once the bridge is registered"
+        self.socks[BRIDGE] = bridge
+        self.fds[BRIDGE] = bridge.fileno()
+        track(self.fds[BRIDGE], self)
+
+    def close(self):
+        "Closes both sockets, along with any splice pipes"
+        if self.closed:
+            return
+
+        self.closed = True
+        for timer in self.timers.values():
+            timer.cancel()
+
+        if self.pipes is not None:
+            for pipe_read, pipe_write in self.pipes:
+                os.close(pipe_read)
+                os.close(pipe_write)
+
+        for side in (BRIDGE, INBOUND):
+            sock = self.socks[side]
+            if sock is None:
+                continue
+
+            logger.debug("Closing %i", self.fds[side])
+            connections[self.fds[side]] = None
+            # The inbound socket isn't registered until the bridge is connected,
+            # but the bridge is as soon as it starts connecting
+            if side == BRIDGE or self.connected is not None:
+                poll.unregister(self.fds[side])
+            sock.close()
+
+        self.server.forget(self)
+
+    def drain(self):
+        """
+        Stops reading from both sockets, and closes the connection once all of
+        the data which is waiting to be written has been. A connection whose
+        bridge hasn't connected yet is closed right away.
+        """
+        if self.connected is None:
+            self.close()
+            return
+
+        for side in (INBOUND, BRIDGE):
+            self.flags[side] |= PAUSED | DRAINING
+            watch(self, side)
+
+        if not queued(self, INBOUND) and not queued(self, BRIDGE):
+            self.close()
+
+    def check_idle(self):
+        """
+        Closes the connection if neither of its sockets has done anything for
+        too long, or checks again later if one of them has.
+        """
+        deadline = self.last_active + self.server._options['idle_timeout']
+        if deadline <= loop_time:
+            self.expire('Was Idle')
+        else:
+            self.timers['idle'] = timers.schedule(deadline, self.check_idle)
+
+    def expire(self, reason):
+        "Closes the connection because its time is up"
+        logger.debug("Closing %i and %i Because It %s",
+                     self.fds[INBOUND], self.fds[BRIDGE], reason)
+        self.close()
+
+class MetricsServer:
+    """
+    Serves the metrics of this process (see render_metrics) over HTTP, so that
+    they can be scraped.
+
+    This runs on the event loop like everything else, so that a scrape never
+    has to wait on (or hold up) the forwarding thread for longer than it takes
+    to render the metrics. Requests and responses are small, so each client
+    is read until the end of its request's headers, sent the whole response
+    as its socket takes it, and then closed. Clients which take longer than
+    METRICS_TIMEOUT are dropped.
+    """
+    def __init__(self, address):
+        self._address = address
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._clients = set()
+        self._accept_timer = None
+
+    def setup(self):
+        "Binds the socket, starts listening, and registers the socket"
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.setblocking(0)
+        self._socket.bind(self._address)
+        self._socket.listen(socket.SOMAXCONN)
+        poll.register(self._socket, poller.READ, self.handle)
+        logger.debug("Serving Metrics On (%s, %i)", *self._address)
+
+    def destroy(self):
+        "Stops listening, and closes all of the clients"
+        for client in list(self._clients):
+            client.close()
+        if self._accept_timer is not None:
+            self._accept_timer.cancel()
+
+        poll.unregister(self._socket)
+        self._socket.close()
+
+    def handle(self, events):
+        "Accepts the clients waiting on the server socket"
+        for _ in range(ACCEPT_BUDGET):
+            try:
+                sock, _ = self._socket.accept()
+            except BlockingIOError:
+                return
+            except ConnectionAbortedError:
+                continue
+            except socket.error as err:
+                logger.error("Unable To Accept Metrics Client Because '%s'", err)
+                if err.errno in OUT_OF_FDS and shed_connection(self._socket):
+                    continue
+
+                # Otherwise the socket would stay readable, and spin the loop
+                poll.modify(self._socket, 0)
+                self._accept_timer = timers.schedule(loop_time + ACCEPT_RETRY_DELAY,
+                                                     self.resume_accepting)
+                return
+
+            client = MetricsClient(self, sock)
+            self._clients.add(client)
+            client.setup()
+
+    def resume_accepting(self):
+        self._accept_timer = None
+        poll.modify(self._socket, poller.READ)
+
+class MetricsClient:
+    "A client of a MetricsServer, which is sent a single response and closed"
+    def __init__(self, server, sock):
+        self._server = server
+        self._socket = sock
+        self._request = bytearray()
+        self._response = None
+        self._timer = None
+
+    def setup(self):
+        self._socket.setblocking(0)
+        poll.register(self._socket, poller.READ, self.handle)
+        self._timer = timers.schedule(loop_time + METRICS_TIMEOUT, self.close)
+
+    def close(self):
+        self._timer.cancel()
+        poll.unregister(self._socket)
+        self._socket.close()
+        self._server._clients.discard(self)
+
+    def handle(self, events):
+        "Reads the request, or writes the response"
+        try:
+            if events & poller.ERROR:
+                self.close()
+            elif self._response is None:
+                self.read_request()
+            else:
+                self.write_response()
+        except BlockingIOError:
+            pass
+        except socket.error as err:
+            logger.debug("Metrics Client Encountered Error '%s'", err)
+            self.close()
+
+    def read_request(self):
+        data = self._socket.recv(METRICS_REQUEST_SIZE)
+        if not data:
+            self.close()
+            return
+
+        self._request += data
+        if b'\r\n\r\n' in self._request or b'\n\n' in self._request:
+            self._response = memoryview(respond_metrics(bytes(self._request)))
+        elif len(self._request) > METRICS_REQUEST_SIZE:
+            self._response = memoryview(http_response(431, 'Request Header Fields Too Large'))
+        else:
+            return
+
+        poll.modify(self._socket, poller.WRITE)
+        self.write_response()
+
+    def write_response(self):
+        sent = self._socket.send(self._response)
+        self._response = self._response[sent:]
+        if not self._response:
+            self.close()
+
+def http_response(status, reason, body=b'', content_type='text/plain; charset=utf-8', head=False):
+    "Returns the bytes of a complete HTTP response, which closes the connection"
+    header = ('HTTP/1.0 {} {}\r\n'
+              'Content-Type: {}\r\n'
+              'Content-Length: {}\r\n'
+              'Connection: close\r\n\r\n').format(status, reason, content_type, len(body))
+    return header.encode('ascii') + (b'' if head else body)
+
+def respond_metrics(request):
+    "Returns the response to a request sent to the metrics endpoint"
+    try:
+        method, target, _ = request.split(b'\n', 1)[0].decode('ascii').split()
+    except ValueError:
+        return http_response(400, 'Bad Request', b'Bad request\n')
+
+    if method not in ('GET', 'HEAD'):
+        return http_response(405, 'Method Not Allowed', b'Only GET is supported\n')
+    elif target.split('?', 1)[0] != '/metrics':
+        return http_response(404, 'Not Found', b'Metrics are at /metrics\n')
+
+    return http_response(200, 'OK', render_metrics(), metrics.CONTENT_TYPE, method == 'HEAD')
 
 # Map: (src_host, src_port) -> server
 # Useful for removing connections
 src_to_svr = {}
 
-# Map: server_fd -> server
-# Useful for handling server connections
-fd_to_svr = {}
+# List: socket_fd -> Connection
+# Every connection, under the file descriptors of both of its sockets (with
+# None for the file descriptors which aren't part of one). The kernel always
+# hands out the lowest file descriptor which is free, so the list stays dense,
+# and finding the connection of a socket costs an index rather than a hash.
+connections = []
 
-# Map: socket_fd -> (writer_socket, reader_socket)
-# Useful for doing transfers of data
-fd_to_pair = {}
+# A file descriptor which is kept open so that it can be given up when all of
+# the others have run out - see shed_connection
+reserve_fd = None
+
+# Map: buffer_size -> memoryview
+# Data is only ever read into these buffers long enough to be sent (or copied
+# into an output buffer), and all of that happens on the forwarding thread -
+# so, every connection with the same buffer size can share the same one.
+recv_buffers = {}
 
 poll = poller.Poller()
 
-def do_send(reader, writer):
+# Everything that the forwarding thread uses is only ever touched by the
+# forwarding thread - other threads post (future, function, args) commands
+# here and wake it up, and it runs them in between batches of events. The
+# future is None for commands which nobody is waiting on.
+commands = collections.deque()
+waker = poller.Waker()
+
+# Held while a command is posted, so that none can slip in after the forwarding
+# thread has run its last batch - once commands_closed is set, nothing more is
+# posted, and the waker is gone
+commands_lock = threading.Lock()
+commands_closed = False
+
+# The time when the poller last returned, which is close enough to use for
+# timestamps and deadlines on the forwarding thread
+loop_time = time.monotonic()
+timers = timerwheel.TimerWheel(loop_time)
+
+# How many bytes each socket can move during the current pass of the event
+# loop - see PASS_BUDGET
+quantum = PASS_BUDGET
+
+# How long to wait in the poller, when there aren't any timers which need
+# running sooner
+MAX_POLL_TIMEOUT = 1.0
+
+# How many passes the event loop has made, and the server which the metrics are
+# scraped from (which is None unless start_metrics has been called)
+passes = 0
+metrics_server = None
+
+# Map: name -> histogram.Histogram
+# What the event loop has been spending its time on, which is only recorded
+# while it is being profiled - otherwise, this is None, and the only cost is a
+# check at the start of each pass
+profile = None
+lag_probe = None
+
+def track(sock_fd, conn):
+    "Puts a connection into the connections table under one of its sockets"
+    if sock_fd >= len(connections):
+        connections.extend([None] * max(sock_fd + 1 - len(connections), len(connections)))
+    connections[sock_fd] = conn
+
+def make_pipes():
     """
-    Handles sending from a reader socket to a writer socket, as well as closing
-    dead sockets.
+    Creates the splice pipes of a connection. Each direction gets its own pipe,
+    since data which is in flight one way shouldn't get mixed up with data
+    going the other way.
     """
-    logger.debug("Sending A Message From %i -> %i", reader.fileno(), writer.fileno())
-
+    first = os.pipe()
     try:
-        logger.debug("Reading Message From %i", reader.fileno())
-        data = writer.recv(4096)
-        logger.debug("Read Message Of Length %i", len(data))
-    except socket.error as err:
-        # A dead socket - set the read data to empty to get it closed
-        data = ""
-        logger.debug("Writer Encoutered Error '%s' While Sending Data", err)
-
-    if data:
+        return (first, os.pipe())
+    except OSError:
+        os.close(first[0])
+        os.close(first[1])
+        raise
+
+def open_reserve():
+    "Opens the reserve file descriptor, if it isn't already open"
+    global reserve_fd
+    if reserve_fd is None:
         try:
-            logger.debug("Writing Message To %i", writer.fileno())
-            reader.send(data)
-        except socket.error as err:
-            logger.debug("Reader Encoutered Error '%s' While Getting Data", err)
+            reserve_fd = os.open(os.devnull, os.O_RDONLY | os.O_CLOEXEC)
+        except OSError:
+            pass
+
+def shed_connection(listener):
+    """
+    Accepts a connection and closes it straight away, for when the process has
+    run out of file descriptors. Otherwise, the connection would sit in the
+    accept queue, and since the poller is level-triggered, the listener would
+    be readable on every pass of the event loop until a file descriptor came
+    free. This way, the client finds out right away.
+
+    The reserve file descriptor is closed to make room for the connection, and
+    opened again afterwards. Returns True if a connection was shed, or False if
+    there weren't any waiting (or there was no reserve to close, in which case
+    reserve_fd is None).
+    """
+    global reserve_fd
+    open_reserve()
+    if reserve_fd is None:
+        return False
+
+    os.close(reserve_fd)
+    reserve_fd = None
+    try:
+        sock, _ = listener.accept()
+        sock.close()
+        shed = True
+    except OSError:
+        shed = False
+
+    open_reserve()
+    return shed
+
+def recv_buffer(size):
+    "Gets the shared receive buffer of the given size"
+    try:
+        return recv_buffers[size]
+    except KeyError:
+        buf = recv_buffers[size] = memoryview(bytearray(size))
+        return buf
+
+def queued(conn, side):
+    "Returns how many bytes are waiting to be written to a socket of a connection"
+    if conn.outbufs is not None:
+        return len(conn.outbufs[side])
     else:
-        writer_fd = writer.fileno()
-        if writer_fd in fd_to_pair:
-            del fd_to_pair[writer_fd]
-            logger.debug("Closing Writer %i", writer_fd)
-            writer.close()
+        return conn.piped[side]
 
-        reader_fd = reader.fileno()
-        if reader_fd in fd_to_pair:
-            del fd_to_pair[reader_fd]
-            logger.debug("Closing Reader %i", reader_fd)
-            reader.close()
+def watch(conn, side):
+    """
+    Updates the events that a socket of a connection is polled for - it is read
+    from unless it is paused or throttled, and written to whenever it has data
+    waiting.
+    """
+    if conn.flags[side] & (PAUSED | THROTTLED):
+        events = 0
+    else:
+        events = poller.READ | poller.HANGUP
+    if queued(conn, side):
+        events |= poller.WRITE
+    poll.modify(conn.fds[side], events)
+
+def pause(conn, side):
+    "Stops reading from a socket of a connection"
+    if not conn.flags[side] & PAUSED:
+        conn.flags[side] |= PAUSED
+        watch(conn, side)
 
-def add_mapping(src_portspec, dest_portspec):
+def resume(conn, side):
+    "Starts reading from a paused socket of a connection again"
+    if conn.flags[side] & PAUSED:
+        conn.flags[side] &= ~PAUSED
+        watch(conn, side)
+
+def make_bucket(rate, burst):
+    "Creates the token bucket for a rate limit, in bytes per second"
+    if not burst:
+        burst = max(int(rate * DEFAULT_BURST_TIME), FAIR_QUANTUM)
+    return tokenbucket.TokenBucket(rate, burst, loop_time)
+
+def allowance(conn, side):
+    """
+    Returns how many bytes can be read from a socket of a connection during this
+    pass of the event loop, throttling it if its rate limit doesn't allow any.
+    """
+    buckets = conn.buckets
+    if buckets is None or conn.flags[side] & THROTTLED:
+        # A throttled socket only gets here when it has hung up, and there's
+        # no point in holding up the end of a connection
+        return quantum
+
+    budget = min(quantum, *[bucket.available(loop_time) for bucket in buckets])
+    if not budget:
+        throttle(conn, side)
+    return budget
+
+def charge(conn, side, moved):
+    "Counts the bytes read from a socket of a connection, and takes them out of its rate limits"
+    conn.received[side] += moved
+    if conn.closed:
+        # The rest has already been added to the server's total (see
+        # TCPServer.forget), when the read closed the connection
+        conn.server._received[side] += moved
+    buckets = conn.buckets
+    if buckets is None or not moved:
+        return
+
+    for bucket in buckets:
+        bucket.consume(moved, loop_time)
+    if not conn.closed and not min(bucket.available(loop_time) for bucket in buckets):
+        throttle(conn, side)
+
+def throttle(conn, side):
+    "Stops reading from a socket until its rate limits let it read a quantum"
+    wait = max(bucket.delay(FAIR_QUANTUM, loop_time) for bucket in conn.buckets)
+    name = ('throttle', side)
+    if name in conn.timers:
+        conn.timers[name].cancel()
+    conn.timers[name] = timers.schedule(loop_time + wait, unthrottle, conn, side)
+
+    if not conn.flags[side] & THROTTLED:
+        conn.flags[side] |= THROTTLED
+        watch(conn, side)
+
+def unthrottle(conn, side):
+    "Starts reading from a throttled socket again"
+    del conn.timers[('throttle', side)]
+    conn.flags[side] &= ~THROTTLED
+    watch(conn, side)
+
+def write_queued(conn, side):
+    """
+    Writes as much of the data waiting for a socket of a connection as it will
+    take, and then pauses or resumes its peer depending upon how much is still
+    waiting.
+
+    Returns the number of bytes still waiting, or None if the connection had
+    to be closed.
+    """
+    peer = 1 - side
+    try:
+        if conn.outbufs is not None:
+            (high, low) = (HIGH_WATERMARK, LOW_WATERMARK)
+            outbuf = conn.outbufs[side]
+            sent = conn.socks[side].send(outbuf)
+            del outbuf[:sent]
+        else:
+            # Nothing can be spliced into the pipe until it has been emptied,
+            # since a partially full pipe might not take a whole chunk
+            (high, low) = (0, 1)
+            sent = os.splice(conn.pipes[peer][0], conn.fds[side], conn.piped[side],
+                             flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+            conn.piped[side] -= sent
+    except BlockingIOError:
+        pass
+    except OSError as err:
+        logger.debug("Reader Encoutered Error '%s' While Getting Data", err)
+        conn.close()
+        return None
+
+    left = queued(conn, side)
+    if not left and conn.flags[side] & DRAINING:
+        # When both sockets are draining, the connection has to wait for both
+        if not (conn.flags[peer] & DRAINING and queued(conn, peer)):
+            conn.close()
+            return None
+
+    if left > high:
+        pause(conn, peer)
+    elif left < low and not conn.flags[side] & DRAINING:
+        resume(conn, peer)
+    return left
+
+def finish_send(conn, side):
+    """
+    Handles a socket of a connection reaching EOF (or dying), by closing the
+    connection once everything that its peer is waiting for has been written.
+    """
+    peer = 1 - side
+    if queued(conn, peer):
+        logger.debug("Draining %i Before Closing", conn.fds[peer])
+        conn.flags[peer] |= DRAINING
+        pause(conn, side)
+    else:
+        conn.close()
+
+def do_send(conn, side):
+    """
+    Handles sending from one socket of a connection to the other, as well as
+    closing dead sockets.
+
+    The socket is read into the connection's buffer until it runs dry, or until
+    it has used up its quantum (or rate limit) for this pass. Anything which its
+    peer can't take right away is queued up, and written by do_flush once the
+    peer becomes writable.
+    """
+    peer = 1 - side
+    writer = conn.socks[side]
+    reader = conn.socks[peer]
+
+    buf = conn.buf
+    outbuf = conn.outbufs[peer]
+    budget = allowance(conn, side)
+    moved = 0
+    try:
+        while moved < budget:
+            wanted = min(len(buf), budget - moved)
+            try:
+                size = writer.recv_into(buf, wanted)
+            except BlockingIOError:
+                return
+            except socket.error as err:
+                # A dead socket - set the read size to nothing to get it closed
+                size = 0
+                logger.debug("Writer Encoutered Error '%s' While Sending Data", err)
+
+            if not size:
+                finish_send(conn, side)
+                return
+
+            moved += size
+            if outbuf:
+                # Sending now would put this data ahead of what is already waiting
+                outbuf += buf[:size]
+                if len(outbuf) > HIGH_WATERMARK:
+                    pause(conn, side)
+                    return
+            else:
+                try:
+                    sent = reader.send(buf[:size])
+                except BlockingIOError:
+                    sent = 0
+                except socket.error as err:
+                    logger.debug("Reader Encoutered Error '%s' While Getting Data", err)
+                    conn.close()
+                    return
+
+                if sent < size:
+                    outbuf += buf[sent:size]
+                    watch(conn, peer)
+                    return
+
+            if size < wanted:
+                # A short read means that the writer has (almost certainly) been
+                # drained - trying again would most likely waste a syscall
+                return
+    finally:
+        charge(conn, side, moved)
+
+def do_splice(conn, side):
+    """
+    Like do_send, but moves the data from one socket to the other through a
+    kernel pipe, so that it never has to be copied into Python.
+    """
+    peer = 1 - side
+    writer_fd = conn.fds[side]
+    pipe_write = conn.pipes[side][1]
+    budget = allowance(conn, side)
+    moved = 0
+    try:
+        while moved < budget:
+            wanted = min(SPLICE_CHUNK, budget - moved)
+            try:
+                size = os.splice(writer_fd, pipe_write, wanted,
+                                 flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+            except BlockingIOError:
+                return
+            except OSError as err:
+                size = 0
+                logger.debug("Writer Encoutered Error '%s' While Splicing Data", err)
+
+            if not size:
+                finish_send(conn, side)
+                return
+
+            moved += size
+            conn.piped[peer] += size
+            left = write_queued(conn, peer)
+            if left is None:
+                return
+            elif left:
+                watch(conn, peer)
+                return
+
+            if size < wanted:
+                return
+    finally:
+        charge(conn, side, moved)
+
+def do_flush(conn, side):
+    """
+    Writes out the data waiting for a socket of a connection, once it becomes
+    writable. Returns False if the connection was closed.
+    """
+    left = write_queued(conn, side)
+    if left == 0:
+        watch(conn, side)
+    return left is not None
+
+def handle_pair(conn, side, events):
+    "Handles the events on one of the sockets in a connection"
+    if conn.closed:
+        # The connection was closed by an earlier event in the same batch
+        return
+
+    conn.last_active = loop_time
+
+    if events & poller.ERROR:
+        logger.debug("Error On %i", conn.fds[side])
+        conn.close()
+        return
+
+    if events & poller.WRITE and not do_flush(conn, side):
+        return
+
+    # A hangup is detected by trying to read, and getting an EOF
+    if events & (poller.READ | poller.HANGUP):
+        if conn.pipes is None:
+            do_send(conn, side)
+        else:
+            do_splice(conn, side)
+
+def run_commands(events):
+    "Runs all of the commands which other threads have posted"
+    waker.clear()
+    while commands:
+        future, func, args = commands.popleft()
+        if future is None:
+            # Nobody is waiting to hear about it, but it mustn't take the
+            # forwarding thread down either
+            try:
+                func(*args)
+            except Exception:
+                logger.exception("Unable To Run A Posted Command")
+            continue
+
+        try:
+            future.set_result(func(*args))
+        except Exception as err:
+            future.set_exception(err)
+
+def call_in_loop(func, *args):
+    """
+    Runs func(*args) on the forwarding thread, waits for it to finish, and then
+    returns whatever it returned (or raises whatever it raised).
+    """
+    if threading.current_thread() is thread:
+        return func(*args)
+    elif done:
+        raise RuntimeError("The forwarding thread has quit")
+
+    future = concurrent.futures.Future()
+    if not post(future, func, args):
+        raise RuntimeError("The forwarding thread has quit")
+    return future.result()
+
+def post_to_loop(func, *args):
+    "Runs func(*args) on the forwarding thread, without waiting for it"
+    post(None, func, args)
+
+def post(future, func, args):
+    """
+    Queues up a command and wakes up the forwarding thread to run it. Returns
+    False if the forwarding thread has quit, and won't ever run it.
+    """
+    with commands_lock:
+        if commands_closed:
+            return False
+        commands.append((future, func, args))
+        waker.wake()
+        return True
+
+# Looks up destination hostnames, so that the forwarding thread never has to
+dns = resolver.Resolver(post_to_loop)
+
+def _add_mapping(src_portspec, dest_portspec, options):
+    if src_portspec in src_to_svr:
+        # SO_REUSEPORT would otherwise let the same port be bound twice
+        raise socket.error(errno.EADDRINUSE, os.strerror(errno.EADDRINUSE))
+
+    server = make_server(src_portspec[Address.PROTOCOL], src_portspec, dest_portspec, options)
+    server.setup()
+
+def _del_mapping(src_portspec, drain):
+    server = src_to_svr[src_portspec]
+    server.destroy()
+    if drain and isinstance(server, TCPServer):
+        server.drain()
+
+def add_mapping(src_portspec, dest_portspec, options=None):
     """
     Adds a mapping from a source host and port to a destination host
     and port.
+
+    options is a dictionary which can override any of the DEFAULT_OPTIONS for
+    this mapping - for example, {'relay': Relay.SPLICE} moves the data of
+    TCP -> TCP connections with splice() rather than by copying it.
+
+    The mapping starts out with dest_portspec as its only destination - more
+    can be added with add_backend, and the balance option decides how
+    connections are spread over them.
     """
+    check_portspec(src_portspec)
+    check_portspec(dest_portspec)
     (src_host, src_port, src_proto) = src_portspec
     (dest_host, dest_port, dest_proto) = dest_portspec
     logger.debug("Added %s:%i (%s) -> %s:%i (%s) ...",
         src_host, src_port, Protocol.ToString[src_proto],
         dest_host, dest_port, Protocol.ToString[dest_proto])
     
-    with mapping_mod_lock:
-        server = make_server(src_proto, (src_host, src_port, src_proto), (dest_host, dest_port, dest_proto))
-        server.setup()
+    options = parse_options(options)
+    call_in_loop(_add_mapping, (src_host, src_port, src_proto),
+                 (dest_host, dest_port, dest_proto), options)
 
-def del_mapping(src_portspec):
+def del_mapping(src_portspec, drain=False):
     """
     Removes a mapping currently on a source host and port.
 
-    Note that this prevents incoming connections, but all existing connections
-    are kept alive. This means that there is effectively no way to remove a UDP socket.
+    Note that this prevents incoming connections, but all existing TCP
+    connections are kept alive - unless drain is True, in which case they stop
+    reading and are closed once the data they have already read is written.
+    UDP sessions are closed along with the server, since they share its socket.
     """
     (src_host, src_port, src_proto) = src_portspec
     logger.debug("Removed %s:%i (%s) ...", src_host, src_port, Protocol.ToString[src_proto])
-    with mapping_mod_lock:
-        server = src_to_svr[(src_host, src_port, src_proto)]
-        server.destroy()
+    call_in_loop(_del_mapping, (src_host, src_port, src_proto), drain)
+
+def _add_mappings(mappings, errors, atomic):
+    added = []
+    for index, (src_portspec, dest_portspec, options) in enumerate(mappings):
+        if errors[index] is not None:
+            continue
+
+        try:
+            _add_mapping(src_portspec, dest_portspec, options)
+            added.append(index)
+        except Exception as err:
+            # Whatever goes wrong, the rest of the batch (and the rollback of
+            # an atomic one) has to go ahead
+            errors[index] = err
+
+    if atomic and any(errors):
+        for index in added:
+            _del_mapping(mappings[index][0], False)
+    return settle_batch(errors, atomic)
+
+def add_mappings(mappings, atomic=False):
+    """
+    Adds many mappings at once, all in a single command on the forwarding
+    thread - mappings is a list of (src_portspec, dest_portspec, options)
+    triples, as add_mapping takes.
+
+    Returns a list with None for each mapping which was added, and the error
+    for each which wasn't. If atomic is True, then either every mapping is
+    added or none of them are.
+    """
+    logger.debug("Adding %i Mappings ...", len(mappings))
+    parsed = []
+    errors = []
+    for src_portspec, dest_portspec, options in mappings:
+        src_portspec, dest_portspec = tuple(src_portspec), tuple(dest_portspec)
+        try:
+            check_portspec(src_portspec)
+            check_portspec(dest_portspec)
+            options = parse_options(options)
+            errors.append(None)
+        except ValueError as err:
+            errors.append(err)
+        parsed.append((src_portspec, dest_portspec, options))
+
+    if atomic and any(errors):
+        return settle_batch(errors, atomic)
+    return call_in_loop(_add_mappings, parsed, errors, atomic)
+
+def _del_mappings(src_portspecs, drain, atomic):
+    errors = check_removals(src_portspecs, src_to_svr, atomic)
+    for src_portspec, err in zip(src_portspecs, errors):
+        if err is None:
+            _del_mapping(src_portspec, drain)
+    return errors
+
+def del_mappings(src_portspecs, drain=False, atomic=False):
+    """
+    Removes many mappings at once, like del_mapping does, in a single command
+    on the forwarding thread.
+
+    Returns a list with None for each mapping which was removed, and the error
+    for each which wasn't. If atomic is True, then either every mapping is
+    removed or none of them are.
+    """
+    logger.debug("Removing %i Mappings ...", len(src_portspecs))
+    return call_in_loop(_del_mappings, [tuple(src) for src in src_portspecs], drain, atomic)
+
+def _add_backend(src_portspec, dest_portspec):
+    server = src_to_svr[src_portspec]
+    if dest_portspec[Address.PROTOCOL] != server._dest_proto:
+        raise ValueError("Every destination of a mapping must use the same protocol")
+    server.add_backend(dest_portspec)
+
+def _del_backend(src_portspec, dest_portspec):
+    src_to_svr[src_portspec].del_backend(dest_portspec)
+
+def add_backend(src_portspec, dest_portspec):
+    """
+    Adds another destination to an existing mapping, which the mapping's
+    balancer can start sending new connections to right away.
+    """
+    check_portspec(dest_portspec)
+    logger.debug("Added Backend %s To %s ...",
+                 format_address(dest_portspec), format_address(src_portspec))
+    call_in_loop(_add_backend, tuple(src_portspec), tuple(dest_portspec))
+
+def del_backend(src_portspec, dest_portspec):
+    """
+    Removes a destination from a mapping. Connections which are already open to
+    it are kept alive, but no new ones are sent to it. A mapping always has to
+    have at least one destination, so removing the last one is a ValueError.
+    """
+    logger.debug("Removed Backend %s From %s ...",
+                 format_address(dest_portspec), format_address(src_portspec))
+    call_in_loop(_del_backend, tuple(src_portspec), tuple(dest_portspec))
+
+def _get_mappings():
+    return [(svr._src, dest, dict(svr._options)) for svr in src_to_svr.values()
+            for dest in svr._balancer.backends]
+
+def get_mappings():
+    """
+    Returns a list of (src_portspec, dest_portspec, options) for every mapping
+    - a mapping with several destinations appears once for each of them.
+    """
+    return call_in_loop(_get_mappings)
+
+def listen_overflows():
+    """
+    Returns how many connections the kernel has dropped because a listening
+    socket's accept queue was full, across the whole system, or None if the
+    kernel doesn't say.
+    """
+    try:
+        with open('/proc/net/netstat') as netstat:
+            lines = netstat.readlines()
+    except OSError:
+        return None
+
+    # Each group of counters is a line of names followed by a line of values
+    for names, values in zip(lines[::2], lines[1::2]):
+        if names.startswith('TcpExt:'):
+            counters = dict(zip(names.split()[1:], values.split()[1:]))
+            if 'ListenOverflows' in counters:
+                return int(counters['ListenOverflows'])
+    return None
+
+def _get_accept_stats():
+    return {svr._src: svr.accept_stats() for svr in src_to_svr.values()
+            if isinstance(svr, TCPServer)}
+
+def get_accept_stats():
+    """
+    Returns a dictionary with the accept counters of every TCP mapping (under
+    'mappings', keyed by source portspec) and the kernel's count of accept
+    queue overflows (under 'listen_overflows').
+    """
+    return {
+        'mappings': call_in_loop(_get_accept_stats),
+        'listen_overflows': listen_overflows(),
+    }
+
+# Map: handler function -> what profiles call the time spent in it
+HANDLER_KINDS = {
+    TCPServer.handle: 'accept',
+    TCPServer.finish_connect: 'connect',
+    TCPServer.warm_connected: 'warm',
+    TCPServer.warm_closed: 'warm',
+    handle_pair: 'transfer',
+    UDPServer.handle: 'udp',
+    UDPSession.handle: 'udp',
+    run_commands: 'commands',
+}
+
+def handler_kind(handler):
+    "Returns what kind of work a handler in the poller does"
+    func = getattr(handler, 'func', handler)
+    return HANDLER_KINDS.get(getattr(func, '__func__', func), 'other')
+
+def run_profiled(ready, polled):
+    """
+    Runs the handlers for a pass of the event loop and then its timers, like
+    start() does, recording how long each of them takes in the profile.
+    """
+    # A command run in this pass can turn profiling off
+    hists = profile
+    clock = time.perf_counter
+    hists['loop.wait_us'].record(int((loop_time - polled) * 1e6))
+    hists['loop.events'].record(len(ready))
+
+    for handler, events in ready:
+        kind = handler_kind(handler)
+        if kind == 'transfer':
+            conn, side = handler.args
+            received = conn.received[side]
+
+        started = clock()
+        handler(events)
+        hists['dispatch.' + kind + '_us'].record(int((clock() - started) * 1e6))
+
+        if kind == 'transfer':
+            hists['transfer.bytes'].record(conn.received[side] - received)
+
+    started = clock()
+    timers.advance(loop_time)
+    hists['loop.timers_us'].record(int((clock() - started) * 1e6))
+    hists['loop.busy_us'].record(int((time.monotonic() - loop_time) * 1e6))
+
+def schedule_lag_probe():
+    global lag_probe
+    deadline = loop_time + LAG_PROBE_INTERVAL
+    lag_probe = timers.schedule(deadline, probe_lag, timers.due(deadline))
+
+def probe_lag(due):
+    """
+    Records how long after it became due that the lag probe actually ran -
+    which is how long anything else waiting on the event loop would have had
+    to wait - and then schedules the next one.
+    """
+    profile['loop.lag_us'].record(int(max(0.0, time.monotonic() - due) * 1e6))
+    schedule_lag_probe()
+
+def _set_profiling(enabled):
+    global profile, lag_probe
+    if lag_probe is not None:
+        lag_probe.cancel()
+        lag_probe = None
+
+    if enabled:
+        profile = collections.defaultdict(histogram.Histogram)
+        schedule_lag_probe()
+    else:
+        profile = None
+
+def set_profiling(enabled):
+    """
+    Starts profiling the event loop, throwing away anything it has already
+    recorded, or stops profiling it.
+    """
+    call_in_loop(_set_profiling, enabled)
+
+def _get_profile():
+    if profile is None:
+        return {}
+    return {name: hist.snapshot() for name, hist in profile.items()}
+
+def get_profile():
+    """
+    Returns a snapshot (see histogram.Histogram.snapshot) of every histogram
+    recorded since profiling was started, keyed by name, or an empty
+    dictionary if the loop isn't being profiled. These are:
+
+    - loop.wait_us: How long each pass waited in the poller
+    - loop.busy_us: How long each pass spent handling events and timers
+    - loop.events: How many events each pass handled
+    - loop.timers_us: How long each pass spent running timers
+    - loop.lag_us: How late timers ran, which is how long anything waiting on
+      the loop has to wait on top of the time it asked for
+    - dispatch.<kind>_us: How long each handler call took, for each kind of
+      handler (accept, connect, transfer, warm, udp, commands, other)
+    - transfer.bytes: How many bytes each wakeup of a connection read
+    """
+    return call_in_loop(_get_profile)
+
+def mapping_labels(server):
+    "Returns the labels which the metrics of a mapping are exported with"
+    src = server._src
+    return {'mapping': '{}:{}:{}'.format(Protocol.ToString[src[Address.PROTOCOL]],
+                                         src[Address.HOST], src[Address.PORT])}
+
+def render_metrics():
+    """
+    Returns the metrics of every mapping, along with those of the whole
+    process, in the Prometheus text format.
+    """
+    tcp = [(mapping_labels(svr), svr) for svr in src_to_svr.values() if isinstance(svr, TCPServer)]
+    udp = [(mapping_labels(svr), svr) for svr in src_to_svr.values() if isinstance(svr, UDPServer)]
+
+    out = metrics.Exposition()
+    out.counter('portforward_received_bytes_total',
+                'Bytes received from clients (upstream) and from destinations (downstream).',
+                [(dict(labels, direction=direction), count)
+                 for labels, svr in tcp + udp
+                 for direction, count in zip(('upstream', 'downstream'), svr.received())])
+    out.counter('portforward_connections_accepted_total', 'TCP connections accepted.',
+                [(labels, svr._accepted) for labels, svr in tcp])
+    out.gauge('portforward_connections_active', 'TCP connections which are open.',
+              [(labels, len(svr._connections)) for labels, svr in tcp])
+    out.counter('portforward_connect_failures_total',
+                'TCP connections closed because their destination could not be reached.',
+                [(labels, svr._connect_failures) for labels, svr in tcp])
+    out.histogram('portforward_connect_latency_seconds',
+                  'How long TCP connections took to reach their destination after being accepted.',
+                  [(labels, svr._connect_latency.snapshot()) for labels, svr in tcp],
+                  scale=1e-6, buckets=CONNECT_LATENCY_BUCKETS)
+    out.counter('portforward_accept_queue_full_total',
+                'How many times a TCP mapping found its accept queue full.',
+                [(labels, svr._accept_queue_full) for labels, svr in tcp])
+    out.counter('portforward_out_of_fds_total',
+                'TCP connections closed because the process ran out of file descriptors.',
+                [(labels, svr._out_of_fds) for labels, svr in tcp])
+    out.gauge('portforward_udp_sessions_active', 'UDP client sessions which are open.',
+              [(labels, len(svr._sessions)) for labels, svr in udp])
+
+    overflows = listen_overflows()
+    if overflows is not None:
+        out.counter('portforward_listen_overflows_total',
+                    'Connections dropped by the kernel because an accept queue was full, system-wide.',
+                    [({}, overflows)])
+    out.counter('portforward_loop_passes_total', 'Passes made by the event loop.', [({}, passes)])
+    out.process()
+    return out.getvalue()
+
+def _start_metrics(address):
+    global metrics_server
+    if metrics_server is not None:
+        raise ValueError("The metrics are already being served")
+
+    server = MetricsServer(address)
+    try:
+        server.setup()
+    except OSError:
+        server._socket.close()
+        raise
+    metrics_server = server
+
+def start_metrics(port, host='127.0.0.1'):
+    """
+    Starts serving the metrics over HTTP, at /metrics on the given port. This
+    only listens on localhost unless another host is given.
+    """
+    call_in_loop(_start_metrics, (host, port))
 
 done = False
 def quit():
     global done
-    done = True
-    
+    with commands_lock:
+        done = True
+        if not commands_closed:
+            waker.wake()
+
 def start():
     """
     Runs a single iteration of the port forwarder, checking for new connections
     and handling reads and writes.
     """
 
-    while not done:
-        for fd in poll.poll(timeout=1):
-            if fd in fd_to_svr:
-                fd_to_svr[fd].connect()
-            else:
-                try:
-                    writer, reader = fd_to_pair[fd]
-                except KeyError:
-                    # Deal with epoll's empty sends (they are apparently kill messages delivered by epoll)
-                    continue
+    global loop_time, quantum, passes, done, commands_closed
 
-                do_send(reader, writer)
+    poll.register(waker, poller.READ, run_commands)
+    open_reserve()
+    try:
+        while not done:
+            polled = time.monotonic()
+            timeout = timers.next_timeout(polled, MAX_POLL_TIMEOUT)
+            ready = poll.poll(timeout=timeout)
 
-    for server in list(fd_to_svr.values()):
+            loop_time = time.monotonic()
+            passes += 1
+            quantum = max(FAIR_QUANTUM, PASS_BUDGET // max(len(ready), 1))
+            if profile is not None:
+                run_profiled(ready, polled)
+                continue
+
+            for handler, events in ready:
+                handler(events)
+
+            timers.advance(loop_time)
+    except Exception:
+        logger.exception("The Forwarding Thread Crashed")
+    finally:
+        # Whether the loop quit or crashed, anything posted from now on is
+        # never going to be run, and neither is anything still waiting
+        with commands_lock:
+            done = True
+            commands_closed = True
+            poll.unregister(waker)
+            waker.close()
+
+        while commands:
+            future, _, _ = commands.popleft()
+            if future is not None:
+                future.set_exception(RuntimeError("The forwarding thread has quit"))
+
+        shut_down()
+
+def shut_down():
+    "Closes every server and connection, once the forwarding thread is done"
+    for server in list(src_to_svr.values()):
         server.destroy()
+    if metrics_server is not None:
+        metrics_server.destroy()
+
+    for conn in set(connections):
+        if conn is not None:
+            conn.close()
 
-    for fd in fd_to_pair:
-        writer, _ = fd_to_pair[fd]
-        writer.close()
+    dns.close()
+    if reserve_fd is not None:
+        os.close(reserve_fd)
 
 thread = threading.Thread(target=start)
 thread.start()
@@ -25,6 +25,8 @@ from gi.repository import GObject
 import portforward
 import socket
 
+from mapping import format_options
+
 GObject.threads_init()
 
 def protocol_string_to_enum(portspec):
@@ -43,7 +45,20 @@ class PortRedirector(dbus.service.Object):
             portforward.add_mapping(protocol_string_to_enum(src), protocol_string_to_enum(dest))
             logger.debug("Done")
             return True
-        except socket.error as e:
+        except (socket.error, ValueError) as e:
+            logger.debug("Fail\n\t-%s", e)
+            return False
+
+    @dbus.service.method('org.new123456.Proxy',
+                         in_signature = '(sis)(sis)a{ss}',
+                         out_signature='b')
+    def AddMappingWithOptions(self, src, dest, options):
+        try:
+            portforward.add_mapping(protocol_string_to_enum(src), protocol_string_to_enum(dest),
+                                    {str(key): str(value) for key, value in options.items()})
+            logger.debug("Done")
+            return True
+        except (socket.error, ValueError) as e:
             logger.debug("Fail\n\t-%s", e)
             return False
 
@@ -59,19 +74,53 @@ class PortRedirector(dbus.service.Object):
             logger.debug("Fail")
             return False
 
+    @dbus.service.method('org.new123456.Proxy',
+                         in_signature = '(sis)(sis)',
+                         out_signature='b')
+    def AddBackend(self, src, dest):
+        try:
+            portforward.add_backend(protocol_string_to_enum(src), protocol_string_to_enum(dest))
+            logger.debug("Done")
+            return True
+        except (KeyError, ValueError) as e:
+            logger.debug("Fail\n\t-%s", e)
+            return False
+
+    @dbus.service.method('org.new123456.Proxy',
+                         in_signature = '(sis)(sis)',
+                         out_signature='b')
+    def RemoveBackend(self, src, dest):
+        try:
+            portforward.del_backend(protocol_string_to_enum(src), protocol_string_to_enum(dest))
+            logger.debug("Done")
+            return True
+        except (KeyError, ValueError) as e:
+            logger.debug("Fail\n\t-%s", e)
+            return False
+
     @dbus.service.method('org.new123456.Proxy',
                          in_signature='',
                          out_signature='a(sissis)')
     def ReadMappings(self):
         src_to_dest = []
-        for svr in portforward.src_to_svr.values():
-            src = svr._src
-            dest = svr._dest
+        for src, dest, _ in portforward.get_mappings():
             src_to_dest.append(
                     (src[0], src[1], portforward.Protocol.ToString[src[2]],
                      dest[0], dest[1], portforward.Protocol.ToString[dest[2]]))
         return src_to_dest
 
+    @dbus.service.method('org.new123456.Proxy',
+                         in_signature='',
+                         out_signature='a(sissisa{ss})')
+    def ReadMappingsWithOptions(self):
+        src_to_dest = []
+        for src, dest, options in portforward.get_mappings():
+            src_to_dest.append(
+                    (src[0], src[1], portforward.Protocol.ToString[src[2]],
+                     dest[0], dest[1], portforward.Protocol.ToString[dest[2]],
+                     format_options(options)))
+        return src_to_dest
+
     @dbus.service.method('org.new123456.Proxy', in_signature='', out_signature='')
     def Quit(self):
         Gtk.main_quit()
@@ -1,71 +1,394 @@
 """
 The service component for the port redirector.
 
-The service accepts connections through a Unix domain sockets.
+The service accepts connections through a Unix domain sockets. Any number of
+tools can be connected at once - the control socket is served by a
+non-blocking loop, which reads from each client into a buffer of its own and
+only carries out a request once all of it has arrived, so a slow or stuck
+tool can't hold up any of the others.
+
+With --journal, every change to the mappings is recorded in a file, and the
+mappings in it are all added back (in a single batch) when the service starts
+again.
 """
 
 import logging
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger('[' + __name__ + ']')
 
+import argparse
+import journal
 import os
+import selectors
 import socket
 import socketproto
 import sys
-import portforward
+import time
+
+from mapping import format_address, format_options
+
+parser = argparse.ArgumentParser(description='Runs the port forwarding service')
+parser.add_argument('--workers', type=int, default=1,
+                    help='The number of processes to forward connections with')
+parser.add_argument('--engine', choices=('portforward', 'asyncio'), default='portforward',
+                    help='The event loop to forward connections with')
+parser.add_argument('--control-socket', default='/tmp/.proxy-socket',
+                    help='The path of the Unix socket which the tool connects to')
+parser.add_argument('--log-level', choices=('DEBUG', 'INFO', 'WARNING', 'ERROR'), default='DEBUG',
+                    help='The least severe messages to log')
+parser.add_argument('--profile', action='store_true',
+                    help='Profile the event loop from the start (the tool can also turn this on)')
+parser.add_argument('--metrics-port', type=int,
+                    help='Serve metrics in the Prometheus text format at http://127.0.0.1:<port>/metrics '
+                         '(with several workers, each one uses the next port up)')
+parser.add_argument('--journal',
+                    help='A file to keep the mappings in, so that they are restored when the service restarts')
+args = parser.parse_args()
+
+logging.basicConfig(level=args.log_level)
+
+engine_name = {'portforward': 'portforward', 'asyncio': 'asyncforward'}[args.engine]
+
+# The workers have to be started before anything else, since they are forked
+# from this process
+if args.workers > 1:
+    import workers
+    engine = workers.WorkerPool(args.workers, engine_name)
+else:
+    import importlib
+    engine = importlib.import_module(engine_name)
+
+if args.profile:
+    try:
+        engine.set_profiling(True)
+    except ValueError as e:
+        engine.quit()
+        parser.error(str(e))
+
+if args.metrics_port is not None:
+    try:
+        engine.start_metrics(args.metrics_port)
+    except (OSError, ValueError) as e:
+        engine.quit()
+        parser.error("Unable to serve metrics: {}".format(e))
+
+mappings_journal = None
+if args.journal is not None:
+    mappings_journal = journal.Journal(args.journal)
+
+def record(change, *args):
+    """
+    Records a change to the mappings in the journal, if there is one. The
+    change has already been made, so failing to record it is only logged.
+    """
+    if mappings_journal is None:
+        return
+
+    try:
+        getattr(mappings_journal, change)(*args)
+    except OSError as e:
+        logger.error("Unable To Write To The Journal Because '%s'", e)
+
+def restore_mappings():
+    """
+    Adds back the mappings in the journal, all in a single batch so that the
+    engine creates their listeners in one go, and then starts the journal over
+    with just the mappings which could be restored.
+    """
+    started = time.monotonic()
+    saved = mappings_journal.load()
+    errors = engine.add_mappings([(src, dests[0], options) for src, dests, options in saved])
+
+    restored = []
+    for (src, dests, options), error in zip(saved, errors):
+        if error is not None:
+            logger.error("Unable To Restore %s Because '%s'", format_address(src), error)
+            continue
+
+        added = dests[:1]
+        for dest in dests[1:]:
+            try:
+                engine.add_backend(src, dest)
+                added.append(dest)
+            except (KeyError, ValueError) as e:
+                logger.error("Unable To Restore Backend %s Of %s Because '%s'",
+                             format_address(dest), format_address(src), e)
+        restored.append((src, added, options))
+
+    mappings_journal.reset(restored)
+    logger.info("Restored %i Of %i Mappings In %.3fs",
+                len(restored), len(saved), time.monotonic() - started)
+
+def format_results(errors):
+    "Turns the errors of a batch into the (ok, error) pairs of a Results message"
+    results = []
+    for error in errors:
+        if error is None:
+            results.append((True, ''))
+            continue
+
+        logger.debug("Fail\n\t-%s", error)
+        if isinstance(error, KeyError):
+            # Which has the portspec as its message, and nothing else
+            results.append((False, 'Not mapped'))
+        else:
+            results.append((False, str(error)))
+    return results
+
+# How many seconds a client can go without sending or reading anything before
+# it is disconnected - whether it is between requests, or stuck in the middle
+# of one
+CLIENT_TIMEOUT = 30.0
+
+# A client which has this many bytes of replies waiting for it isn't read from
+# until it has read some of them
+CLIENT_OUTPUT_LIMIT = 16 * 1024 * 1024
+
+# How many clients can be waiting to be accepted
+CONTROL_BACKLOG = 128
+
+class Quit(Exception):
+    "Raised by handle_message when a client tells the service to quit"
+
+def handle_message(msgtype, params):
+    """
+    Carries out a single request from a client, and returns the reply to send
+    back (which is None for requests without one).
+    """
+    if msgtype == socketproto.Messages.AddProxy:
+        src, dest, options = params
+        try:
+            engine.add_mapping(src, dest, options)
+            record('add', [(src, dest, options)])
+            logger.debug("Done")
+            return True
+        except (socket.error, ValueError) as e:
+            logger.debug("Fail\n\t-%s", e)
+            return False
+
+    elif msgtype == socketproto.Messages.DelProxy:
+        src = params
+        try:
+            engine.del_mapping(src)
+            record('remove', [src])
+            logger.debug("Done")
+            return True
+        except KeyError:
+            logger.debug("Fail")
+            return False
+
+    elif msgtype == socketproto.Messages.AddProxies:
+        mappings, atomic = params
+        errors = engine.add_mappings(mappings, atomic)
+        record('add', [mapping for mapping, error in zip(mappings, errors) if error is None])
+        logger.debug("Added %i Of %i Mappings", errors.count(None), len(errors))
+        return (socketproto.Messages.Results, format_results(errors))
+
+    elif msgtype == socketproto.Messages.DelProxies:
+        srcs, atomic = params
+        errors = engine.del_mappings(srcs, atomic=atomic)
+        record('remove', [src for src, error in zip(srcs, errors) if error is None])
+        logger.debug("Removed %i Of %i Mappings", errors.count(None), len(errors))
+        return (socketproto.Messages.Results, format_results(errors))
+
+    elif msgtype == socketproto.Messages.AddBackend:
+        src, dest = params
+        try:
+            engine.add_backend(src, dest)
+            record('add_backend', src, dest)
+            logger.debug("Done")
+            return True
+        except (KeyError, ValueError) as e:
+            logger.debug("Fail\n\t-%s", e)
+            return False
+
+    elif msgtype == socketproto.Messages.DelBackend:
+        src, dest = params
+        try:
+            engine.del_backend(src, dest)
+            record('del_backend', src, dest)
+            logger.debug("Done")
+            return True
+        except (KeyError, ValueError) as e:
+            logger.debug("Fail\n\t-%s", e)
+            return False
+
+    elif msgtype == socketproto.Messages.GetProxies:
+        proxies = [(src, dest, format_options(options))
+                   for src, dest, options in engine.get_mappings()]
+        return (socketproto.Messages.GetProxies, proxies)
+    elif msgtype == socketproto.Messages.SetProfiling:
+        try:
+            engine.set_profiling(params)
+            logger.debug("Done")
+            return True
+        except ValueError as e:
+            logger.debug("Fail\n\t-%s", e)
+            return False
+
+    elif msgtype == socketproto.Messages.GetProfile:
+        return (socketproto.Messages.GetProfile, engine.get_profile())
+    elif msgtype == socketproto.Messages.Quit:
+        raise Quit()
+    return None
+
+def failure_reply(msgtype, params, error):
+    "Returns the reply to a request which failed with an unexpected error"
+    if msgtype in (socketproto.Messages.AddProxies, socketproto.Messages.DelProxies):
+        mappings, _ = params
+        return (socketproto.Messages.Results, [(False, str(error))] * len(mappings))
+    return False
+
+class ControlClient:
+    """
+    A tool connected to the control socket, which can send as many requests
+    as it likes. Requests are read into the client's Reader until a whole one
+    has arrived, and replies are queued up and written as the socket takes
+    them, so nothing ever waits on the client.
+    """
+    def __init__(self, sock):
+        self.socket = sock
+        self.socket.setblocking(0)
+        self.reader = socketproto.Reader(sock)
+        self.output = bytearray()
+        self.closing = False
+        self.touch()
+
+    def touch(self):
+        "Puts off the client's timeout, since it has just done something"
+        self.deadline = time.monotonic() + CLIENT_TIMEOUT
+
+    def events(self):
+        "Returns what the selector should wait on the client for"
+        events = 0
+        if not self.closing and len(self.output) < CLIENT_OUTPUT_LIMIT:
+            events |= selectors.EVENT_READ
+        if self.output:
+            events |= selectors.EVENT_WRITE
+        return events
+
+    def read(self):
+        """
+        Reads whatever the client has sent, and carries out every request
+        which has all arrived. Raises Quit if one of them was a Quit.
+        """
+        if not self.reader.fill():
+            # The client is done, although it may still be waiting for replies
+            self.closing = True
+        self.touch()
+
+        while True:
+            msg = self.reader.next_message()
+            if msg is None:
+                return
+
+            # Go ahead and assume a command, since the client
+            # will never send a lone True/False
+            msgtype, params = msg
+            try:
+                reply = handle_message(msgtype, params)
+            except Quit:
+                raise
+            except Exception as e:
+                # A bug in the service shouldn't take all of it down, and the
+                # client is still owed a reply
+                logger.exception("Unable To Carry Out A Request")
+                reply = failure_reply(msgtype, params, e)
+            if reply is not None:
+                self.output += socketproto.encode_message(reply)
+
+    def write(self):
+        "Writes as much of the waiting replies as the client will take"
+        sent = self.socket.send(self.output)
+        del self.output[:sent]
+        self.touch()
+
+def serve(server):
+    """
+    Serves every client of the control socket until one of them sends a
+    Quit message.
+    """
+    selector = selectors.DefaultSelector()
+    selector.register(server, selectors.EVENT_READ)
+    clients = set()
+
+    def close(client):
+        selector.unregister(client.socket)
+        client.socket.close()
+        clients.discard(client)
+
+    try:
+        while True:
+            now = time.monotonic()
+            for client in [client for client in clients if client.deadline <= now]:
+                logger.error("Disconnecting A Client Which Was Quiet For %.0fs", CLIENT_TIMEOUT)
+                close(client)
+
+            timeout = min([client.deadline for client in clients], default=now + CLIENT_TIMEOUT) - now
+            for key, events in selector.select(max(timeout, 0)):
+                if key.fileobj is server:
+                    try:
+                        sock, _ = server.accept()
+                    except (BlockingIOError, InterruptedError):
+                        continue
+                    except OSError as e:
+                        logger.error("Unable To Accept A Client Because '%s'", e)
+                        continue
+
+                    client = ControlClient(sock)
+                    clients.add(client)
+                    selector.register(sock, client.events(), client)
+                    continue
+
+                client = key.data
+                if client not in clients:
+                    # Closed by an earlier event in the same batch
+                    continue
+
+                try:
+                    if events & selectors.EVENT_READ:
+                        client.read()
+                    if client.output and events & selectors.EVENT_WRITE:
+                        client.write()
+                except BlockingIOError:
+                    pass
+                except (OSError, ValueError) as e:
+                    # A ValueError is most likely a tool from before the
+                    # protocol had versions
+                    logger.error("Disconnecting A Client Because '%s'", e)
+                    close(client)
+                    continue
+
+                if client.closing and not client.output:
+                    close(client)
+                elif client.events() != key.events:
+                    selector.modify(client.socket, client.events(), client)
+    finally:
+        for client in list(clients):
+            close(client)
+        selector.close()
 
 server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
 
 try:
-    server.bind('/tmp/.proxy-socket')
+    server.bind(args.control_socket)
 except OSError:
     logger.error("Could not bind to proxy socket - is another instance running?")
     sys.exit(1)
-server.listen(1)
+server.setblocking(0)
 
 try:
-    while True:
-        client, _ = server.accept()
+    # The mappings are restored before the tools can connect, so that they
+    # never see the service half restored
+    if mappings_journal is not None:
+        restore_mappings()
 
-        # Go ahead and assume a command, since the client
-        # will never send a lone True/False
-        msgtype, params = socketproto.read_message(client)
-
-        if msgtype == socketproto.Messages.AddProxy:
-            src, dest = params
-            try:
-                portforward.add_mapping(src, dest)
-                socketproto.write_message(client, True)
-                logger.debug("Done")
-            except socket.error as e:
-                socketproto.write_message(client, False)
-                logger.debug("Fail\n\t-%s", e)
-
-        elif msgtype == socketproto.Messages.DelProxy:
-            src = params
-            try:
-                portforward.del_mapping(src)
-                socketproto.write_message(client, True)
-                logger.debug("Done")
-            except KeyError:
-                socketproto.write_message(client, False)
-                logger.debug("Fail")
-
-        elif msgtype == socketproto.Messages.GetProxies:
-            src_to_dest = []
-            for svr in portforward.src_to_svr.values():
-                src = svr._src
-                dest = svr._dest
-                src_to_dest.append((src, dest))
-
-            socketproto.write_message(client, 
-                    (socketproto.Messages.GetProxies, src_to_dest))
-        elif msgtype == socketproto.Messages.Quit:
-            break
-
-        client.close()
-        
+    server.listen(CONTROL_BACKLOG)
+    serve(server)
+except Quit:
+    pass
 finally:
     server.close()
-    os.remove('/tmp/.proxy-socket')
-    portforward.quit()
+    os.remove(args.control_socket)
+    if mappings_journal is not None:
+        mappings_journal.close()
+    engine.quit()
@@ -1,5 +1,5 @@
 #!/usr/bin/python2
-"""Usage: port-tool <add|del|list|quit|help> ...
+"""Usage: port-tool <add|del|add-backend|del-backend|list|quit|help> ...
 
 Note that all <src> and <dest> are in terms of a portspec, which looks like:
   <proto>:<host>:<port>
@@ -7,9 +7,15 @@ Example:
     TCP:www.google.com:80 or
     UDP:www.streamcast.example.com:1776
 
-add <src> <dest>: Adds a mapping between the source and destionation given
+add <src> <dest> [<option>=<value> ...]: Adds a mapping between the source and
+  destionation given. Options tune the mapping, for example:
+    nodelay=true rcvbuf=262144 keepalive=true keepidle=30 tos=0x10
 del <src>: Removes the mapping which is associated with the source given.
-list: Gets all of the mappings on the system.
+add-backend <src> <dest>: Adds another destination to the mapping on the source
+  given - new connections are spread over all of a mapping's destinations.
+del-backend <src> <dest>: Stops sending new connections to a destination of
+  the mapping on the source given (existing connections stay open).
+list: Gets all of the mappings on the system, along with their options.
 quit: Terminates the proxy server.
 help: Prints this screen
 """
@@ -22,13 +28,14 @@ def portspec(arg):
     return (host, int(port), proto)
 
 try:
-    if sys.argv[1] not in ('add', 'del', 'list', 'quit'):
+    if sys.argv[1] not in ('add', 'del', 'add-backend', 'del-backend', 'list', 'quit'):
         print(__doc__)
         sys.exit(1)
 
-    if sys.argv[1] == 'add':
+    if sys.argv[1] in ('add', 'add-backend', 'del-backend'):
         src = portspec(sys.argv[2])
         dest = portspec(sys.argv[3])
+        options = dict(arg.split("=", 1) for arg in sys.argv[4:])
     elif sys.argv[1] == 'del':
         src = portspec(sys.argv[2])
 except (IndexError, ValueError):
@@ -43,15 +50,24 @@ obj = bus.get_object(BUS, OBJ)
 proxy = dbus.Interface(obj, BUS)
 
 if sys.argv[1] == 'add':
-    if not proxy.AddMapping(src, dest):
+    if not proxy.AddMappingWithOptions(src, dest, options):
         print('[Unable to map port - is it taken already?]')
         sys.exit(1)
 elif sys.argv[1] == 'del':
     if not proxy.RemoveMapping(src):
         print('[Unable to unmap port - does it have a proxy?]')
         sys.exit(1)
+elif sys.argv[1] == 'add-backend':
+    if not proxy.AddBackend(src, dest):
+        print('[Unable to add backend - is the port mapped, and is the backend new?]')
+        sys.exit(1)
+elif sys.argv[1] == 'del-backend':
+    if not proxy.RemoveBackend(src, dest):
+        print('[Unable to remove backend - is it the last one?]')
+        sys.exit(1)
 elif sys.argv[1] == 'list':
-    for (srchost, srcport, srcproto, desthost, destport, destproto) in proxy.ReadMappings():
-        print('{}:{} ({}) -> {}:{} ({})'.format(srchost, srcport, srcproto, desthost, destport, destproto))
+    for (srchost, srcport, srcproto, desthost, destport, destproto, options) in proxy.ReadMappingsWithOptions():
+        print('{}:{} ({}) -> {}:{} ({}){}'.format(srchost, srcport, srcproto, desthost, destport, destproto,
+              ''.join(' {}={}'.format(key, value) for key, value in sorted(options.items()))))
 elif sys.argv[1] == 'quit':
     proxy.Quit()
@@ -1,5 +1,5 @@
 #!/usr/bin/python2
-"""Usage: port-tool <add|del|list|quit|help> ...
+"""Usage: port-tool <add|del|add-backend|del-backend|list|profile|quit|help> ...
 
 Note that all <src> and <dest> are in terms of a portspec, which looks like:
   <proto>:<host>:<port>
@@ -8,13 +8,29 @@ Example:
 or
     UDP:www.streaming.example.com:9100
 
-add <src> <dest>: Adds a mapping between the source and destionation given.
+add <src> <dest> [<option>=<value> ...]: Adds a mapping between the source and
+  destionation given. Options tune the mapping, for example:
+    nodelay=true rcvbuf=262144 keepalive=true keepidle=30 tos=0x10
 del <src>: Removes the mapping which is associated with the source given.
-list: Gets all of the mappings on the system.
+add -f <file> [--atomic]: Adds every mapping in a file, which has one mapping
+  per line in the same form as add takes (<src> <dest> [<option>=<value> ...]).
+  Blank lines and lines starting with # are skipped. With --atomic, either all
+  of the mappings are added or none of them are.
+del -f <file> [--atomic]: Removes the mapping on the source at the start of
+  each line in a file (so the same file can be given to add -f and del -f).
+add-backend <src> <dest>: Adds another destination to the mapping on the source
+  given - new connections are spread over all of a mapping's destinations.
+del-backend <src> <dest>: Stops sending new connections to a destination of
+  the mapping on the source given (existing connections stay open).
+list: Gets all of the mappings on the system, along with their options.
+profile <on|off|show>: Starts or stops profiling the server's event loop, or
+  shows what it has recorded - how long passes of the loop and each kind of
+  handler take, how late timers run, and how much each wakeup reads.
 quit: Terminates the proxy server.
 help: Prints this screen
 """
 
+import histogram
 import socket
 import socketproto
 import sys
@@ -35,16 +51,84 @@ def portspec(arg):
         print(__doc__)
         sys.exit(1)
 
+def option(arg):
+    try:
+        key, value = arg.split("=", 1)
+    except ValueError:
+        print(__doc__)
+        sys.exit(1)
+    return (key, value)
+
+def read_mappings(path):
+    """
+    Reads the mappings out of a file given to add -f or del -f, as a list of
+    (src, dest, options) triples - dest is None on lines which only have a
+    source.
+    """
+    mappings = []
+    try:
+        with open(path) as mapping_file:
+            lines = mapping_file.readlines()
+    except OSError as e:
+        print('[Unable to read {}: {}]'.format(path, e))
+        sys.exit(1)
+
+    for number, line in enumerate(lines, 1):
+        fields = line.split()
+        if not fields or fields[0].startswith('#'):
+            continue
+
+        try:
+            src = portspec(fields[0])
+            dest = portspec(fields[1]) if len(fields) > 1 else None
+            options = dict(option(arg) for arg in fields[2:])
+        except SystemExit:
+            print('[Line {} of {} is not a mapping]'.format(number, path))
+            raise
+        mappings.append((src, dest, options))
+    return mappings
+
+def print_failures(verb, srcs, results):
+    "Prints out the mappings of a batch which failed, and exits if there were any"
+    failures = 0
+    for (host, port, proto), (ok, error) in zip(srcs, results):
+        if not ok:
+            failures += 1
+            print('[Unable to {} {}:{}:{} - {}]'.format(verb, tostring[proto], host, port, error))
+
+    if failures:
+        print('[{} of {} mappings failed]'.format(failures, len(results)))
+        sys.exit(1)
+
+tostring = {
+    socket.SOCK_STREAM: 'TCP',
+    socket.SOCK_DGRAM: 'UDP',
+}
+
 try:
-    if sys.argv[1] not in ('add', 'del', 'list', 'quit'):
+    if sys.argv[1] not in ('add', 'del', 'add-backend', 'del-backend', 'list', 'profile', 'quit'):
         print(__doc__)
         sys.exit(1)
 
-    if sys.argv[1] == 'add':
+    if sys.argv[1] in ('add', 'del') and sys.argv[2] == '-f':
+        mappings = read_mappings(sys.argv[3])
+        if sys.argv[4:] not in ([], ['--atomic']):
+            print(__doc__)
+            sys.exit(1)
+        atomic = sys.argv[4:] == ['--atomic']
+        if sys.argv[1] == 'add' and any(dest is None for src, dest, options in mappings):
+            print('[Every line given to add -f needs a destination]')
+            sys.exit(1)
+    elif sys.argv[1] in ('add', 'add-backend', 'del-backend'):
         src = portspec(sys.argv[2])
         dest = portspec(sys.argv[3])
+        options = dict(option(arg) for arg in sys.argv[4:])
     elif sys.argv[1] == 'del':
         src = portspec(sys.argv[2])
+    elif sys.argv[1] == 'profile':
+        if sys.argv[2] not in ('on', 'off', 'show'):
+            print(__doc__)
+            sys.exit(1)
 except IndexError:
     print(__doc__)
     sys.exit(1)
@@ -52,10 +136,23 @@ except IndexError:
 client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
 client.connect("/tmp/.proxy-socket")
 
-if sys.argv[1] == 'add':
-    socketproto.write_message(client, (socketproto.Messages.AddProxy, (src, dest)))
+if sys.argv[1] in ('add', 'del') and sys.argv[2] == '-f':
+    srcs = [src for src, dest, options in mappings]
+    if sys.argv[1] == 'add':
+        socketproto.write_message(client, (socketproto.Messages.AddProxies, (mappings, atomic)))
+    else:
+        socketproto.write_message(client, (socketproto.Messages.DelProxies, (srcs, atomic)))
+
+    msg, results = socketproto.read_message(client)
+    if msg != socketproto.Messages.Results:
+        print('[Protocol error]')
+        sys.exit(1)
+    print_failures({'add': 'map', 'del': 'unmap'}[sys.argv[1]], srcs, results)
+
+elif sys.argv[1] == 'add':
+    socketproto.write_message(client, (socketproto.Messages.AddProxy, (src, dest, options)))
     if socketproto.read_message(client) is not True:
-        print('[Unable to map port - is it taken already?]')
+        print('[Unable to map port - is it taken already, or are the options wrong?]')
         sys.exit(1)
 
 elif sys.argv[1] == 'del':
@@ -64,6 +161,18 @@ elif sys.argv[1] == 'del':
         print('[Unable to unmap port - does it have a proxy?]')
         sys.exit(1)
 
+elif sys.argv[1] == 'add-backend':
+    socketproto.write_message(client, (socketproto.Messages.AddBackend, (src, dest)))
+    if socketproto.read_message(client) is not True:
+        print('[Unable to add backend - is the port mapped, and is the backend new?]')
+        sys.exit(1)
+
+elif sys.argv[1] == 'del-backend':
+    socketproto.write_message(client, (socketproto.Messages.DelBackend, (src, dest)))
+    if socketproto.read_message(client) is not True:
+        print('[Unable to remove backend - is it the last one?]')
+        sys.exit(1)
+
 elif sys.argv[1] == 'list':
     socketproto.write_message(client, (socketproto.Messages.GetProxies, []))
     msg, proxies = socketproto.read_message(client)
@@ -71,13 +180,31 @@ elif sys.argv[1] == 'list':
         print('[Protocol error]')
         sys.exit(1)
 
-    tostring = {
-        socket.SOCK_STREAM: 'TCP',
-        socket.SOCK_DGRAM: 'UDP',
-    }
+    for ((srchost, srcport, srcproto), (desthost, destport, destproto), options) in proxies:
+        print('{}:{} ({}) -> {}:{} ({}){}'.format(srchost, srcport, tostring[srcproto], desthost, destport, tostring[destproto],
+              ''.join(' {}={}'.format(key, value) for key, value in sorted(options.items()))))
+
+elif sys.argv[1] == 'profile' and sys.argv[2] == 'show':
+    socketproto.write_message(client, (socketproto.Messages.GetProfile, {}))
+    msg, profile = socketproto.read_message(client)
+    if msg != socketproto.Messages.GetProfile:
+        print('[Protocol error]')
+        sys.exit(1)
+    elif not profile:
+        print('[Nothing recorded - is profiling on?]')
+        sys.exit(1)
+
+    for name, snapshot in sorted(profile.items()):
+        print('{}: count={} mean={:.1f} p50={} p99={} max={}'.format(
+              name, snapshot['count'], snapshot['sum'] / max(snapshot['count'], 1),
+              histogram.percentile(snapshot, 0.5), histogram.percentile(snapshot, 0.99),
+              snapshot['max']))
 
-    for ((srchost, srcport, srcproto), (desthost, destport, destproto)) in proxies:
-        print('{}:{} ({}) -> {}:{} ({})'.format(srchost, srcport, tostring[srcproto], desthost, destport, tostring[destproto]))
+elif sys.argv[1] == 'profile':
+    socketproto.write_message(client, (socketproto.Messages.SetProfiling, sys.argv[2] == 'on'))
+    if socketproto.read_message(client) is not True:
+        print('[Unable to change profiling - does the engine support it?]')
+        sys.exit(1)
 
 elif sys.argv[1] == 'quit':
     socketproto.write_message(client, (socketproto.Messages.Quit, []))
@@ -0,0 +1,140 @@
+"""
+Looks up destination hostnames without blocking the forwarding thread.
+
+getaddrinfo() takes as long as the system's resolver wants it to, so lookups
+are run on a small pool of threads, and their results are handed back through
+a deliver function - deliver(func, *args) has to arrange for func(*args) to be
+called on the forwarding thread.
+
+Results are cached for TTL seconds, and failures are cached for NEGATIVE_TTL
+seconds so that a name which doesn't resolve can't flood the resolver. Names
+which are still in use are looked up again shortly before their entries
+expire, so that a busy mapping never has to wait on a lookup after the first.
+
+Everything except the lookups themselves happens on the forwarding thread.
+"""
+
+import concurrent.futures
+import logging
+import socket
+import time
+
+logger = logging.getLogger('[' + __name__ + ']')
+
+# How many lookups can be running at once
+WORKERS = 4
+
+# How many seconds a lookup is cached for, if it worked
+TTL = 60.0
+
+# How many seconds a lookup is cached for, if it failed
+NEGATIVE_TTL = 5.0
+
+# How far through its TTL an entry can get before using it starts a new lookup
+REFRESH_AHEAD = 0.8
+
+def is_address(host):
+    "Returns True if the host is an IPv4 address rather than a name"
+    try:
+        socket.inet_pton(socket.AF_INET, host)
+        return True
+    except OSError:
+        return False
+
+def getaddrinfo_resolve(host):
+    "Looks up the first IPv4 address of a host, using the system's resolver"
+    infos = socket.getaddrinfo(host, None, socket.AF_INET, socket.SOCK_STREAM)
+    return infos[0][4][0]
+
+class Entry:
+    "The cached result of a lookup, which is either an address or an error"
+    def __init__(self, address, error, now, ttl):
+        self.address = address
+        self.error = error
+        self.expires = now + ttl
+        self.refresh_at = now + ttl * REFRESH_AHEAD
+
+class Resolver:
+    """
+    A cache of hostname lookups. The resolve function does the actual lookups
+    (on a worker thread), and can be swapped out for a stub when testing - it
+    takes a hostname and returns an address, or raises an exception.
+    """
+    def __init__(self, deliver, resolve=getaddrinfo_resolve, ttl=TTL,
+                 negative_ttl=NEGATIVE_TTL, clock=time.monotonic, workers=WORKERS):
+        self._deliver = deliver
+        self._resolve = resolve
+        self._ttl = ttl
+        self._negative_ttl = negative_ttl
+        self._clock = clock
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='resolver')
+
+        # Map: host -> Entry
+        self._cache = {}
+
+        # Map: host -> [callback, ...]
+        # The lookups which are running, and who is waiting on each of them
+        self._waiting = {}
+
+    def resolve(self, host, callback):
+        """
+        Calls callback(address, error) once the address of the host is known,
+        where error is None if the lookup worked. The callback is called
+        straight away if the answer is cached (or the host is already an
+        address), and otherwise when the lookup finishes.
+        """
+        if is_address(host):
+            callback(host, None)
+            return
+
+        now = self._clock()
+        entry = self._cache.get(host)
+        if entry is not None and now < entry.expires:
+            if entry.error is None and now >= entry.refresh_at:
+                self._lookup(host)
+            callback(entry.address, entry.error)
+        else:
+            self._lookup(host).append(callback)
+
+    def _lookup(self, host):
+        "Starts looking up a host, unless it already is, and returns its waiters"
+        if host not in self._waiting:
+            logger.debug("Looking Up %s", host)
+            self._waiting[host] = []
+            self._executor.submit(self._run, host)
+        return self._waiting[host]
+
+    def _run(self, host):
+        "Does a lookup on a worker thread, and sends back what it found"
+        try:
+            address, error = self._resolve(host), None
+        except Exception as err:
+            # Not just OSErrors - names with overlong labels make getaddrinfo()
+            # raise a UnicodeError, and the waiters have to hear about that too
+            address, error = None, err
+        self._deliver(self._finish, host, address, error)
+
+    def _finish(self, host, address, error):
+        "Caches the result of a lookup, and passes it on to everyone waiting"
+        now = self._clock()
+        waiting = self._waiting.pop(host)
+        entry = self._cache.get(host)
+
+        if error is not None:
+            logger.debug("Unable To Resolve %s Because '%s'", host, error)
+
+        if (error is not None and entry is not None and entry.error is None and
+                now < entry.expires):
+            # A refresh failing shouldn't throw out an answer which is still good
+            pass
+        else:
+            ttl = self._ttl if error is None else self._negative_ttl
+            entry = self._cache[host] = Entry(address, error, now, ttl)
+
+        for callback in waiting:
+            callback(entry.address, entry.error)
+
+    def close(self):
+        "Stops the worker threads, abandoning any lookups which haven't started"
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -1,3 +1,18 @@
+"""
+The protocol which the tool and the service speak over the Unix socket.
+
+Each message is sent as a frame - a version byte, the length of the rest of the
+frame, and then the message itself, which starts with its type. A message is
+packed into a single buffer and sent with one sendall(), and a frame is only
+decoded once all of it has arrived, so neither side has to care how the
+socket splits it up.
+
+The version byte is well away from the message types, which is what the first
+byte of a message was before there were frames, so that a tool or service
+from before then is turned away with an error instead of being misread.
+"""
+
+import functools
 import struct
 
 class Messages:
@@ -5,40 +20,262 @@ class Messages:
     All messages that can be sent down the socket.
     """
     AddProxy, DelProxy, GetProxies, Quit, Success, Failure = list(range(2, 8))
+    AddBackend, DelBackend = list(range(8, 10))
+    SetProfiling, GetProfile = list(range(10, 12))
+    AddProxies, DelProxies, Results = list(range(12, 15))
+
+VERSION = 0x81
+
+# The version byte and the length of the rest of the frame
+HEADER = struct.Struct("=BI")
 
-def read_host_port_proto(socket):
+# Anything longer than this is taken to be garbage, rather than allocated
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+# How much a Reader receives at once
+READ_SIZE = 65536
+
+# Everything is packed with standard sizes and no alignment, so that fields can
+# be packed together (see string_struct)
+BYTE = struct.Struct("=B")
+UINT = struct.Struct("=I")
+PORT_PROTO = struct.Struct("=II")
+HISTOGRAM = struct.Struct("=QQQI")
+BUCKET = struct.Struct("=QQ")
+
+@functools.lru_cache(maxsize=1024)
+def string_struct(*sizes):
     """
-    Reads a single host-port-proto triple off the socket.
+    Returns a Struct for packing length-prefixed strings of the given sizes
+    one after another - packing a whole portspec or option in one call, rather
+    than a call per field, is what keeps big messages quick to encode.
     """
-    unpacking_recv = lambda sz, fmt: struct.unpack(fmt, socket.recv(sz))[0]
-    host_sz = unpacking_recv(4, "@I")
-    host = socket.recv(host_sz).decode('utf-8')
-    port = unpacking_recv(4, "@I")
-    proto = unpacking_recv(4, "@I")
-    return (host, port, proto)
+    return struct.Struct("=" + "".join("I{}s".format(size) for size in sizes))
 
-def read_message(socket):
+@functools.lru_cache(maxsize=1024)
+def portspec_struct(size):
+    "Returns a Struct for packing a host-port-proto triple with a host of the given size"
+    return struct.Struct("=I{}sII".format(size))
+
+class Encoder:
+    """
+    Packs a message into a buffer, which starts out with room for the header
+    and grows as needed.
+    """
+    def __init__(self):
+        self.buffer = bytearray(4096)
+        self.size = HEADER.size
+
+    def pack(self, packer, *values):
+        end = self.size + packer.size
+        if end > len(self.buffer):
+            self.buffer.extend(bytes(max(len(self.buffer), packer.size)))
+        packer.pack_into(self.buffer, self.size, *values)
+        self.size = end
+
+    def string(self, string):
+        "Packs a single length-prefixed string"
+        data = bytes(string, 'utf-8')
+        self.pack(string_struct(len(data)), len(data), data)
+
+    def options(self, options):
+        """
+        Packs a dictionary of mapping options. The values are sent as strings,
+        and converted back by the service.
+        """
+        self.pack(UINT, len(options))
+        for key, value in options.items():
+            key = bytes(key, 'utf-8')
+            value = bytes(str(value), 'utf-8')
+            self.pack(string_struct(len(key), len(value)), len(key), key, len(value), value)
+
+    def host_port_proto(self, portspec):
+        "Packs a single host-port-proto triple"
+        host = bytes(portspec[0], 'utf-8')
+        self.pack(portspec_struct(len(host)), len(host), host, portspec[1], portspec[2])
+
+    def histogram(self, snapshot):
+        "Packs a single histogram snapshot (see histogram.Histogram.snapshot)"
+        self.pack(HISTOGRAM, snapshot['count'], snapshot['sum'], snapshot['max'],
+                  len(snapshot['buckets']))
+        for bound, count in snapshot['buckets']:
+            self.pack(BUCKET, bound, count)
+
+    def frame(self):
+        "Fills in the header, and returns the whole frame"
+        HEADER.pack_into(self.buffer, 0, VERSION, self.size - HEADER.size)
+        return memoryview(self.buffer)[:self.size]
+
+class Decoder:
+    """
+    Unpacks a message from the body of a frame. Running off the end of the
+    frame raises a struct.error, which decode_message turns into a ValueError.
+    """
+    def __init__(self, data):
+        self._data = data
+        self._offset = 0
+
+    def unpack(self, unpacker):
+        values = unpacker.unpack_from(self._data, self._offset)
+        self._offset += unpacker.size
+        return values
+
+    def uint(self):
+        return self.unpack(UINT)[0]
+
+    def string(self):
+        "Unpacks a single length-prefixed string"
+        data = self._data
+        start = self._offset + UINT.size
+        end = start + UINT.unpack_from(data, self._offset)[0]
+        if end > len(data):
+            raise struct.error("A string runs past the end of its frame")
+
+        self._offset = end
+        return str(data[start:end], 'utf-8')
+
+    def options(self):
+        """
+        Unpacks a dictionary of mapping options, where both the keys and the
+        values are strings.
+        """
+        options = {}
+        for x in range(self.uint()):
+            key = self.string()
+            options[key] = self.string()
+        return options
+
+    def host_port_proto(self):
+        "Unpacks a single host-port-proto triple"
+        host = self.string()
+        port, proto = PORT_PROTO.unpack_from(self._data, self._offset)
+        self._offset += PORT_PROTO.size
+        return (host, port, proto)
+
+    def histogram(self):
+        "Unpacks a single histogram snapshot"
+        count, total, maximum, num_buckets = self.unpack(HISTOGRAM)
+        buckets = [self.unpack(BUCKET) for x in range(num_buckets)]
+        return {'count': count, 'sum': total, 'max': maximum, 'buckets': buckets}
+
+def encode_message(msg):
+    """
+    Packs a message into a frame - a message is either a tuple of
+    (MessageType, Params), or a boolean for a success/fail message.
+    """
+    encoder = Encoder()
+    if type(msg) == bool and msg in (True, False):
+        encoder.pack(BYTE, msg)
+        return encoder.frame()
+
+    msgtype, params = msg
+    encoder.pack(BYTE, msgtype)
+    if msgtype == Messages.AddProxy:
+        encoder.host_port_proto(params[0])
+        encoder.host_port_proto(params[1])
+        encoder.options(params[2] if len(params) > 2 else {})
+    elif msgtype in (Messages.AddBackend, Messages.DelBackend):
+        encoder.host_port_proto(params[0])
+        encoder.host_port_proto(params[1])
+    elif msgtype == Messages.DelProxy:
+        encoder.host_port_proto(params)
+    elif msgtype == Messages.GetProxies:
+        encoder.pack(UINT, len(params))
+        for param in params:
+            encoder.host_port_proto(param[0])
+            encoder.host_port_proto(param[1])
+            encoder.options(param[2] if len(param) > 2 else {})
+    elif msgtype == Messages.AddProxies:
+        mappings, atomic = params
+        encoder.pack(UINT, len(mappings))
+        for mapping in mappings:
+            encoder.host_port_proto(mapping[0])
+            encoder.host_port_proto(mapping[1])
+            encoder.options(mapping[2] if len(mapping) > 2 else {})
+        encoder.pack(BYTE, bool(atomic))
+    elif msgtype == Messages.DelProxies:
+        srcs, atomic = params
+        encoder.pack(UINT, len(srcs))
+        for src in srcs:
+            encoder.host_port_proto(src)
+        encoder.pack(BYTE, bool(atomic))
+    elif msgtype == Messages.Results:
+        encoder.pack(UINT, len(params))
+        for ok, error in params:
+            encoder.pack(BYTE, bool(ok))
+            encoder.string(error or '')
+    elif msgtype == Messages.SetProfiling:
+        encoder.pack(BYTE, bool(params))
+    elif msgtype == Messages.GetProfile:
+        encoder.pack(UINT, len(params))
+        for name, snapshot in params.items():
+            encoder.string(name)
+            encoder.histogram(snapshot)
+    elif msgtype == Messages.Quit:
+        pass
+    else:
+        raise ValueError("{} is not a valid message!".format(msgtype))
+    return encoder.frame()
+
+def decode_message(data):
     """
-    Reads a message packet off the socket, returning the tuple
-    (MessageType, Params) or a boolean if it is a success/fail message.
+    Unpacks the body of a frame, returning the tuple (MessageType, Params) or
+    a boolean if it is a success/fail message.
     """
-    msg_type = struct.unpack("@B", socket.recv(1))[0]
+    try:
+        return _decode_message(Decoder(data))
+    except struct.error as err:
+        raise ValueError("Truncated message: {}".format(err))
+
+def _decode_message(decoder):
+    msg_type = decoder.unpack(BYTE)[0]
 
     if msg_type == Messages.AddProxy:
-        src = read_host_port_proto(socket)
-        dest = read_host_port_proto(socket)
-        return (Messages.AddProxy, (src, dest))
+        src = decoder.host_port_proto()
+        dest = decoder.host_port_proto()
+        options = decoder.options()
+        return (Messages.AddProxy, (src, dest, options))
+    elif msg_type in (Messages.AddBackend, Messages.DelBackend):
+        src = decoder.host_port_proto()
+        dest = decoder.host_port_proto()
+        return (msg_type, (src, dest))
     elif msg_type == Messages.DelProxy:
-        src = read_host_port_proto(socket)
-        return (Messages.DelProxy, src)
+        return (Messages.DelProxy, decoder.host_port_proto())
     elif msg_type == Messages.GetProxies:
-        num_proxies = struct.unpack("@I", socket.recv(4))[0]
         proxies = []
-        for x in range(num_proxies):
-            src = read_host_port_proto(socket)
-            dest = read_host_port_proto(socket)
-            proxies.append((src, dest))
+        for x in range(decoder.uint()):
+            src = decoder.host_port_proto()
+            dest = decoder.host_port_proto()
+            options = decoder.options()
+            proxies.append((src, dest, options))
         return (Messages.GetProxies, proxies)
+    elif msg_type == Messages.AddProxies:
+        mappings = []
+        for x in range(decoder.uint()):
+            src = decoder.host_port_proto()
+            dest = decoder.host_port_proto()
+            options = decoder.options()
+            mappings.append((src, dest, options))
+        atomic = bool(decoder.unpack(BYTE)[0])
+        return (Messages.AddProxies, (mappings, atomic))
+    elif msg_type == Messages.DelProxies:
+        srcs = [decoder.host_port_proto() for x in range(decoder.uint())]
+        atomic = bool(decoder.unpack(BYTE)[0])
+        return (Messages.DelProxies, (srcs, atomic))
+    elif msg_type == Messages.Results:
+        results = []
+        for x in range(decoder.uint()):
+            ok = bool(decoder.unpack(BYTE)[0])
+            results.append((ok, decoder.string()))
+        return (Messages.Results, results)
+    elif msg_type == Messages.SetProfiling:
+        return (Messages.SetProfiling, bool(decoder.unpack(BYTE)[0]))
+    elif msg_type == Messages.GetProfile:
+        profile = {}
+        for x in range(decoder.uint()):
+            name = decoder.string()
+            profile[name] = decoder.histogram()
+        return (Messages.GetProfile, profile)
     elif msg_type == Messages.Quit:
         return (Messages.Quit, [])
     elif msg_type in (1, 0):
@@ -46,38 +283,98 @@ def read_message(socket):
     else:
         raise ValueError("{} is not a valid message!".format(msg_type))
 
-def write_host_port_proto(socket, host, port, proto):
+def check_header(version, size):
+    "Raises a ValueError if a frame header is from a different protocol"
+    if version != VERSION:
+        raise ValueError("Protocol version {} is not supported (expected {})".format(version, VERSION))
+    elif size > MAX_FRAME_SIZE:
+        raise ValueError("A frame of {} bytes is too large".format(size))
+
+class Reader:
     """
-    Writes a single host-port-proto triple to the socket.
-    """ 
-    packing_send = lambda val, fmt: socket.send(struct.pack(fmt, val))
-    packing_send(len(host), "@I")
-    socket.send(bytes(host, 'utf-8'))
-    packing_send(port, "@I")
-    packing_send(proto, "@I")
+    Reads messages off a socket, receiving as much as is waiting each time
+    and keeping whatever arrives ahead of the message being read for the next
+    one.
 
-def write_message(socket, msg):
+    This works on non-blocking sockets as well: fill() receives whatever is
+    waiting, and next_message() returns a message once all of it is there.
     """
-    Writes a single message to the socket.
+    def __init__(self, socket):
+        self._socket = socket
+        self._buffer = bytearray(READ_SIZE)
+        self._start = 0
+        self._end = 0
+
+    def fill(self):
+        """
+        Receives whatever is waiting on the socket into the buffer, and
+        returns how many bytes there were (which is 0 at EOF).
+        """
+        if self._start == self._end:
+            self._start = self._end = 0
+        elif len(self._buffer) - self._end < READ_SIZE:
+            # Move what is left up to the front, and make room for more
+            waiting = self._end - self._start
+            self._buffer[:waiting] = self._buffer[self._start:self._end]
+            self._start, self._end = 0, waiting
+            if len(self._buffer) - waiting < READ_SIZE:
+                self._buffer.extend(bytes(len(self._buffer)))
+
+        with memoryview(self._buffer) as view:
+            size = self._socket.recv_into(view[self._end:])
+        self._end += size
+        return size
+
+    def next_message(self):
+        "Returns the next message in the buffer, or None if it hasn't all arrived"
+        waiting = self._end - self._start
+        if waiting < HEADER.size:
+            return None
+
+        version, size = HEADER.unpack_from(self._buffer, self._start)
+        check_header(version, size)
+        if waiting < HEADER.size + size:
+            return None
+
+        body_start = self._start + HEADER.size
+        self._start = body_start + size
+        return decode_message(bytes(self._buffer[body_start:self._start]))
+
+    def read_message(self):
+        "Waits for the next message, and returns it"
+        while True:
+            msg = self.next_message()
+            if msg is not None:
+                return msg
+            elif not self.fill():
+                raise EOFError("The socket was closed before a whole message arrived")
+
+def recv_exactly(socket, size):
+    "Receives exactly size bytes off the socket"
+    data = bytearray(size)
+    with memoryview(data) as view:
+        received = 0
+        while received < size:
+            chunk = socket.recv_into(view[received:])
+            if not chunk:
+                raise EOFError("The socket was closed before a whole message arrived")
+            received += chunk
+    return data
+
+def read_message(socket):
     """
+    Reads a single message off the socket, returning the tuple (MessageType,
+    Params) or a boolean if it is a success/fail message.
 
-    if type(msg) == bool and msg in (True, False):
-        socket.send(struct.pack("@B", msg))
-        return
+    Nothing past the end of the message is read, so this can be mixed with
+    writes - but a Reader is quicker for reading many messages in a row.
+    """
+    version, size = HEADER.unpack(recv_exactly(socket, HEADER.size))
+    check_header(version, size)
+    return decode_message(recv_exactly(socket, size))
 
-    msgtype, params = msg
-    socket.send(struct.pack("@B", msgtype))
-    if msgtype == Messages.AddProxy:
-        write_host_port_proto(socket, params[0][0], params[0][1], params[0][2])
-        write_host_port_proto(socket, params[1][0], params[1][1], params[1][2])
-    elif msgtype == Messages.DelProxy:
-        write_host_port_proto(socket, params[0], params[1], params[2])
-    elif msgtype == Messages.GetProxies:
-        socket.send(struct.pack("@I", len(params)))
-        for param in params:
-            write_host_port_proto(socket, param[0][0], param[0][1], param[0][2])
-            write_host_port_proto(socket, param[1][0], param[1][1], param[1][2])
-    elif msgtype == Messages.Quit:
-        pass
-    else:
-        raise ValueError("{} is not a valid message!".format(msg_type))
+def write_message(socket, msg):
+    """
+    Writes a single message to the socket.
+    """
+    socket.sendall(encode_message(msg))
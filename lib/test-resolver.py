@@ -0,0 +1,147 @@
+import queue
+import threading
+
+import resolver
+
+def assert_eq(a, b):
+    print(repr(a), "==", repr(b), "...")
+    assert a == b
+
+# The clock only moves when the test says so
+now = [1000.0]
+
+# What each host resolves to (an exception is raised instead of returned), how
+# many times each has been looked up, and an event which holds up lookups of
+# a host until it is set
+answers = {}
+lookups = {}
+gates = {}
+
+def stub_resolve(host):
+    lookups[host] = lookups.get(host, 0) + 1
+    if host in gates:
+        gates[host].wait(5)
+
+    answer = answers[host]
+    if isinstance(answer, Exception):
+        raise answer
+    return answer
+
+# Stands in for the forwarding thread - whatever the worker threads deliver is
+# only run when the test asks for it
+delivered = queue.Queue()
+
+def deliver(func, *args):
+    delivered.put((func, args))
+
+def run_delivered():
+    func, args = delivered.get(timeout=5)
+    func(*args)
+
+results = []
+def callback(address, error):
+    results.append((address, error))
+
+cache = resolver.Resolver(deliver, resolve=stub_resolve, ttl=60.0, negative_ttl=5.0,
+                          clock=lambda: now[0], workers=2)
+
+try:
+    cache.resolve('127.0.0.1', callback)
+    assert_eq(results.pop(), ('127.0.0.1', None))
+    assert_eq(lookups, {})
+    print("[Address] Success")
+
+    answers['example.com'] = '10.0.0.1'
+    cache.resolve('example.com', callback)
+    assert_eq(results, [])
+    run_delivered()
+    assert_eq(results.pop(), ('10.0.0.1', None))
+    assert_eq(lookups['example.com'], 1)
+    print("[Lookup] Success")
+
+    now[0] += 30
+    cache.resolve('example.com', callback)
+    assert_eq(results.pop(), ('10.0.0.1', None))
+    assert_eq(lookups['example.com'], 1)
+    print("[Cached] Success")
+
+    # Past REFRESH_AHEAD of the TTL, the cached answer is still used, but
+    # another lookup starts in the background
+    answers['example.com'] = '10.0.0.2'
+    now[0] += 20
+    cache.resolve('example.com', callback)
+    assert_eq(results.pop(), ('10.0.0.1', None))
+    run_delivered()
+    assert_eq(lookups['example.com'], 2)
+    cache.resolve('example.com', callback)
+    assert_eq(results.pop(), ('10.0.0.2', None))
+    print("[Refresh Ahead] Success")
+
+    # A refresh which fails leaves the answer which is still good alone
+    answers['example.com'] = OSError("Refresh failed")
+    now[0] += 50
+    cache.resolve('example.com', callback)
+    assert_eq(results.pop(), ('10.0.0.2', None))
+    run_delivered()
+    assert_eq(lookups['example.com'], 3)
+
+    # ... and the next caller tries the refresh again
+    cache.resolve('example.com', callback)
+    assert_eq(results.pop(), ('10.0.0.2', None))
+    run_delivered()
+    assert_eq(lookups['example.com'], 4)
+    print("[Failed Refresh] Success")
+
+    # Once the TTL is up, callers have to wait on a new lookup
+    answers['example.com'] = '10.0.0.3'
+    now[0] += 60
+    cache.resolve('example.com', callback)
+    assert_eq(results, [])
+    run_delivered()
+    assert_eq(results.pop(), ('10.0.0.3', None))
+    assert_eq(lookups['example.com'], 5)
+    print("[Expiry] Success")
+
+    # Everyone who asks while a lookup is running waits on that lookup
+    answers['busy.example.com'] = '10.0.1.1'
+    gates['busy.example.com'] = threading.Event()
+    for _ in range(3):
+        cache.resolve('busy.example.com', callback)
+    gates['busy.example.com'].set()
+    run_delivered()
+    assert_eq(results, [('10.0.1.1', None)] * 3)
+    assert_eq(lookups['busy.example.com'], 1)
+    results.clear()
+    print("[Coalescing] Success")
+
+    # Failures are cached too, but only for the negative TTL
+    error = OSError("Name or service not known")
+    answers['missing.example.com'] = error
+    cache.resolve('missing.example.com', callback)
+    run_delivered()
+    assert_eq(results.pop(), (None, error))
+    now[0] += 4
+    cache.resolve('missing.example.com', callback)
+    assert_eq(results.pop(), (None, error))
+    assert_eq(lookups['missing.example.com'], 1)
+    now[0] += 2
+    cache.resolve('missing.example.com', callback)
+    assert_eq(results, [])
+    run_delivered()
+    assert_eq(results.pop(), (None, error))
+    assert_eq(lookups['missing.example.com'], 2)
+    print("[Negative Caching] Success")
+
+    # getaddrinfo() raises a UnicodeError for overlong labels, which has to
+    # reach the callers like any other failure
+    long_name = 'a' * 70 + '.com'
+    answers[long_name] = UnicodeError("label empty or too long")
+    cache.resolve(long_name, callback)
+    run_delivered()
+    address, error = results.pop()
+    assert_eq((address, type(error)), (None, UnicodeError))
+    cache.resolve(long_name, callback)
+    assert_eq(results.pop()[0], None)
+    print("[Unexpected Error] Success")
+finally:
+    cache.close()
@@ -1,5 +1,6 @@
 import socket
 import socketproto
+import struct
 import time
 
 def assert_eq(a, b):
@@ -10,7 +11,7 @@ test_socket_send = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
 test_socket_send.connect('/tmp/proxy-sockets-test')
 
 try:
-    socketproto.write_message(test_socket_send, (socketproto.Messages.AddProxy, (('', 8000, socket.SOCK_DGRAM), ('www.google.com', 80, socket.SOCK_STREAM))))
+    socketproto.write_message(test_socket_send, (socketproto.Messages.AddProxy, (('', 8000, socket.SOCK_DGRAM), ('www.google.com', 80, socket.SOCK_STREAM), {'rcvbuf': '262144', 'tos': '0x10'})))
     msg = socketproto.read_message(test_socket_send)
     assert type(msg) is bool
     assert_eq(msg, True)
@@ -25,7 +26,28 @@ try:
     socketproto.write_message(test_socket_send, (socketproto.Messages.GetProxies, []))
     msgtype, param = socketproto.read_message(test_socket_send)
     assert_eq(msgtype, socketproto.Messages.GetProxies)
-    assert_eq(param, [(('', 8000, socket.SOCK_DGRAM), ('www.google.com', 80, socket.SOCK_STREAM))])
+    assert_eq(param, [(('', 8000, socket.SOCK_DGRAM), ('www.google.com', 80, socket.SOCK_STREAM), {'rcvbuf': '262144', 'tos': '0x10'})])
     print("[GetProxies] Success")
+
+    start = time.monotonic()
+    socketproto.write_message(test_socket_send, (socketproto.Messages.GetProxies, []))
+    msgtype, param = socketproto.read_message(test_socket_send)
+    assert_eq(msgtype, socketproto.Messages.GetProxies)
+    assert_eq(len(param), 20000)
+    assert_eq(param[-1], (('', 19999, socket.SOCK_STREAM), ('localhost', 19999, socket.SOCK_STREAM), {'nodelay': 'true'}))
+    print("Took {:.1f}ms".format((time.monotonic() - start) * 1000))
+    print("[GetProxies (Large)] Success")
+
+    socketproto.write_message(test_socket_send, (socketproto.Messages.AddProxies, ([(('', 8000, socket.SOCK_STREAM), ('localhost', 80, socket.SOCK_STREAM), {}), (('', 8001, socket.SOCK_STREAM), ('localhost', 81, socket.SOCK_STREAM), {'nodelay': 'true'})], True)))
+    msgtype, param = socketproto.read_message(test_socket_send)
+    assert_eq(msgtype, socketproto.Messages.Results)
+    assert_eq(param, [(False, 'Not applied'), (False, 'Address already in use')])
+    print("[AddProxies] Success")
+
+    # A DelProxy, the way that it was sent before there were frames
+    host = bytes('', 'utf-8')
+    test_socket_send.sendall(struct.pack("@BI", socketproto.Messages.DelProxy, len(host)) + host +
+                             struct.pack("@II", 8000, socket.SOCK_DGRAM))
+    print("[Version] Success")
 finally:
     test_socket_send.close()
@@ -22,6 +22,7 @@ try:
     assert_eq(params[1][0], 'www.google.com')
     assert_eq(params[1][1], 80)
     assert_eq(params[1][2], socket.SOCK_STREAM)
+    assert_eq(params[2], {'rcvbuf': '262144', 'tos': '0x10'})
 
     socketproto.write_message(client, True)
     print("[AddProxy] Success")
@@ -41,8 +42,33 @@ try:
     assert_eq(msgtype, socketproto.Messages.GetProxies)
     assert_eq(params, [])
 
-    socketproto.write_message(client, (socketproto.Messages.GetProxies, [(('', 8000, socket.SOCK_DGRAM), ('www.google.com', 80, socket.SOCK_STREAM))]))
+    socketproto.write_message(client, (socketproto.Messages.GetProxies, [(('', 8000, socket.SOCK_DGRAM), ('www.google.com', 80, socket.SOCK_STREAM), {'rcvbuf': '262144', 'tos': '0x10'})]))
     print("[GetProxies] Success")
+
+    # The fourth message lists the proxies again (say that there are lots)
+    msgtype, params = socketproto.read_message(client)
+    assert_eq(msgtype, socketproto.Messages.GetProxies)
+
+    socketproto.write_message(client, (socketproto.Messages.GetProxies, [(('', port, socket.SOCK_STREAM), ('localhost', port, socket.SOCK_STREAM), {'nodelay': 'true'}) for port in range(20000)]))
+    print("[GetProxies (Large)] Success")
+
+    # The fifth message adds two mappings at once (say that the second is taken)
+    msgtype, params = socketproto.read_message(client)
+    assert_eq(msgtype, socketproto.Messages.AddProxies)
+    assert_eq(params, ([(('', 8000, socket.SOCK_STREAM), ('localhost', 80, socket.SOCK_STREAM), {}),
+                        (('', 8001, socket.SOCK_STREAM), ('localhost', 81, socket.SOCK_STREAM), {'nodelay': 'true'})],
+                       True))
+
+    socketproto.write_message(client, (socketproto.Messages.Results, [(False, 'Not applied'), (False, 'Address already in use')]))
+    print("[AddProxies] Success")
+
+    # The last message is from a tool which doesn't put messages into frames
+    try:
+        socketproto.read_message(client)
+        assert False, "An unframed message was accepted"
+    except ValueError as e:
+        print(repr(e))
+    print("[Version] Success")
 finally:
     client.close()
     test_socket_recv.close()
@@ -0,0 +1,149 @@
+"""
+A hierarchical timer wheel, for keeping track of lots of timeouts cheaply.
+
+Time is divided into ticks of a fixed resolution. The first level of the wheel
+has a slot for each of the next SLOTS ticks, the second level has a slot for
+each of the next SLOTS groups of SLOTS ticks, and so on. Timers are put into
+the slot that their deadline falls in, which makes scheduling and cancelling
+them O(1); whenever the first level wraps around, the next slot of the level
+above is emptied out and its timers are spread over the level below.
+
+Timers which would have to be moved around a lot (like idle timeouts, which
+are pushed back whenever data moves) are best handled lazily: keep a
+timestamp of the last activity, and when the timer fires, schedule a new one
+for the time remaining if the timeout hasn't actually passed yet.
+"""
+
+import math
+
+# Each level has 2 ** SLOT_BITS slots
+SLOT_BITS = 8
+SLOTS = 1 << SLOT_BITS
+SLOT_MASK = SLOTS - 1
+
+class Timer:
+    "A callback which a TimerWheel runs once its deadline has passed"
+    def __init__(self, wheel, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self._wheel = wheel
+        self._slot = None
+
+    def cancel(self):
+        "Stops the timer from running, if it hasn't already"
+        if self._slot is not None:
+            self._slot.discard(self)
+            self._slot = None
+            self._wheel._count -= 1
+
+class TimerWheel:
+    def __init__(self, now, resolution=0.01, levels=4):
+        self._resolution = resolution
+        self._tick = self._to_tick(now)
+        self._levels = [[set() for _ in range(SLOTS)] for _ in range(levels)]
+
+        # Deadlines too far off for the top level sit here until they come
+        # close enough
+        self._overflow = set()
+        self._count = 0
+
+    def _to_tick(self, when):
+        return int(when / self._resolution)
+
+    def __len__(self):
+        return self._count
+
+    def _due_tick(self, deadline):
+        # Rounding up means that timers never go off early
+        return max(math.ceil(deadline / self._resolution), self._tick + 1)
+
+    def due(self, deadline):
+        """
+        Returns the time at which a timer scheduled now for deadline becomes
+        due - anything after this that it runs is lateness on the caller's
+        part, rather than the wheel's resolution.
+        """
+        return self._due_tick(deadline) * self._resolution
+
+    def _insert(self, timer):
+        "Puts a timer into the slot that its deadline falls into"
+        tick = self._due_tick(timer.deadline)
+        distance = tick - self._tick
+
+        for level_num, level in enumerate(self._levels):
+            if distance < 1 << (SLOT_BITS * (level_num + 1)):
+                slot = level[(tick >> (SLOT_BITS * level_num)) & SLOT_MASK]
+                break
+        else:
+            slot = self._overflow
+
+        slot.add(timer)
+        timer._slot = slot
+
+    def schedule(self, deadline, callback, *args):
+        "Runs callback(*args) once the (monotonic) deadline has passed"
+        timer = Timer(self, deadline, callback, args)
+        self._insert(timer)
+        self._count += 1
+        return timer
+
+    def next_timeout(self, now, limit):
+        """
+        Returns how long the caller can wait before calling advance(), which is
+        never more than limit. This can be earlier than the next deadline,
+        when the wheel has to cascade timers down from a higher level.
+        """
+        if not self._count:
+            return limit
+
+        level = self._levels[0]
+        base = self._tick & SLOT_MASK
+        end = min(SLOTS - base, int(limit / self._resolution) + 1)
+        for offset in range(1, end):
+            if level[base + offset]:
+                break
+        else:
+            offset = end
+
+        return min(limit, max(0, (self._tick + offset) * self._resolution - now))
+
+    def advance(self, now):
+        "Runs all of the timers whose deadlines have passed"
+        target = self._to_tick(now)
+        if not self._count:
+            self._tick = max(self._tick, target)
+            return
+
+        while self._tick < target:
+            self._tick += 1
+            if self._tick & SLOT_MASK == 0:
+                self._cascade()
+
+            slot = self._levels[0][self._tick & SLOT_MASK]
+            while slot:
+                timer = slot.pop()
+                timer._slot = None
+                self._count -= 1
+                timer.callback(*timer.args)
+
+    def _cascade(self):
+        """
+        Moves the timers of the next slot of each higher level down to the
+        levels below, whenever the level below wraps around.
+        """
+        for level_num in range(1, len(self._levels)):
+            index = (self._tick >> (SLOT_BITS * level_num)) & SLOT_MASK
+            slot = self._levels[level_num][index]
+            timers = list(slot)
+            slot.clear()
+            for timer in timers:
+                self._insert(timer)
+
+            if index != 0:
+                break
+        else:
+            timers = list(self._overflow)
+            self._overflow.clear()
+            for timer in timers:
+                self._insert(timer)
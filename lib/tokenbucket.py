@@ -0,0 +1,34 @@
+"""
+Token buckets, for limiting how fast data moves through a mapping.
+
+A bucket holds up to burst tokens and gains rate tokens every second, and each
+byte that is moved takes a token out of it. Once a bucket is empty, nothing
+more can move until it has refilled.
+"""
+
+class TokenBucket:
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = now
+
+    def _refill(self, now):
+        if now > self._updated:
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+    def available(self, now):
+        "Returns how many whole tokens are in the bucket"
+        self._refill(now)
+        return max(0, int(self._tokens))
+
+    def consume(self, amount, now):
+        "Takes tokens out of the bucket"
+        self._refill(now)
+        self._tokens -= amount
+
+    def delay(self, amount, now):
+        "Returns how many seconds it will be until the bucket has amount tokens"
+        self._refill(now)
+        return max(0.0, (min(amount, self.burst) - self._tokens) / self.rate)
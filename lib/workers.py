@@ -0,0 +1,297 @@
+"""
+Runs the port forwarder in several worker processes.
+
+The portforward module runs all of its forwarding on a single thread, which
+means that it can never use more than one core. A WorkerPool gets around this
+by forking off worker processes, each of which has its own copy of portforward
+(and thus its own event loop and poller). Every mapping is bound in every
+worker with SO_REUSEPORT, so that the kernel spreads incoming connections
+across all of them.
+
+A WorkerPool has the same add_mapping/del_mapping/get_mappings/quit interface
+as the portforward module, so the services can use either one. The workers
+themselves can run any engine with that interface (such as asyncforward).
+"""
+
+import errno
+import importlib
+import logging
+import multiprocessing
+import os
+import sys
+
+import histogram
+from mapping import parse_options, settle_batch, check_removals
+
+logger = logging.getLogger('[' + __name__ + ']')
+
+class Commands:
+    "The commands that can be sent to a worker process"
+    (ADD, DEL, ADD_BACKEND, DEL_BACKEND, SET_PROFILING, GET_PROFILE, START_METRICS,
+     ADD_MANY, DEL_MANY, QUIT) = list(range(10))
+
+def _worker_main(conn, engine_name):
+    """
+    Runs a worker process, which carries out commands sent down its pipe until
+    it is told to quit (or the pool goes away).
+    """
+    # This is imported here, so that each worker has its own forwarding thread
+    # rather than one inherited from the pool.
+    engine = importlib.import_module(engine_name)
+
+    try:
+        while True:
+            try:
+                command, args = conn.recv()
+            except EOFError:
+                break
+
+            if command == Commands.QUIT:
+                break
+
+            try:
+                result = None
+                if command == Commands.ADD:
+                    engine.add_mapping(*args)
+                elif command == Commands.DEL:
+                    engine.del_mapping(*args)
+                elif command == Commands.ADD_BACKEND:
+                    engine.add_backend(*args)
+                elif command == Commands.DEL_BACKEND:
+                    engine.del_backend(*args)
+                elif command == Commands.SET_PROFILING:
+                    engine.set_profiling(*args)
+                elif command == Commands.GET_PROFILE:
+                    result = engine.get_profile()
+                elif command == Commands.START_METRICS:
+                    engine.start_metrics(*args)
+                elif command == Commands.ADD_MANY:
+                    result = engine.add_mappings(*args)
+                elif command == Commands.DEL_MANY:
+                    result = engine.del_mappings(*args)
+                conn.send((True, result))
+            except (OSError, KeyError, ValueError) as err:
+                conn.send((False, err))
+    finally:
+        engine.quit()
+        engine.thread.join()
+
+class WorkerPool:
+    "A group of worker processes that all forward the same mappings"
+    def __init__(self, count, engine_name='portforward'):
+        if engine_name in sys.modules:
+            # Otherwise, every worker would inherit the same event loop
+            raise RuntimeError("A WorkerPool must be created before {} is imported".format(engine_name))
+
+        context = multiprocessing.get_context('fork')
+        self._workers = []
+        for _ in range(count):
+            (ours, theirs) = context.Pipe()
+            process = context.Process(target=_worker_main, args=(theirs, engine_name), daemon=True)
+            process.start()
+            theirs.close()
+            self._workers.append((process, ours))
+
+        # Map: src_portspec -> ([dest_portspec, ...], options)
+        self._mappings = {}
+        logger.debug("Started %i Workers", count)
+
+    def _broadcast(self, workers, command, args, results=None):
+        """
+        Sends a command to every worker given, and returns the workers which
+        carried it out along with the first error any of them reported. What
+        each worker returned is appended to results, if it is given.
+        """
+        for _, conn in workers:
+            conn.send((command, args))
+
+        succeeded = []
+        error = None
+        for worker in workers:
+            ok, reply = worker[1].recv()
+            if ok:
+                succeeded.append(worker)
+                if results is not None:
+                    results.append(reply)
+            elif error is None:
+                error = reply
+        return (succeeded, error)
+
+    def add_mapping(self, src_portspec, dest_portspec, options=None):
+        """
+        Adds a mapping to every worker. If any of them can't add it, then it
+        is removed from the others and the error is raised.
+        """
+        if src_portspec in self._mappings:
+            # Every worker would happily bind it again with SO_REUSEPORT
+            raise OSError(errno.EADDRINUSE, os.strerror(errno.EADDRINUSE))
+
+        options = parse_options(dict(options or {}, reuseport=True))
+        succeeded, error = self._broadcast(self._workers, Commands.ADD,
+                                           (src_portspec, dest_portspec, options))
+        if error is not None:
+            self._broadcast(succeeded, Commands.DEL, (src_portspec,))
+            raise error
+
+        self._mappings[src_portspec] = ([dest_portspec], options)
+
+    def del_mapping(self, src_portspec, drain=False):
+        "Removes a mapping from every worker, draining its connections if asked to"
+        if src_portspec not in self._mappings:
+            raise KeyError(src_portspec)
+
+        del self._mappings[src_portspec]
+        _, error = self._broadcast(self._workers, Commands.DEL, (src_portspec, drain))
+        if error is not None:
+            raise error
+
+    def add_mappings(self, mappings, atomic=False):
+        """
+        Adds many mappings to every worker at once, from a list of
+        (src_portspec, dest_portspec, options) triples.
+
+        Returns a list with None for each mapping which was added, and the
+        error for each which wasn't. A mapping which any worker can't add is
+        removed from the others, and if atomic is True, then either every
+        mapping is added or none of them are.
+        """
+        batch = []
+        errors = []
+        for src_portspec, dest_portspec, options in mappings:
+            src_portspec, dest_portspec = tuple(src_portspec), tuple(dest_portspec)
+            try:
+                # The workers turn away a mapping which appears twice in the
+                # batch themselves
+                if src_portspec in self._mappings:
+                    raise OSError(errno.EADDRINUSE, os.strerror(errno.EADDRINUSE))
+                options = parse_options(dict(options or {}, reuseport=True))
+                errors.append(None)
+            except (OSError, ValueError) as err:
+                errors.append(err)
+            batch.append((src_portspec, dest_portspec, options))
+
+        if atomic and any(errors):
+            return settle_batch(errors, atomic)
+
+        todo = [index for index, err in enumerate(errors) if err is None]
+        results = []
+        _, error = self._broadcast(self._workers, Commands.ADD_MANY,
+                                   ([batch[index] for index in todo], False), results)
+        if error is not None:
+            raise error
+
+        for worker_errors in results:
+            for index, err in zip(todo, worker_errors):
+                if err is not None and errors[index] is None:
+                    errors[index] = err
+
+        failed = any(errors[index] is not None for index in todo)
+        for worker, worker_errors in zip(self._workers, results):
+            undo = [batch[index][0] for index, err in zip(todo, worker_errors)
+                    if err is None and (errors[index] is not None or (atomic and failed))]
+            if undo:
+                self._broadcast([worker], Commands.DEL_MANY, (undo,))
+
+        errors = settle_batch(errors, atomic)
+        for index in todo:
+            if errors[index] is None:
+                src_portspec, dest_portspec, options = batch[index]
+                self._mappings[src_portspec] = ([dest_portspec], options)
+        return errors
+
+    def del_mappings(self, src_portspecs, drain=False, atomic=False):
+        """
+        Removes many mappings from every worker at once. Returns a list with
+        None for each mapping which was removed, and the error for each which
+        wasn't - if atomic is True, then either every mapping is removed or
+        none of them are.
+        """
+        src_portspecs = [tuple(src) for src in src_portspecs]
+        errors = check_removals(src_portspecs, self._mappings, atomic)
+        todo = [src for src, err in zip(src_portspecs, errors) if err is None]
+        for src_portspec in todo:
+            del self._mappings[src_portspec]
+        _, error = self._broadcast(self._workers, Commands.DEL_MANY, (todo, drain))
+        if error is not None:
+            raise error
+        return errors
+
+    def add_backend(self, src_portspec, dest_portspec):
+        """
+        Adds another destination to a mapping in every worker, undoing it in
+        all of them if any of them can't add it.
+        """
+        dests, _ = self._mappings[src_portspec]
+        succeeded, error = self._broadcast(self._workers, Commands.ADD_BACKEND,
+                                           (src_portspec, dest_portspec))
+        if error is not None:
+            self._broadcast(succeeded, Commands.DEL_BACKEND, (src_portspec, dest_portspec))
+            raise error
+
+        dests.append(dest_portspec)
+
+    def del_backend(self, src_portspec, dest_portspec):
+        "Removes a destination from a mapping in every worker"
+        dests, _ = self._mappings[src_portspec]
+        if dest_portspec not in dests:
+            raise KeyError(dest_portspec)
+        elif len(dests) == 1:
+            raise ValueError("Can't remove the last backend of a mapping")
+
+        dests.remove(dest_portspec)
+        _, error = self._broadcast(self._workers, Commands.DEL_BACKEND,
+                                   (src_portspec, dest_portspec))
+        if error is not None:
+            raise error
+
+    def get_mappings(self):
+        "Returns a list of (src_portspec, dest_portspec, options) for every destination of every mapping"
+        return [(src, dest, dict(options)) for src, (dests, options) in self._mappings.items()
+                for dest in dests]
+
+    def set_profiling(self, enabled):
+        "Starts (or stops) profiling the event loop of every worker"
+        _, error = self._broadcast(self._workers, Commands.SET_PROFILING, (enabled,))
+        if error is not None:
+            raise error
+
+    def get_profile(self):
+        "Returns the profiles of all of the workers, merged together"
+        profiles = []
+        _, error = self._broadcast(self._workers, Commands.GET_PROFILE, (), profiles)
+        if error is not None:
+            raise error
+
+        names = set(name for profile in profiles for name in profile)
+        return {name: histogram.merge(profile[name] for profile in profiles if name in profile)
+                for name in names}
+
+    def start_metrics(self, port, host='127.0.0.1'):
+        """
+        Starts serving the metrics of every worker over HTTP. Each worker has
+        its own counters, so they can't share a port - the first worker
+        serves its metrics on the port given, the second on the one after
+        that, and so on.
+        """
+        for number, (_, conn) in enumerate(self._workers):
+            conn.send((Commands.START_METRICS, (port + number, host)))
+
+        error = None
+        for _, conn in self._workers:
+            ok, reply = conn.recv()
+            if not ok and error is None:
+                error = reply
+        if error is not None:
+            raise error
+
+    def quit(self):
+        "Stops all of the workers, waiting for them to exit"
+        for process, conn in self._workers:
+            try:
+                conn.send((Commands.QUIT, ()))
+            except OSError:
+                pass
+
+        for process, conn in self._workers:
+            process.join()
+            conn.close()